@@ -3,9 +3,13 @@ from famma_runner.runners.generation_runner import GenerationRunner
 from famma_runner.runners.eval_runner import EvaluationRunner
 from famma_runner.runners.analyzer import Analyzer
 from famma_runner.runners.distillation_runner import DistillationRunner
+from famma_runner.runners.leaderboard import LeaderboardAnalyzer
+from famma_runner.runners.live_analyzer import LiveAnalyzer
 
 __all__ = ["Runner",
            "GenerationRunner",
            "EvaluationRunner",
            "Analyzer",
-           "DistillationRunner"]
+           "DistillationRunner",
+           "LeaderboardAnalyzer",
+           "LiveAnalyzer"]
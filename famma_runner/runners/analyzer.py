@@ -1,11 +1,20 @@
 from easyllm_kit.utils.io_utils import initialize_database, write_to_database
-from easyllm_kit.utils import get_logger, read_json, convert_to_dict
+from easyllm_kit.utils import get_logger, convert_to_dict
 import pandas as pd
 from famma_runner.runners.base_runner import Runner
-from famma_runner.utils import DC, LANGUAGE_ORDER, calculate_accuracy
+from famma_runner.utils import DC, LANGUAGE_ORDER, build_accuracy_cube, accuracy_from_cube, count_from_cube, \
+    clustered_bootstrap_ci
+from famma_runner.utils.compress_utils import load_store
+from famma_runner.utils.eval_utils import ANALYSIS_TYPES, CUBE_DIMENSIONS, BREAKDOWNS, LANGUAGE_BREAKDOWNS, \
+    to_correct_flag
 
 logger = get_logger('analyzer', 'analyzer.log')
 
+# Sub-questions of a main question share their context, so they are resampled together
+BOOTSTRAP_CLUSTER_BY = [DC.LANGUAGE, DC.MAIN_QUESTION_ID]
+
+DEFAULT_BOOTSTRAP_CONFIG = {'n_resamples': 10000, 'confidence_level': 0.95, 'seed': 0}
+
 
 @Runner.register("analyzer")
 class Analyzer(Runner):
@@ -18,13 +27,22 @@ class Analyzer(Runner):
         self.target_db_name = f'{to_analyze_db_name}_result'
         self.target_db = initialize_database(output_db=self.target_db_name)
 
+        # Bootstrap confidence intervals, disabled with n_resamples: 0
+        self.bootstrap_config = {**DEFAULT_BOOTSTRAP_CONFIG, **dict(config.get('bootstrap') or {})}
+
         self.dataset_df = self.setup_dataset()
         self.metrics = {}
         self.correct_question_ids = {}
 
     def setup_dataset(self):
+        return self.load_evaluated_store(self.data_config.data_dir)
+
+    @staticmethod
+    def load_evaluated_store(data_dir):
+        """Load an evaluated result store into a DataFrame with a 0/1 'is_correct_by_model' column."""
         # Load the dataset
-        dataset_json = read_json(self.data_config.data_dir)
+        # Compressed trace fields, if any, are decompressed transparently
+        dataset_json = load_store(data_dir)
         # Convert the JSON data into a list of dictionaries
         records = []
         for _, details in dataset_json.items():
@@ -32,65 +50,93 @@ class Analyzer(Runner):
 
         # Create a DataFrame from the list of dictionaries
         df = pd.DataFrame(records)
-        df['is_correct_by_model'] = df['is_correct_by_model'].map(lambda x: 1 if x == 'correct' or x is True else 0)
+        df['is_correct_by_model'] = df['is_correct_by_model'].map(to_correct_flag)
         return df
 
+    @staticmethod
+    def build_analysis_frame(df):
+        """
+        Stack the rows of every analysis type into one frame tagged with an 'analysis_type' column,
+        so that all analysis types are aggregated by the same groupby.
+        """
+        df = df.copy()
+        for column in CUBE_DIMENSIONS + [DC.IS_ARITHMETIC]:
+            if column not in df.columns:
+                df[column] = None
+
+        frames = []
+        for analysis_type, condition in ANALYSIS_TYPES.items():
+            subset = df if condition is None else df[df[condition[0]] == condition[1]]
+            frames.append(subset.assign(analysis_type=analysis_type))
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def collect_correct_question_ids(analysis_df):
+        """Group the ids of correctly answered questions by analysis type and '{language}_{difficulty}'."""
+        keys = ['analysis_type', DC.LANGUAGE, DC.TOPIC_DIFFICULTY]
+        # Every (language, difficulty) seen gets an entry, in order of first appearance
+        combinations = analysis_df.groupby(keys, sort=False, dropna=False).size().index
+        correct_df = analysis_df[analysis_df['is_correct_by_model'] == 1]
+        correct_ids = correct_df.groupby(keys, sort=False, dropna=False)[DC.QUESTION_ID].agg(list)
+
+        question_ids = {analysis_type: {} for analysis_type in ANALYSIS_TYPES}
+        for language in LANGUAGE_ORDER:
+            for analysis_type, combination_language, difficulty in combinations:
+                if combination_language != language:
+                    continue
+                key = (analysis_type, combination_language, difficulty)
+                ids = correct_ids[key] if key in correct_ids.index else []
+                question_ids[analysis_type][f"{language}_{difficulty}"] = ids
+        return question_ids
+
+    def compute_confidence_intervals(self, analysis_df, analysis_type):
+        """Clustered bootstrap confidence intervals of every accuracy reported for an analysis type."""
+        breakdowns = {metric_name: (group_by, None) for metric_name, group_by in BREAKDOWNS.items()}
+        for language in LANGUAGE_ORDER:
+            for metric_name, group_by in LANGUAGE_BREAKDOWNS.items():
+                breakdowns[metric_name.format(language=language)] = (group_by, {DC.LANGUAGE: language})
+
+        current_df = analysis_df[analysis_df['analysis_type'] == analysis_type]
+        # Fall back to resampling single questions if the store has no main question ids
+        cluster_by = BOOTSTRAP_CLUSTER_BY if DC.MAIN_QUESTION_ID in current_df.columns else [DC.QUESTION_ID]
+        return clustered_bootstrap_ci(current_df, breakdowns, cluster_by,
+                                      n_resamples=int(self.bootstrap_config['n_resamples']),
+                                      confidence_level=float(self.bootstrap_config['confidence_level']),
+                                      seed=self.bootstrap_config['seed'])
+
     def run(self):
-        # Define analysis types and their corresponding filters
-        analysis_types = {
-            'consolidated': lambda df: df,  # No filter, use all data
-            'arithmetic': lambda df: df[df['is_arithmetic'] == '1'],
-            'no_arithmetic': lambda df: df[df['is_arithmetic'] == '0']
-        }
+        analysis_df = self.build_analysis_frame(self.dataset_df)
+        # One aggregation over analysis_type x language x difficulty x subfield x question_type
+        cube = build_accuracy_cube(analysis_df, ['analysis_type'] + CUBE_DIMENSIONS)
+        question_ids = self.collect_correct_question_ids(analysis_df) if self.data_config.save_question_ids else None
 
-        for analysis_type, filter_func in analysis_types.items():
-            # Filter the dataset based on the current analysis type
-            current_df = filter_func(self.dataset_df)
+        for analysis_type in ANALYSIS_TYPES:
+            current_cube = cube[cube.index.get_level_values('analysis_type') == analysis_type]
 
             # Create metrics dictionary for current analysis type
             current_metrics = {}
 
             # Basic counts
-            current_metrics['total_questions'] = len(current_df)
-            current_metrics['total_english_questions'] = len(current_df[current_df[DC.LANGUAGE] == 'english'])
-            current_metrics['total_chinese_questions'] = len(current_df[current_df[DC.LANGUAGE] == 'chinese'])
-            current_metrics['total_french_questions'] = len(current_df[current_df[DC.LANGUAGE] == 'french'])
-
-            # Calculate accuracies
-            print("Total questions:", len(current_df))
-            print("Sum correct:", current_df['is_correct_by_model'].sum())
-            print("Mean (accuracy):", current_df['is_correct_by_model'].mean())
-            print("Manual acc:", current_df['is_correct_by_model'].sum() / len(current_df))
-
-            overall_acc = calculate_accuracy(current_df)
-            current_metrics["overall_acc"] = overall_acc
-
-            overall_acc_by_subfield = calculate_accuracy(current_df, group_by=[DC.SUBFIELD])
-            current_metrics["overall_acc_by_subfield"] = overall_acc_by_subfield
-
-            overall_acc_by_difficulty = calculate_accuracy(current_df, group_by=[DC.TOPIC_DIFFICULTY])
-            current_metrics["overall_acc_by_difficulty"] = overall_acc_by_difficulty
-
-            overall_acc_by_language = calculate_accuracy(current_df, group_by=[DC.LANGUAGE])
-            current_metrics["overall_acc_by_language"] = overall_acc_by_language
+            questions_by_language = count_from_cube(current_cube, [DC.LANGUAGE])
+            current_metrics['total_questions'] = int(current_cube['total'].sum())
+            for language in LANGUAGE_ORDER:
+                current_metrics[f'total_{language}_questions'] = int(questions_by_language.get(language, 0))
 
-            # Language-specific analysis
-            current_correct_question_ids = {}
+            # Accuracies
+            for metric_name, group_by in BREAKDOWNS.items():
+                current_metrics[metric_name] = accuracy_from_cube(current_cube, group_by=group_by)
 
             for language in LANGUAGE_ORDER:
-                language_df = current_df[current_df[DC.LANGUAGE] == language]
-
-                language_acc = calculate_accuracy(language_df, group_by=[DC.TOPIC_DIFFICULTY])
-                current_metrics[f"overall_acc_by_difficulty_{language}"] = language_acc
+                for metric_name, group_by in LANGUAGE_BREAKDOWNS.items():
+                    current_metrics[metric_name.format(language=language)] = accuracy_from_cube(
+                        current_cube, group_by=group_by, where={DC.LANGUAGE: language})
 
-                for difficulty in language_df[DC.TOPIC_DIFFICULTY].unique():
-                    difficulty_df = language_df[language_df[DC.TOPIC_DIFFICULTY] == difficulty]
-                    correct_ids = difficulty_df[difficulty_df['is_correct_by_model'] == 1][DC.QUESTION_ID].tolist()
-                    current_correct_question_ids[f"{language}_{difficulty}"] = correct_ids
+            if self.bootstrap_config['n_resamples']:
+                current_metrics['confidence_intervals'] = self.compute_confidence_intervals(analysis_df, analysis_type)
 
             # Save correct_question_ids into metrics
-            if self.data_config.save_question_ids:
-                current_metrics["correct_question_ids"] = current_correct_question_ids
+            if question_ids is not None:
+                current_metrics["correct_question_ids"] = question_ids[analysis_type]
 
             # Store the metrics for this analysis type
             self.metrics[analysis_type] = current_metrics
@@ -1,6 +1,13 @@
-import json
+from easyllm_kit.utils import get_logger
 from registrable import Registrable
 
+from famma_runner.utils.cache_utils import PromptCache, prompt_digest
+from famma_runner.utils.executor_utils import DEFAULT_BACKEND, Executor
+from famma_runner.utils.manifest_utils import RunManifest, get_manifest_path
+from famma_runner.utils.pipeline_utils import stop_on_signals
+
+logger = get_logger('base_runner', 'base_runner.log')
+
 
 class Runner(Registrable):
     @staticmethod
@@ -11,79 +18,127 @@ class Runner(Registrable):
     def run(self):
         """Base run method"""
         pass
-    
+
     # @abstractmethod
     def _run_single(self, prompt: str | list[dict[str, str]]) -> list[str]:
         pass
 
-    @staticmethod
-    def run_single(combined_args) -> list[str]:
+    def _get_cached(self, key: str) -> list[str] | None:
+        """Cached outputs of a prompt key, None if missing, generated with another n or the cache is not used."""
+        cache = getattr(self, 'cache', None)
+        if cache is None or not self.args.use_cache:
+            return None
+        outputs = cache.get(key)
+        if outputs is not None and len(outputs) == self.args.n:
+            return outputs
+        return None
+
+    def run_single(self, prompt: str | list[dict[str, str]]) -> list[str]:
         """
-        Run the model for a single prompt and return the output
-        Static method to be used in multiprocessing
-        Calls the _run_single method with the combined arguments
+        Run the model for a single prompt and return the output, consulting the cache first.
+        Also run in the workers of run_batch, where the outputs go to the shared cache
+        as soon as they are generated.
         """
-        prompt: str | list[dict[str, str]]
-        cache: dict[str, str]
-        call_method: callable
-        prompt, cache, args, call_method = combined_args
-
-        if isinstance(prompt, list):
-            prompt_cache = json.dumps(prompt)
-        elif isinstance(prompt, tuple):
-            prompt_cache = prompt[0] + json.dumps(prompt[1])
-        else:
-            prompt_cache = prompt      
+        key = prompt_digest(prompt)
+        cached = self._get_cached(key)
+        if cached is not None:
+            return cached
 
-        if cache is not None and prompt_cache in cache:
-            if len(cache[prompt_cache]) == args.n:
-                return cache[prompt_cache]
-
-        result = call_method(prompt)
-        assert len(result) == args.n
+        result = self._run_single(prompt)
+        assert len(result) == self.args.n
 
+        if self.args.use_cache and getattr(self, 'cache', None) is not None:
+            self.cache.put(key, result)
         return result
 
     def run_batch(self, prompts: list[str | list[dict[str, str]]]) -> list[list[str]]:
-        from easyllm_kit.utils.multiprocess import run_tasks_in_parallel
-        outputs = []
-        arguments = [
-            (
-                prompt,
-                self.cache,  ## pass the cache as argument for cache check
-                self.args,  ## pass the args as argument for cache check
-                self._run_single,  ## pass the _run_single method as argument because of multiprocessing
-            )
-            for prompt in prompts
-        ]
-        if self.args.multiprocess > 1:
-            parallel_outputs = run_tasks_in_parallel(
-                self.run_single,
-                arguments,
-                self.args.multiprocess,
-                use_progress_bar=True,
-            )
-            for output in parallel_outputs:
-                if output.is_success():
-                    outputs.append(output.result)
+        """
+        Run the model for a batch of prompts.
+
+        The cache is a PromptCache keyed by prompt digests: hits are resolved here, and only the missing
+        prompts are sent to the workers of the executor backend (args.backend, threads by default,
+        as for the model calls of the pipelines). With the processes backend, the runner is sent once per
+        worker process and must be picklable, so the cost of a task does not grow with the cache.
+        """
+        outputs = [None] * len(prompts)
+        keys = [prompt_digest(prompt) for prompt in prompts]
+        cache = getattr(self, 'cache', None)
+        if cache is not None and self.args.use_cache:
+            cached = cache.get_many(keys)
+            for i, key in enumerate(keys):
+                if len(cached.get(key) or []) == self.args.n:
+                    outputs[i] = cached[key]
+
+        # Identical prompts of the batch are only run once
+        pending = {}
+        for i, key in enumerate(keys):
+            if outputs[i] is None:
+                pending.setdefault(key, []).append(i)
+        pending_keys = list(pending)
+
+        if self.args.multiprocess > 1 and len(pending) > 1:
+            executor = Executor.build(getattr(self.args, 'backend', None) or DEFAULT_BACKEND,
+                                      max_workers=min(self.args.multiprocess, len(pending)), use_progress_bar=True)
+            for outcome in executor.map(self.run_single, [prompts[pending[key][0]] for key in pending_keys]):
+                if outcome.is_success():
+                    result = outcome.result
                 else:
                     print("Failed to run the model for some prompts")
-                    print(output.status)
-                    print(output.exception_tb)
-                    outputs.extend([""] * self.args.n)
+                    print(outcome.traceback)
+                    result = [""] * self.args.n
+                for i in pending[pending_keys[outcome.index]]:
+                    outputs[i] = result
         else:
-            outputs = [self.run_single(argument) for argument in arguments]
-
-        if self.args.use_cache:
-            for prompt, output in zip(prompts, outputs):
-                if isinstance(prompt, list):
-                    prompt_cache = json.dumps(prompt)
-                elif isinstance(prompt, tuple):
-                    prompt_cache = prompt[0] + json.dumps(prompt[1])
-                else:
-                    prompt_cache = prompt
-                self.cache[prompt_cache] = output  ## save the output to cache
+            for key in pending_keys:
+                result = self.run_single(prompts[pending[key][0]])
+                for i in pending[key]:
+                    outputs[i] = result
 
         return outputs
-    
-    
\ No newline at end of file
+
+    def setup_cache(self, path: str):
+        """Open the prompt cache of the runner, shared by the worker processes of run_batch."""
+        self.cache = PromptCache(path)
+        return self.cache
+
+    def setup_manifest(self, config, target_db_name: str, keys, is_stored=None):
+        """
+        Open the run manifest from the `manifest` section of the config, None if it is disabled.
+
+        Without manifest.resume (--resume of the scripts), a new manifest is started with the tasks of the run
+        as pending and those already in the result store (checked with is_stored, a callable of a key) as done.
+        With it, the manifest of the previous run is continued, so that its done tasks are skipped
+        and is_stored is never called.
+        """
+        manifest_config = dict(config.get('manifest') or {})
+        if not manifest_config.get('enabled', True):
+            return None
+        path = manifest_config.get('path') or get_manifest_path(target_db_name)
+        manifest = RunManifest(path, resume=bool(manifest_config.get('resume', False)))
+        if not manifest.resumed and is_stored is not None:
+            manifest.done_many([key for key in keys if is_stored(key)])
+        manifest.register(keys)
+        return manifest
+
+    @property
+    def resumed(self) -> bool:
+        """True if the run continues the manifest of a previous run."""
+        manifest = getattr(self, 'manifest', None)
+        return manifest is not None and manifest.resumed
+
+    def close_manifest(self):
+        """
+        Compact and close the run manifest. Called by the runner once everything that reports to it is done,
+        e.g. after the ResultWriter flushed its last batch.
+        """
+        if getattr(self, 'manifest', None) is not None:
+            self.manifest.close()
+
+    def run_pipeline(self, pipeline, tasks) -> dict:
+        """Run the tasks through the pipeline, stopping gracefully on SIGINT and SIGTERM."""
+        with stop_on_signals(pipeline):
+            stats = pipeline.run(tasks)
+        if pipeline.stopped:
+            logger.warning(f"Run stopped early, {stats['cancelled']} tasks were not processed, "
+                           f"continue it with --resume")
+        return stats
@@ -1,14 +1,21 @@
-from easyllm_kit.utils.io_utils import initialize_database, write_to_database
-from easyllm_kit.utils import get_logger, read_json
+import threading
+
+from easyllm_kit.utils.io_utils import initialize_database
+from easyllm_kit.utils import get_logger
 from easyllm_kit.models import LLM
 from easyllm_kit.configs.llm_base_config import GenerationArguments
-import pandas as pd
-import omegaconf
 from famma_runner.runners.base_runner import Runner
 from famma_runner.utils import generate_response_from_llm, parse_reasoning_response
-from famma_runner.utils import LANGUAGE_ORDER, DC, order_by_language
+from famma_runner.utils import DC, ResultWriter
 from famma_runner.utils.prompt_utils import ReasoningDistillationPrompt
-import concurrent.futures
+from famma_runner.utils.eval_utils import judge_answer_locally
+from famma_runner.utils.compress_utils import TraceCompressor, get_store_path
+from famma_runner.utils.token_utils import load_encoding, count_text_tokens
+from famma_runner.utils.telemetry_utils import setup_telemetry
+from famma_runner.utils.executor_utils import Executor
+from famma_runner.utils.manifest_utils import DONE
+from famma_runner.utils.pipeline_utils import Pipeline, Stage, filter_dataset_by_question_id, get_pipeline_config, \
+    iter_main_question_groups, load_release_df
 
 logger = get_logger('distillation_runner', 'distillation_runner.log')
 
@@ -26,95 +33,54 @@ class DistillationRunner(Runner):
 
         self.dataset_df = self.setup_dataset()
 
-        self.num_workers = self.data_config.get('num_workers', 1)
+        # Best-of-n sampling: up to num_samples traces per sub-question, checked against the gold answer,
+        # until num_correct_required of them are correct. Runs sample_workers requests per sub-question at once.
+        sampling_config = config.get('rejection_sampling') or {}
+        self.num_samples = max(1, int(sampling_config.get('num_samples', 1)))
+        self.num_correct_required = max(1, int(sampling_config.get('num_correct_required', 1)))
+        self.sample_workers = max(1, int(sampling_config.get('sample_workers', self.num_samples)))
+        self.tokenizer_name = sampling_config.get('tokenizer_name', 'cl100k_base')
+        # Loaded once: a tokenizer that cannot be loaded offline is not retried on every sample
+        self.encoding = load_encoding(self.tokenizer_name)
 
         # filter the dataset by main_question_id
         # for each question_id, we need to find out its main_question_id and language
         # then filter the dataset by main_question_id and language
-        self.dataset_df, self.filtered_main_question_ids = self.filter_dataset_by_question_id(self.dataset_df,
-                                                                                              self.data_config.question_id)
+        self.dataset_df, self.filtered_main_question_ids = filter_dataset_by_question_id(self.dataset_df,
+                                                                                         self.data_config.question_id)
 
         # Initialize the DDB
         release_version = self.data_config.data_dir.split('/')[-1].split('.')[0]
         self.target_db_name = f'{self.llm_name}_distill_{release_version}'
         self.target_db = initialize_database(output_db=self.target_db_name)
-
-    def filter_dataset_by_question_id(self, dataset_df, question_ids):
-        """
-        Filter dataset by specific question_ids.
-
-        Args:
-            dataset_df: The dataset DataFrame to filter
-            question_ids: A single question_id or list of question_ids in format
-                         {language}_{main_question_id}_{sub_question_id}_{version}
-
-        Returns:
-            Filtered DataFrame containing only rows matching the main_question_ids and languages
-        """
-        filtered_main_question_ids = None
-        if not question_ids:
-            return dataset_df, filtered_main_question_ids
-
-        # Convert single question_id to list for consistent processing
-        if not isinstance(question_ids, omegaconf.ListConfig):
-            question_ids = [question_ids]
-
-        if len(question_ids) == 0:
-            return dataset_df, filtered_main_question_ids
-
-        # Create empty DataFrame to collect all filtered results
-        filtered_results = pd.DataFrame()
-
-        # Track unique language-main_question_id pairs to avoid duplicate processing
-        processed_pairs = set()
-
-        for question_id in question_ids:
-            try:
-                # Parse the question_id to extract components
-                parts = question_id.split('_')
-                if len(parts) >= 3:  # Ensure we have at least language, main_question_id, and sub_question_id
-                    language = parts[0]
-                    main_question_id = int(parts[1])
-
-                    # Create a unique identifier for this language-main_question_id pair
-                    pair_key = f"{language}_{main_question_id}"
-
-                    # Skip if we've already processed this pair
-                    if pair_key in processed_pairs:
-                        # logger.info(f"Skipping duplicate filter for {pair_key}")
-                        continue
-
-                    processed_pairs.add(pair_key)
-
-                    logger.info(f"Filtering dataset for language: {language}, main_question_id: {main_question_id}")
-
-                    # Filter the dataset by both main_question_id and language
-                    current_filtered = dataset_df[
-                        (dataset_df[DC.MAIN_QUESTION_ID] == main_question_id) &
-                        (dataset_df[DC.LANGUAGE] == language)
-                        ]
-
-                    if current_filtered.empty:
-                        logger.warning(f"No matching questions found for {question_id}")
-                    else:
-                        logger.info(f"Found {len(current_filtered)} questions matching {question_id}")
-                        # Append to our results
-                        filtered_results = pd.concat([filtered_results, current_filtered])
-                else:
-                    logger.warning(f"Invalid question_id format: {question_id}")
-            except Exception as e:
-                logger.error(f"Error parsing question_id {question_id}: {str(e)}")
-
-        # If we didn't find any matches, return the original dataset
-        if filtered_results.empty:
-            logger.warning("No matching questions found for any of the provided question_ids")
-            return dataset_df
-
-        logger.info(f"Total of {len(filtered_results)} questions matched across all filters")
-
-        # Extract unique main_question_ids from filtered results
-        filtered_main_question_ids = filtered_results[DC.MAIN_QUESTION_ID].unique().tolist()
-        return filtered_results, filtered_main_question_ids
+        # State of every sub-question of the run, --resume continues from it
+        keys = self.dataset_df[DC.QUESTION_ID].tolist()
+        self.manifest = self.setup_manifest(config, self.target_db_name, keys,
+                                            is_stored=self.target_db.__contains__)
+        # Single writer for all worker threads, its key set backs the skip check.
+        # Sub-questions are only done in the manifest once the writer stored them
+        self.writer = ResultWriter(self.target_db_name,
+                                   existing_keys=self.manifest.keys(DONE) if self.manifest else self.target_db.keys(),
+                                   transform=self.setup_compressor(),
+                                   on_written=self.manifest.done_many if self.manifest else None)
+
+        # Per-call latency and token events, see the telemetry section of the config
+        self.telemetry = setup_telemetry(config, 'distillation', self.llm_name)
+
+        # Workers of the pipeline stages, the model calls run on the backend of the execution section
+        self.pipeline_config = get_pipeline_config(config)
+        self.pipeline = None
+        # Sampling executor of each call worker, reused for all the sub-questions of the worker
+        self._samplers = threading.local()
+        self._sampler_executors = []
+        self._sampler_lock = threading.Lock()
+
+    def setup_compressor(self):
+        """Compress the traces written to the store with zstd dictionaries per language if data.compress_traces is set."""
+        if not self.data_config.get('compress_traces', False):
+            return None
+        compressor = TraceCompressor.for_store(get_store_path(self.target_db_name))
+        return compressor.compress_record
 
     def setup_model(self):
         # Build the LLM model
@@ -131,122 +97,181 @@ class DistillationRunner(Runner):
         return llm
 
     def setup_dataset(self):
-        # convert dataset to DataFrame for easy processing
-        data = read_json(self.data_config.data_dir)
-        dataset_df = pd.DataFrame(data)
-        # Create a new column for sorting languages
-        order_by_language(dataset_df, LANGUAGE_ORDER, DC.MAIN_QUESTION_ID, DC.SUB_QUESTION_ID, DC.LANGUAGE)
-
-        return dataset_df
-
-    def generate_answer_for_one_main_question(self, sub_question_set_df):
-        """Generate model answer and explanation for each sub-question independently."""
-        model_responses = {}
-        sub_question_set_df.sort_values(by=DC.SUB_QUESTION_ID, inplace=True)
-        for _, row in sub_question_set_df.iterrows():
-            question_id = row['question_id']
-
-            if question_id in self.target_db:
-                logger.info(f"Skipping {question_id} because it already exists in the database")
-                continue
-
-            logger.info(f'start generating answers for {question_id}')
-
+        # data_dir can be either the release json or a packed release snapshot
+        return load_release_df(self.data_config.data_dir)
+
+    @staticmethod
+    def build_question_dict(row):
+        """Structure a sub-question as it is put into the distillation prompt."""
+        question_dict = {
+            "type": row['question_type'],
+            "question": row['question']
+        }
+
+        if row['question_type'] == 'multiple-choice':
+            question_dict["options"] = row['options']
+        return question_dict
+
+    def iter_tasks(self):
+        """
+        Yield a task per sub-question, in dataset order, claiming it on the writer so that it is not
+        processed twice. Stops if the writer failed, results could not be stored anymore.
+        """
+        for _, _, group in iter_main_question_groups(self.dataset_df):
+            group = group.sort_values(by=DC.SUB_QUESTION_ID)
             # Get the context from the first sub_question in the group
-            context = sub_question_set_df.iloc[0].get("context", "")
-            question = row['question']
-
-            # Create question dictionary for the prompt
-            question_dict = {
-                "type": row['question_type'],
-                "question": question
-            }
-
-            if row['question_type'] == 'multiple-choice':
-                question_dict["options"] = row['options']
-
-            # Generate response for each sub-question independently
-            prompt = ReasoningDistillationPrompt.init().format(
-                context=context,
-                question=question_dict
-            )
-
-            model_output = generate_response_from_llm(
-                self.llm,
-                prompt
-            )
-
-            # Parse response for this specific question
-            question_response = parse_reasoning_response(model_output)
-            # attach the input k, v to the response
-            input_data = row.to_dict()
-            for key, value in input_data.items():
-                if key not in question_response:
-                    question_response[key] = value
-
-            # Write the aggregated subquestion responses to the database
-            write_to_database(self.target_db_name, question_id, question_response)
-
-        return model_responses
-
-    def process_dataset_parallel(self, num_workers: int = 4) -> None:
+            context = group.iloc[0].get("context", "")
+            for _, row in group.iterrows():
+                if self.writer.failed:
+                    return
+                question_id = row['question_id']
+                if not self.writer.claim(question_id):
+                    logger.info(f"Skipping {question_id} because it already exists in the database")
+                    continue
+                yield {'key': question_id, 'row': row, 'context': context}
+
+    def render(self, task):
+        # Generate response for each sub-question independently
+        task['prompt'] = ReasoningDistillationPrompt.init().format(
+            context=task['context'],
+            question=self.build_question_dict(task['row'])
+        )
+        return task
+
+    def call(self, task):
+        logger.info(f"start generating answers for {task['key']}")
+        task['response'] = self.sample_answers(task['prompt'], task['row'])
+        return task
+
+    def parse(self, task):
+        # attach the input k, v to the response
+        question_response = task['response']
+        for key, value in task['row'].to_dict().items():
+            if key not in question_response:
+                question_response[key] = value
+        return task
+
+    def persist(self, task):
+        # Queue the response, the writer thread stores it in the database
+        self.writer.put(task['key'], task['response'])
+        return task
+
+    def on_task_error(self, stage, task, error):
+        """Give the claim of a failed sub-question back, and stop if its result could not be stored."""
+        self.writer.release(task['key'])
+        if self.writer.failed:
+            self.pipeline.stop()
+
+    def build_pipeline(self):
+        return Pipeline('distillation', [
+            Stage('render', self.render, self.pipeline_config['render_workers'], drain=False),
+            # Each call samples up to num_samples responses with sample_workers threads of its own
+            Stage('call', self.call, self.pipeline_config['call_workers'], drain=False,
+                  backend=self.pipeline_config['call_backend'], dispatch=True),
+            Stage('parse', self.parse, self.pipeline_config['parse_workers']),
+            Stage('persist', self.persist),
+        ], queue_size=self.pipeline_config['queue_size'], on_error=self.on_task_error,
+            on_cancel=lambda task: self.writer.release(task['key']), manifest=self.manifest, mark_done=False)
+
+    @staticmethod
+    def _response_text(model_output):
+        if isinstance(model_output, dict):
+            return f"{model_output.get('reasoning_content', '') or ''}{model_output.get('content', '') or ''}"
+        return str(model_output)
+
+    def sample_answers(self, prompt, row):
         """
-        Process the dataset in parallel using multiple threads.
+        Sample up to num_samples responses in parallel and check each against the gold answer with the
+        local judge rules. Sampling stops once num_correct_required responses are correct: samples that
+        have not started are cancelled and those still running are ignored.
 
-        Args:
-            num_workers: Number of workers to use
+        Returns:
+            The first correct response (the first response if none is correct), with the sampling statistics
         """
+        gold_answer = row.get(DC.ANSWER)
+        question_type = row.get(DC.QUESTION_TYPE)
+
+        samples, accepted = [], []
+        num_failed = 0
+        completion_tokens = 0
+
+        def sample(attempt):
+            telemetry = self.telemetry.bind(key=row['question_id'], attempt=attempt, language=row.get(DC.LANGUAGE),
+                                            difficulty=row.get(DC.TOPIC_DIFFICULTY)) if self.telemetry else None
+            return generate_response_from_llm(self.llm, prompt, telemetry=telemetry)
+
+        outcomes = self.get_sampler().map(sample, range(self.num_samples))
         try:
-            dataset_df = self.dataset_df.copy()
-            groups = list(dataset_df.groupby(['language_order', DC.LANGUAGE, DC.MAIN_QUESTION_ID]))
-            total_groups = len(groups)
-
-            logger.info(f"Starting parallel processing with {num_workers} workers for {total_groups} groups")
-
-            # Clear memory
-            del dataset_df
-
-            completed_groups = 0
-            active_threads = 0
-
-            # Always use ThreadPoolExecutor for API calls
-            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-                futures = []
-                # Submit tasks
-                for idx, group in enumerate(groups):
-                    lang, main_id = group[0][1], group[0][2]  # Get language and main_question_id
-                    logger.info(f"Submitting group {idx + 1}/{total_groups} (lang: {lang}, main_id: {main_id})")
-                    future = executor.submit(self.generate_answer_for_one_main_question, group[1])
-                    futures.append(future)
-                    active_threads += 1
-                    logger.info(f"Active threads: {active_threads}/{num_workers}")
-
-                # Wait for completion and handle errors
-                for future in concurrent.futures.as_completed(futures):
-                    try:
-                        future.result()
-                        completed_groups += 1
-                        active_threads -= 1
-                        logger.info(
-                            f"Completed {completed_groups}/{total_groups} groups. Active threads: {active_threads}")
-                    except Exception as e:
-                        logger.error(f"Error in parallel processing: {str(e)}")
-                        active_threads -= 1
-
-            logger.info(
-                f"Parallel processing complete. Successfully processed {completed_groups}/{total_groups} groups")
-
-        except Exception as e:
-            logger.error(f"Error in parallel processing setup: {str(e)}")
-            raise
+            for outcome in outcomes:
+                if not outcome.is_success():
+                    num_failed += 1
+                    logger.warning(f"Sample for {row['question_id']} failed: {str(outcome.error)}")
+                    continue
+
+                # Parse response for this specific question
+                model_output = outcome.result
+                sample_response = parse_reasoning_response(model_output)
+                sample_response['is_correct_by_rules'] = judge_answer_locally(sample_response['model_answer'],
+                                                                              gold_answer, question_type)
+                completion_tokens += count_text_tokens(self._response_text(model_output), self.encoding)
+                samples.append(sample_response)
+                if sample_response['is_correct_by_rules']:
+                    accepted.append(sample_response)
+                    if len(accepted) >= self.num_correct_required:
+                        break
+        finally:
+            # Samples that have not started are not submitted, those still running are ignored
+            outcomes.close()
+
+        if not samples:
+            raise RuntimeError(f"All {num_failed} samples for {row['question_id']} failed")
+
+        prompt_tokens = count_text_tokens(prompt, self.encoding)
+        question_response = dict(accepted[0] if accepted else samples[0])
+        question_response.update({
+            'num_attempts': len(samples) + num_failed,
+            'num_correct': len(accepted),
+            'acceptance_rate': len(accepted) / len(samples),
+            # Tokens of the samples that completed, samples cancelled while running are not counted
+            'prompt_tokens': prompt_tokens * len(samples),
+            'completion_tokens': completion_tokens,
+            'tokens_spent': prompt_tokens * len(samples) + completion_tokens,
+        })
+        if self.num_correct_required > 1:
+            question_response['accepted_samples'] = accepted
+        logger.info(f"{row['question_id']}: {len(accepted)} correct out of {len(samples)} samples")
+        return question_response
+
+    def get_sampler(self) -> Executor:
+        """Executor of the samples of the calling worker, on the same backend as the calls of the pipeline."""
+        executor = getattr(self._samplers, 'executor', None)
+        if executor is None:
+            executor = Executor.build(self.pipeline_config['call_backend'],
+                                      max_workers=min(self.sample_workers, self.num_samples))
+            # Kept running across the sub-questions until close_samplers
+            executor.__enter__()
+            self._samplers.executor = executor
+            with self._sampler_lock:
+                self._sampler_executors.append(executor)
+        return executor
+
+    def close_samplers(self):
+        with self._sampler_lock:
+            executors, self._sampler_executors = self._sampler_executors, []
+        for executor in executors:
+            executor.close()
+        self._samplers = threading.local()
 
     def run(self):
-        if self.num_workers > 1:
-            self.process_dataset_parallel(self.num_workers)
-        else:
-            for (_, _, _), group in self.dataset_df.groupby(
-                    ['language_order', DC.LANGUAGE, DC.MAIN_QUESTION_ID]):
-                self.generate_answer_for_one_main_question(group)
+        self.pipeline = self.build_pipeline()
+        # The writer marks the sub-questions done in the manifest as it stores them,
+        # so the manifest is only closed once the writer flushed its last batch
+        try:
+            with self.writer:
+                self.run_pipeline(self.pipeline, self.iter_tasks())
+        finally:
+            self.close_samplers()
+            self.close_manifest()
 
         logger.info('Generation complete')
         logger.info('Result saved to %s in json format', self.target_db_name)
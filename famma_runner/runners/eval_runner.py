@@ -6,6 +6,10 @@ import pandas as pd
 
 from famma_runner.runners.base_runner import Runner
 from famma_runner.utils import generate_response_from_llm, DC, LANGUAGE_ORDER, order_by_language, JudgePrompt
+from famma_runner.utils.pipeline_utils import Pipeline, Stage, get_pipeline_config, iter_main_question_groups, \
+    load_release_df
+from famma_runner.utils.eval_utils import StreamingAccuracy
+from famma_runner.utils.telemetry_utils import setup_telemetry
 
 logger = get_logger('eval_runner', 'eval_runner.log')
 
@@ -30,6 +34,42 @@ class EvaluationRunner(Runner):
         # Form the target database name using the extracted names
         self.target_db_name = f'{model_name}_evaluated_by_{judger_name}'
         self.target_db = initialize_database(output_db=self.target_db_name)
+        # State of every sub-question of the run, --resume continues from it
+        keys = self.gold_df[DC.QUESTION_ID].tolist()
+        self.manifest = self.setup_manifest(config, self.target_db_name, keys,
+                                            is_stored=self.target_db.__contains__)
+
+        # Running accuracy published while judging, see setup_monitor
+        self.monitor_config = dict(config.get('monitor') or {})
+        self.tracker = self.setup_monitor()
+
+        # Per-call latency and token events of the judge, see the telemetry section of the config
+        self.telemetry = setup_telemetry(config, 'evaluation', self.model_config.get('model_full_name', self.llm_name))
+
+        # Workers of the pipeline stages, see the pipeline section of the config
+        self.pipeline_config = get_pipeline_config(config)
+        self.pipeline = None
+        self.aborted = False
+
+    def setup_monitor(self):
+        """Track the accuracy of the judged questions, starting from those already in the target database."""
+        tracker = StreamingAccuracy(total_questions=len(self.gold_df))
+        for record in self.target_db.values():
+            tracker.update(record)
+        self.live_db_name = self.monitor_config.get('live_db_name', f'{self.target_db_name}_live')
+        return tracker
+
+    def publish_snapshot(self):
+        snapshot = self.tracker.snapshot()
+        write_to_database(self.live_db_name, 'snapshot', snapshot)
+        overall_acc = snapshot['metrics']['consolidated']['overall_acc']
+        logger.info(f"Judged {snapshot['num_records']}/{snapshot['total_questions']} questions, "
+                    f"running accuracy {overall_acc:.2%}")
+
+    def should_abort(self):
+        """Stop judging if the running accuracy is below monitor.abort_below_acc after monitor.abort_after_progress."""
+        return self.tracker.is_below(self.monitor_config.get('abort_below_acc'),
+                                     self.monitor_config.get('abort_after_progress', 0.05))
 
     def setup_model(self):
         # Build the LLM model
@@ -58,62 +98,109 @@ class EvaluationRunner(Runner):
         if self.data_config.gold_dir is None or self.data_config.gold_dir == self.data_config.data_dir:
             gold_df = answers_df.copy()
         else:
-            gold_json = read_json(self.data_config.gold_dir)
-            gold_df = pd.DataFrame(gold_json)
-            order_by_language(gold_df, LANGUAGE_ORDER, DC.MAIN_QUESTION_ID, DC.SUB_QUESTION_ID, DC.LANGUAGE)
+            # gold_dir can be either the release json or a packed release snapshot
+            gold_df = load_release_df(self.data_config.gold_dir)
 
         return answers_df, gold_df
 
     def get_gold_answer(self, question_id):
         return self.gold_df[self.gold_df[DC.QUESTION_ID] == question_id][DC.ANSWER].values[0]
 
-    def run(self):
-        # We use gold_df to judge the answers   
-        gold_df = self.gold_df.copy()
-        for _, group in gold_df.groupby(['language_order', DC.LANGUAGE, DC.MAIN_QUESTION_ID]):
+    def iter_tasks(self):
+        """Yield a task per sub-question of the gold dataset that is not judged yet."""
+        for _, _, group in iter_main_question_groups(self.gold_df):
             for idx in range(len(group)):
                 row = group.iloc[idx]
                 key = row['question_id']
-
-                if key in self.target_db:
+                if self.manifest.is_done(key) if self.manifest is not None else key in self.target_db:
                     continue
+                yield {'key': key, 'row': row}
+
+    def render(self, task):
+        """Attach the student's answer to the gold row, the call is skipped if the student has no answer."""
+        key = task['key']
+        student_row = self.answers_df[self.answers_df[DC.QUESTION_ID] == key]
+
+        # Ensure student_row is not empty and make a copy of the row
+        data_to_save = task['row'].to_dict()
+        if not student_row.empty:
+            student_row = student_row.iloc[0].copy()
+            data_to_save['model_answer'] = student_row['model_answer']
+            data_to_save['model_explanation'] = student_row['model_explanation']
+            task['prompt'] = JudgePrompt.init().format(question=self.build_judge_question(data_to_save))
+        else:
+            logger.warning(f'No student row found for question_id: {key}, set is_correct_by_model to False')
+            data_to_save['model_answer'] = None
+            data_to_save['model_explanation'] = None
+            data_to_save['is_correct_by_model'] = False
+        task['record'] = data_to_save
+        return task
+
+    def call(self, task):
+        if 'prompt' not in task:
+            return task
+        logger.info(f"start judging answers for {task['key']}")
+        record = task['record']
+        telemetry = self.telemetry.bind(key=task['key'], attempt=0, language=record.get(DC.LANGUAGE),
+                                        difficulty=record.get(DC.TOPIC_DIFFICULTY)) if self.telemetry else None
+        task['model_output'] = generate_response_from_llm(self.llm, task['prompt'], telemetry=telemetry)
+        return task
+
+    def parse(self, task):
+        if 'model_output' in task:
+            judge_response = extract_json_from_text(task['model_output'])
+            task['record']['is_correct_by_model'] = judge_response[task['key']]
+        # Ensure all values in data_to_save are JSON serializable
+        task['record'] = convert_to_dict(task['record'])
+        return task
+
+    def persist(self, task):
+        write_to_database(self.target_db_name, task['key'], task['record'])
+
+        self.tracker.update(task['record'])
+        if self.tracker.num_records % self.monitor_config.get('snapshot_every', 20) == 0:
+            self.publish_snapshot()
+        if not self.aborted and self.should_abort():
+            self.aborted = True
+            logger.error(f"Running accuracy is below {self.monitor_config['abort_below_acc']} after "
+                         f"{self.tracker.num_records} questions, stop judging")
+            self.pipeline.stop()
+        return task
+
+    def build_pipeline(self):
+        return Pipeline('evaluation', [
+            Stage('render', self.render, self.pipeline_config['render_workers'], drain=False),
+            Stage('call', self.call, self.pipeline_config['call_workers'], drain=False,
+                  backend=self.pipeline_config['call_backend'], dispatch=True),
+            Stage('parse', self.parse, self.pipeline_config['parse_workers']),
+            # A single writer, which also keeps the tracker updates in one thread
+            Stage('persist', self.persist),
+        ], queue_size=self.pipeline_config['queue_size'], manifest=self.manifest)
 
-                logger.info(f'start judging answers for {key}')
-
-                student_row = self.answers_df[self.answers_df[DC.QUESTION_ID] == key]
-
-                # Ensure student_row is not empty and make a copy of the row
-                data_to_save = row.to_dict()
-                if not student_row.empty:
-                    student_row = student_row.iloc[0].copy()
-
-                    data_to_save['model_answer'] = student_row['model_answer']
-                    data_to_save['model_explanation'] = student_row['model_explanation']
-
-                    judge_response = self.judge_answer_for_one_subquestion(data_to_save)
-
-                    # Convert the row to a dictionary and add 'is_correct_by_model'
-                    data_to_save['is_correct_by_model'] = judge_response[key]
-                else:
-                    logger.warning(f'No student row found for question_id: {key}, set is_correct_by_model to False')
-                    data_to_save['model_answer'] = None
-                    data_to_save['model_explanation'] = None
-                    data_to_save['is_correct_by_model'] = False
-
-                # Ensure all values in data_to_save are JSON serializable
-                data_to_save = convert_to_dict(data_to_save)
-
-                write_to_database(self.target_db_name, key, data_to_save)
+    def run(self):
+        # We use gold_df to judge the answers
+        self.aborted = False
+        self.pipeline = self.build_pipeline()
+        try:
+            self.run_pipeline(self.pipeline, self.iter_tasks())
+        finally:
+            self.close_manifest()
+
+        self.publish_snapshot()
+        if self.aborted:
+            return
 
         # Save the DataFrame to a file or database as needed
-        gold_df.to_csv('output_samples.csv', index=False)
+        self.gold_df.to_csv('output_samples.csv', index=False)
 
         logger.info('Judging complete')
         logger.info('Result saved to %s in json format', self.target_db_name)
         logger.info('Result saved to %s in csv format', 'output_samples.csv')
 
-    def judge_answer_for_one_subquestion(self, gold_row):
-        question = {
+    @staticmethod
+    def build_judge_question(gold_row):
+        """Structure a sub-question with the student's answer as it is put into the judge prompt."""
+        return {
             'question_id': gold_row[DC.QUESTION_ID],
             'context': gold_row[DC.CONTEXT],
             'question_type': gold_row[DC.QUESTION_TYPE],
@@ -124,11 +211,3 @@ class EvaluationRunner(Runner):
             'student_explanation': gold_row['model_explanation'],  # attach the model_explanation to the question
             'ground_truth': gold_row[DC.ANSWER]
         }
-        prompt = JudgePrompt.init().format(
-            question=question
-        )
-
-        model_response = generate_response_from_llm(self.llm, prompt)
-        model_response = extract_json_from_text(model_response)
-
-        return model_response
@@ -1,13 +1,16 @@
 from easyllm_kit.utils.io_utils import initialize_database, write_to_database
-from easyllm_kit.utils import get_logger, read_json
+from easyllm_kit.utils import get_logger
 from easyllm_kit.models import LLM
 from easyllm_kit.configs.llm_base_config import GenerationArguments
-import pandas as pd
-import os
-import omegaconf
+import threading
 from famma_runner.runners.base_runner import Runner
-from famma_runner.utils import collect_images_from_first_subquestion, generate_response_from_llm, safe_parse_response
-from famma_runner.utils import QuestionPrompt, LANGUAGE_ORDER, DC, order_by_language, ProgramOfThoughtsQuestionPrompt
+from famma_runner.utils import collect_images_from_first_subquestion, generate_response_from_llm, safe_parse_response, \
+    find_unanswered_questions
+from famma_runner.utils import QuestionPrompt, DC, ProgramOfThoughtsQuestionPrompt, get_release_image_source
+from famma_runner.utils.pipeline_utils import Pipeline, Stage, filter_dataset_by_question_id, get_pipeline_config, \
+    iter_main_question_groups, load_release_df
+from famma_runner.utils.telemetry_utils import setup_telemetry
+from famma_runner.utils.ocr_utils import OCRCache, build_ocr_model, get_ocr_language, resolve_ocr_cache_path
 
 logger = get_logger('generation_runner', 'generation_runner.log')
 
@@ -28,98 +31,49 @@ class GenerationRunner(Runner):
         # filter the dataset by main_question_id
         # for each question_id, we need to find out its main_question_id and language
         # then filter the dataset by main_question_id and language  
-        self.dataset_df, self.filtered_main_question_ids = self.filter_dataset_by_question_id(self.dataset_df, self.data_config.question_id)
+        self.dataset_df, self.filtered_main_question_ids = filter_dataset_by_question_id(self.dataset_df,
+                                                                                         self.data_config.question_id)
 
         # Initialize the DDB
         release_version = self.data_config.data_dir.split('/')[-1].split('.')[0]
         self.target_db_name = f'{self.llm_name}_ans_{release_version}'
         self.target_db = initialize_database(output_db=self.target_db_name)
+        # State of every main question of the run, --resume continues from it
+        keys = [f'{language}_{main_question_id}' for language, main_question_id in
+                self.dataset_df[[DC.LANGUAGE, DC.MAIN_QUESTION_ID]].drop_duplicates().itertuples(index=False)]
+        self.manifest = self.setup_manifest(config, self.target_db_name, keys,
+                                            is_stored=self.is_stored)
 
         self.use_pot = self.model_config.get('use_pot', False)
         self.is_reasoning_model = self.model_config.get('is_reasoning_model', False)
-        self.ocr_model = None
         self.use_ocr = self.model_config.get('use_ocr', False)
-        if self.use_ocr:
-            # ref: https://paddlepaddle.github.io/PaddleOCR/main/en/ppocr/quick_start.html#11-install-paddlepaddle
-            from paddleocr import PaddleOCR
-            self.ocr_model = PaddleOCR(use_angle_cls=True)
-
-    def filter_dataset_by_question_id(self, dataset_df, question_ids):
-        """
-        Filter dataset by specific question_ids.
-        
-        Args:
-            dataset_df: The dataset DataFrame to filter
-            question_ids: A single question_id or list of question_ids in format 
-                         {language}_{main_question_id}_{sub_question_id}_{version}
-            
-        Returns:
-            Filtered DataFrame containing only rows matching the main_question_ids and languages
-        """
-        filtered_main_question_ids = None
-        if not question_ids:
-            return dataset_df, filtered_main_question_ids
-        
-        # Convert single question_id to list for consistent processing
-        if not isinstance(question_ids, omegaconf.ListConfig):
-            question_ids = [question_ids]
-        
-        if len(question_ids) == 0:
-            return dataset_df, filtered_main_question_ids
-        
-        # Create empty DataFrame to collect all filtered results
-        filtered_results = pd.DataFrame()
-        
-        # Track unique language-main_question_id pairs to avoid duplicate processing
-        processed_pairs = set()
-        
-        for question_id in question_ids:
-            try:
-                # Parse the question_id to extract components
-                parts = question_id.split('_')
-                if len(parts) >= 3:  # Ensure we have at least language, main_question_id, and sub_question_id
-                    language = parts[0]
-                    main_question_id = int(parts[1])
-                    
-                    # Create a unique identifier for this language-main_question_id pair
-                    pair_key = f"{language}_{main_question_id}"
-                    
-                    # Skip if we've already processed this pair
-                    if pair_key in processed_pairs:
-                        # logger.info(f"Skipping duplicate filter for {pair_key}")
-                        continue
-                    
-                    processed_pairs.add(pair_key)
-                    
-                    logger.info(f"Filtering dataset for language: {language}, main_question_id: {main_question_id}")
-                    
-                    # Filter the dataset by both main_question_id and language
-                    current_filtered = dataset_df[
-                        (dataset_df[DC.MAIN_QUESTION_ID] == main_question_id) & 
-                        (dataset_df[DC.LANGUAGE] == language)
-                    ]
-                    
-                    if current_filtered.empty:
-                        logger.warning(f"No matching questions found for {question_id}")
-                    else:
-                        logger.info(f"Found {len(current_filtered)} questions matching {question_id}")
-                        # Append to our results
-                        filtered_results = pd.concat([filtered_results, current_filtered])
-                else:
-                    logger.warning(f"Invalid question_id format: {question_id}")
-            except Exception as e:
-                logger.error(f"Error parsing question_id {question_id}: {str(e)}")
-        
-        # If we didn't find any matches, return the original dataset
-        if filtered_results.empty:
-            logger.warning("No matching questions found for any of the provided question_ids")
-            return dataset_df
-
-        logger.info(f"Total of {len(filtered_results)} questions matched across all filters")
-        
-        # Extract unique main_question_ids from filtered results
-        filtered_main_question_ids = filtered_results[DC.MAIN_QUESTION_ID].unique().tolist()
-        return filtered_results, filtered_main_question_ids
+        # ref: https://paddlepaddle.github.io/PaddleOCR/main/en/ppocr/quick_start.html#11-install-paddlepaddle
+        # 'auto' picks the OCR language of each question like misc_scripts/ocr_and_merge.py,
+        # so that both share the entries of the OCR cache
+        self.ocr_lang = self.model_config.get('ocr_lang', 'auto')
+        # OCR results shared across runs and models, keyed by image content, set ocr_cache to null to disable
+        self.ocr_cache_path = resolve_ocr_cache_path(self.model_config.get('ocr_cache', 'default'))
+        self._ocr_models = {}
+        self._ocr_caches = {}
+        self._ocr_lock = threading.Lock()
+
+        # Per-call latency and token events, see the telemetry section of the config
+        self.telemetry = setup_telemetry(config, 'generation', self.llm_name)
+
+        # Workers of the pipeline stages, see the pipeline section of the config
+        self.pipeline_config = get_pipeline_config(config)
+
+        # Follow-up requests for the sub-questions left without an answer, see the repair section of the config
+        self.max_repair_attempts = max(0, int((config.get('repair') or {}).get('max_attempts', 1)))
+
+    def get_ocr(self, language):
+        """OCR model and OCR cache of a dataset language, created the first time they are needed."""
+        lang = get_ocr_language(language) if self.ocr_lang == 'auto' else self.ocr_lang
+        with self._ocr_lock:
+            if lang not in self._ocr_models:
+                self._ocr_models[lang] = build_ocr_model(lang)
+                self._ocr_caches[lang] = OCRCache(self.ocr_cache_path, lang=lang) if self.ocr_cache_path else None
+        return self._ocr_models[lang], self._ocr_caches[lang]
 
     def setup_model(self):
         # Build the LLM model
@@ -134,30 +88,13 @@ class GenerationRunner(Runner):
         return llm
 
     def setup_dataset(self):
-        # convert dataset to DataFrame for easy processing
-        data = read_json(self.data_config.data_dir)
-        dataset_df = pd.DataFrame(data)
-        # Create a new column for sorting languages
-        order_by_language(dataset_df, LANGUAGE_ORDER, DC.MAIN_QUESTION_ID, DC.SUB_QUESTION_ID, DC.LANGUAGE)
-
-        return dataset_df
-
-    def generate_answer_for_one_main_question(self, sub_question_set_df):
-        """
-        Generates model answer and explanation for a subset of questions, including both multiple-choice 
-        and open-ended types.
-        """
-        # Get the context from the first sub_question
-        context = sub_question_set_df.iloc[0].get("context", "")
-
-        # Collect images from the first sub-question
-        # parent_dir is the parent directory of the dataset - self.data_config.data_dir
-        parent_dir = os.path.dirname(self.data_config.data_dir)
-
-        images = collect_images_from_first_subquestion(sub_question_set_df, parent_dir=parent_dir)
+        # data_dir can be either the release json or a packed release snapshot
+        return load_release_df(self.data_config.data_dir)
 
+    @staticmethod
+    def build_sub_questions(sub_question_set_df):
+        """Structure the sub-questions of a main question as they are put into the prompt."""
         sub_questions = []
-        question_id_list = []
         for _, row in sub_question_set_df.iterrows():
             question_dict = {
                 "id": row['question_id'],
@@ -170,72 +107,163 @@ class GenerationRunner(Runner):
                 question_dict["options"] = row['options']
 
             sub_questions.append(question_dict)
-            question_id_list.append(row['question_id'])
+        return sub_questions
+
+    def render(self, task):
+        """Build the prompt and collect the images of a main question."""
+        sub_question_set_df = task['group']
+        # Get the context from the first sub_question, kept for the repair requests
+        task['context'] = context = sub_question_set_df.iloc[0].get("context", "")
+
+        # Collect images from the first sub-question
+        # parent_dir is the parent directory of the dataset - self.data_config.data_dir,
+        # or the packed release snapshot itself
+        parent_dir = get_release_image_source(self.data_config.data_dir)
+
+        task['images'] = collect_images_from_first_subquestion(sub_question_set_df, parent_dir=parent_dir)
+
+        sub_questions = self.build_sub_questions(sub_question_set_df)
+        task['question_id_list'] = [question_dict["id"] for question_dict in sub_questions]
+        task['prompt'] = self.format_prompt(context, sub_questions)
+        return task
+
+    def format_prompt(self, context, sub_questions):
+        """Format the prompt with the structured questions."""
+        prompt_template = ProgramOfThoughtsQuestionPrompt if self.use_pot else QuestionPrompt
+        return prompt_template.init().format(
+            context=context,
+            sub_questions=sub_questions
+        )
+
+    def generate(self, task, prompt, attempt=0):
+        """Call the model with a prompt and the images of a main question."""
+        first_row = task['group'].iloc[0]
+        telemetry = self.telemetry.bind(key=task['key'], attempt=attempt, language=task['language'],
+                                        difficulty=first_row.get(DC.TOPIC_DIFFICULTY)) if self.telemetry else None
+
+        ocr_model, ocr_cache = self.get_ocr(task['language']) if self.use_ocr else (None, None)
+        return generate_response_from_llm(self.llm, prompt, task['images'],
+                                          use_ocr=self.use_ocr, ocr_model=ocr_model,
+                                          ocr_cache=ocr_cache, telemetry=telemetry)
+
+    def call(self, task):
+        """Generate the answers of a main question with the model."""
+        logger.info(f"start generating answers for {task['language']} -- main_question_id: {task['main_question_id']}")
+        task['model_output'] = self.generate(task, task['prompt'])
+        return task
+
+    def parse(self, task):
+        """Parse the answers of the model and aggregate all sub-questions with their answers into one record."""
+        task['model_response'] = safe_parse_response(task['model_output'], task['question_id_list'])
+        task['unanswered_ids'] = find_unanswered_questions(task['model_response'], task['question_id_list'])
+        task['record'] = self.build_record(task)
+        return task
+
+    def repair(self, task):
+        """
+        Ask again for the sub-questions left without an answer, with a prompt holding only them and the same
+        context and images, up to repair.max_attempts times. The answers found are merged into the response,
+        so a main question is not generated again for a few sub-questions the model skipped or that did not parse.
+        """
+        attempt = 0
+        while task['unanswered_ids'] and attempt < self.max_repair_attempts:
+            attempt += 1
+            unanswered_ids = task['unanswered_ids']
+            logger.info(f"repair attempt {attempt} for {task['key']}: {unanswered_ids}")
+            sub_questions = [question_dict for question_dict in self.build_sub_questions(task['group'])
+                             if question_dict['id'] in unanswered_ids]
+            try:
+                model_output = self.generate(task, self.format_prompt(task['context'], sub_questions),
+                                             attempt=attempt)
+            except Exception as e:
+                # Keep the answers of the first response rather than failing the main question
+                logger.warning(f"repair attempt {attempt} for {task['key']} failed: {str(e)}")
+                break
+            repaired_response = safe_parse_response(model_output, unanswered_ids)
+            for question_id in unanswered_ids:
+                if not find_unanswered_questions(repaired_response, [question_id]):
+                    task['model_response'][question_id] = repaired_response[question_id]
+            task['unanswered_ids'] = find_unanswered_questions(task['model_response'], task['question_id_list'])
+
+        if attempt:
+            logger.info(f"{task['key']}: {len(task['unanswered_ids'])} sub-questions without an answer "
+                        f"after {attempt} repair attempts")
+            task['record'] = self.build_record(task)
+        return task
+
+    def build_record(self, task):
+        """All sub-questions of a main question with the answers of the model."""
+        model_response = task['model_response']
+        group = task['group']
+
+        subquestion_responses = {}
+        for idx in range(len(group)):
+            output_key = group.iloc[idx]['question_id']
+
+            # Create a JSON object with the original input data and the model response
+            input_data_with_response = group.iloc[idx].to_dict()
+
+            # Always include model_answer and model_explanation
+            # Sub-questions the model left out get empty ones
+            sub_response = model_response.get(output_key)
+            if not isinstance(sub_response, dict):
+                sub_response = {}
+            response_update = {
+                'model_answer': sub_response.get('answer', ''),
+                'model_explanation': sub_response.get('explanation', '')
+            }
 
-        # Format the prompt with the structured questions
-        if self.use_pot:
-            prompt = ProgramOfThoughtsQuestionPrompt.init().format(
-                context=context,
-                sub_questions=sub_questions
-            )
-        else:
-            prompt = QuestionPrompt.init().format(
-                context=context,
-                sub_questions=sub_questions
-            )
+            # Only include model_reasoning if self.is_reasoning_model is True
+            if self.is_reasoning_model and 'reasoning' in model_response:
+                response_update['model_reasoning'] = model_response['reasoning']
 
-        model_output = generate_response_from_llm(self.llm, prompt, images, use_ocr=self.use_ocr, ocr_model=self.ocr_model)
-        model_response = safe_parse_response(model_output, question_id_list)
+            input_data_with_response.update(response_update)
 
-        return model_response
+            # Store the response in the subquestion_responses dictionary
+            subquestion_responses[output_key] = input_data_with_response
 
-    def run(self):
-        # Create a copy of the DataFrame at the start
-        dataset_df = self.dataset_df.copy()
+        return subquestion_responses
 
-        for (_, language, main_question_id), group in dataset_df.groupby(
-                ['language_order', DC.LANGUAGE, DC.MAIN_QUESTION_ID]):
+    def persist(self, task):
+        # Write the aggregated subquestion responses to the database
+        write_to_database(self.target_db_name, task['key'], task['record'])
+        return task
+
+    def is_stored(self, key):
+        """True if the main question is in the database AND not specifically requested in filtered_main_question_ids."""
+        main_question_id = int(key.rsplit('_', 1)[1])
+        return key in self.target_db and (self.filtered_main_question_ids is None or
+                                          main_question_id not in self.filtered_main_question_ids)
+
+    def iter_tasks(self):
+        """Yield a task per main question that is not in the database yet, or specifically requested."""
+        for language, main_question_id, group in iter_main_question_groups(self.dataset_df):
             key = f'{language}_{main_question_id}'
-            # Skip if already in database AND not specifically requested in filtered_main_question_ids
-            if key in self.target_db and (self.filtered_main_question_ids is None or main_question_id not in self.filtered_main_question_ids):
-            # Skip this question since it's already in the database and not specifically requested
-                continue
-            try:
-                logger.info(f'start generating answers for {language} -- main_question_id: {main_question_id}')
-                model_response = self.generate_answer_for_one_main_question(group)
-
-                # Aggregate all subquestions with their answers into a single dictionary
-                subquestion_responses = {}
-                for idx in range(len(group)):
-                    output_key = group.iloc[idx]['question_id']
-
-                    # Create a JSON object with the original input data and the model response
-                    input_data_with_response = group.iloc[idx].to_dict()
-                    
-                    # Always include model_answer and model_explanation
-                    response_update = {
-                        'model_answer': model_response[output_key]['answer'],
-                        'model_explanation': model_response[output_key]['explanation']
-                    }
-
-                    # Only include model_reasoning if self.is_reasoning_model is True
-                    if self.is_reasoning_model and 'reasoning' in model_response:
-                        response_update['model_reasoning'] = model_response['reasoning']
-                
-                    input_data_with_response.update(response_update)
-
-                    # Store the response in the subquestion_responses dictionary
-                    subquestion_responses[output_key] = input_data_with_response
-
-                # Write the aggregated subquestion responses to the database
-                write_to_database(self.target_db_name, key, subquestion_responses)
-            except Exception as e:
-                logger.error(
-                    "Error processing main_question_id %s: %s", main_question_id, str(e))
+            if self.manifest.is_done(key) if self.manifest is not None else self.is_stored(key):
                 continue
+            yield {'key': key, 'language': language, 'main_question_id': main_question_id, 'group': group}
+
+    def build_pipeline(self):
+        return Pipeline('generation', [
+            Stage('render', self.render, self.pipeline_config['render_workers'], drain=False),
+            Stage('call', self.call, self.pipeline_config['call_workers'], drain=False,
+                  backend=self.pipeline_config['call_backend'], dispatch=True),
+            Stage('parse', self.parse, self.pipeline_config['parse_workers']),
+            # Follow-up calls for the unanswered sub-questions, a no-op for the tasks answered in full
+            Stage('repair', self.repair, self.pipeline_config['call_workers'],
+                  backend=self.pipeline_config['call_backend']),
+            # A single writer, the database file must not be written by two threads at once
+            Stage('persist', self.persist),
+        ], queue_size=self.pipeline_config['queue_size'], manifest=self.manifest)
+
+    def run(self):
+        try:
+            self.run_pipeline(self.build_pipeline(), self.iter_tasks())
+        finally:
+            self.close_manifest()
 
         # Save the DataFrame to a file
-        dataset_df.to_csv('output_samples.csv', index=False)
+        self.dataset_df.to_csv('output_samples.csv', index=False)
 
         logger.info('Generation complete')
         logger.info('Result saved to %s in json format', self.target_db_name)
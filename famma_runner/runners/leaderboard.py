@@ -0,0 +1,195 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import omegaconf
+import pandas as pd
+from easyllm_kit.utils.io_utils import initialize_database, write_to_database
+from easyllm_kit.utils import get_logger
+
+from famma_runner.runners.base_runner import Runner
+from famma_runner.runners.analyzer import Analyzer, BOOTSTRAP_CLUSTER_BY, DEFAULT_BOOTSTRAP_CONFIG
+from famma_runner.utils import DC
+from famma_runner.utils.eval_utils import ANALYSIS_TYPES, BREAKDOWNS, format_group_key, cluster_bootstrap_weights, \
+    pairwise_mcnemar
+
+logger = get_logger('leaderboard', 'leaderboard.log')
+
+# Question attributes kept next to the result matrix to compute the breakdowns
+QUESTION_COLUMNS = [DC.LANGUAGE, DC.MAIN_QUESTION_ID, DC.TOPIC_DIFFICULTY, DC.SUBFIELD, DC.QUESTION_TYPE,
+                    DC.IS_ARITHMETIC]
+
+
+@Runner.register("leaderboard")
+class LeaderboardAnalyzer(Runner):
+    """
+    Compare many evaluated models in one run.
+
+    The evaluated stores are loaded concurrently and aligned on question_id into one int8 matrix
+    (models x questions) with 1 for correct, 0 for incorrect and -1 for questions a model was not
+    evaluated on. Accuracies, pairwise McNemar and paired bootstrap tests and rank stability are all
+    computed from that matrix and written as one comparison table.
+    """
+
+    def __init__(self, config):
+        self.data_config = config["data"]
+        self.config = config
+
+        self.target_db_name = self.data_config.get('leaderboard_name', 'leaderboard')
+        self.target_db = initialize_database(output_db=self.target_db_name)
+        self.output_path = self.data_config.get('output_path', f'./{self.target_db_name}.csv')
+        self.bootstrap_config = {**DEFAULT_BOOTSTRAP_CONFIG, **dict(config.get('bootstrap') or {})}
+
+        self.model_names, self.result_matrix, self.questions_df = self.setup_dataset()
+
+    @staticmethod
+    def get_model_name(data_dir):
+        """Model name of an evaluated store, e.g. 'gpt-4o' for './ddb_storage/gpt-4o_evaluated_by_gpt.json'"""
+        return os.path.splitext(os.path.basename(data_dir))[0].split('_evaluated_by_')[0]
+
+    def setup_dataset(self):
+        data_dirs = self.data_config.data_dirs
+        if isinstance(data_dirs, (dict, omegaconf.DictConfig)):
+            model_names, data_dirs = list(data_dirs.keys()), list(data_dirs.values())
+        else:
+            data_dirs = list(data_dirs)
+            model_names = [self.get_model_name(data_dir) for data_dir in data_dirs]
+
+        num_workers = self.data_config.get('num_workers', 8)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            stores = list(executor.map(Analyzer.load_evaluated_store, data_dirs))
+        logger.info(f"Loaded {len(stores)} evaluated stores")
+
+        return (model_names,) + self.build_result_matrix(stores)
+
+    @staticmethod
+    def build_result_matrix(stores):
+        """
+        Align evaluated stores on question_id.
+
+        Returns:
+            Tuple (result_matrix, questions_df), result_matrix being an int8 array (models x questions)
+            and questions_df the attributes of the questions, in the column order of the matrix
+        """
+        question_frames = []
+        for df in stores:
+            columns = [DC.QUESTION_ID] + [column for column in QUESTION_COLUMNS if column in df.columns]
+            question_frames.append(df[columns])
+        questions_df = pd.concat(question_frames, ignore_index=True).drop_duplicates(DC.QUESTION_ID)
+        questions_df = questions_df.reset_index(drop=True).reindex(columns=[DC.QUESTION_ID] + QUESTION_COLUMNS)
+
+        question_index = pd.Index(questions_df[DC.QUESTION_ID])
+        result_matrix = np.full((len(stores), len(question_index)), -1, dtype=np.int8)
+        for i, df in enumerate(stores):
+            df = df.drop_duplicates(DC.QUESTION_ID)
+            result_matrix[i, question_index.get_indexer(df[DC.QUESTION_ID])] = df['is_correct_by_model'].to_numpy()
+        return result_matrix, questions_df
+
+    def compute_breakdown_accuracies(self):
+        """Accuracy of every model for every analysis type and every group of every breakdown."""
+        correct = (self.result_matrix == 1).astype(np.float64)
+        evaluated = (self.result_matrix >= 0).astype(np.float64)
+
+        columns = {}
+        for analysis_type, condition in ANALYSIS_TYPES.items():
+            if condition is None:
+                mask = np.ones(len(self.questions_df), dtype=bool)
+                prefix = ''
+            else:
+                mask = (self.questions_df[condition[0]] == condition[1]).to_numpy()
+                prefix = f'{analysis_type}_'
+
+            for metric_name, group_by in BREAKDOWNS.items():
+                if group_by is None:
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        accuracies = correct[:, mask].sum(axis=1) / evaluated[:, mask].sum(axis=1)
+                    columns[f'{prefix}{metric_name}'] = accuracies
+                    continue
+                grouped = self.questions_df[mask].groupby(group_by, sort=True)
+                codes = grouped.ngroup().to_numpy()
+                keys = [format_group_key(key) for key in grouped.size().index]
+                # One-hot (questions x groups) matrix, questions with missing keys belong to no group
+                one_hot = np.zeros((int(mask.sum()), len(keys)))
+                valid = np.nan_to_num(codes, nan=-1) >= 0
+                one_hot[np.flatnonzero(valid), codes[valid].astype(np.int64)] = 1
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    accuracies = (correct[:, mask] @ one_hot) / (evaluated[:, mask] @ one_hot)
+                for k, key in enumerate(keys):
+                    columns[f'{prefix}{metric_name}_{key}'] = accuracies[:, k]
+        return columns
+
+    def compute_paired_bootstrap(self):
+        """
+        Paired clustered bootstrap over the questions evaluated for every model.
+
+        Returns:
+            Dict with the bootstrap accuracies (resamples x models) and the number of common questions
+        """
+        common = (self.result_matrix >= 0).all(axis=0)
+        n_resamples = int(self.bootstrap_config['n_resamples'])
+        if not common.any() or not n_resamples:
+            return None
+
+        common_df = self.questions_df[common]
+        cluster_by = BOOTSTRAP_CLUSTER_BY if common_df[DC.MAIN_QUESTION_ID].notna().all() else [DC.QUESTION_ID]
+        cluster_codes = common_df.groupby(cluster_by, sort=False, dropna=False).ngroup().to_numpy()
+        num_clusters = int(cluster_codes.max()) + 1
+
+        # Per-cluster correct counts of every model (clusters x models) and question counts
+        S = np.zeros((num_clusters, len(self.model_names)))
+        np.add.at(S, cluster_codes, (self.result_matrix[:, common] == 1).T.astype(np.float64))
+        N = np.bincount(cluster_codes, minlength=num_clusters).astype(np.float64)
+
+        accuracies = np.concatenate([(W @ S) / (W @ N)[:, None] for W in cluster_bootstrap_weights(
+            num_clusters, n_resamples, seed=self.bootstrap_config['seed'])], axis=0)
+        return {'accuracies': accuracies, 'num_questions': int(common.sum()),
+                'observed': S.sum(axis=0) / N.sum()}
+
+    def run(self):
+        num_models = len(self.model_names)
+        table = pd.DataFrame({'model': self.model_names,
+                              'num_questions': (self.result_matrix >= 0).sum(axis=1)})
+        for column, values in self.compute_breakdown_accuracies().items():
+            table[column] = values
+
+        bootstrap = self.compute_paired_bootstrap()
+        if bootstrap is not None:
+            accuracies = bootstrap['accuracies']
+            alpha = (1 - float(self.bootstrap_config['confidence_level'])) / 2
+            table['num_common_questions'] = bootstrap['num_questions']
+            table['common_acc'] = bootstrap['observed']
+            table['common_acc_ci_low'], table['common_acc_ci_high'] = np.percentile(
+                accuracies, [100 * alpha, 100 * (1 - alpha)], axis=0)
+
+            # Rank stability: how often each model keeps its rank on the common questions
+            observed_rank = (-bootstrap['observed']).argsort(kind='stable').argsort() + 1
+            ranks = (-accuracies).argsort(axis=1, kind='stable').argsort(axis=1) + 1
+            table['rank'] = observed_rank
+            table['mean_bootstrap_rank'] = ranks.mean(axis=0)
+            table['rank_ci_low'], table['rank_ci_high'] = np.percentile(
+                ranks, [100 * alpha, 100 * (1 - alpha)], axis=0)
+            table['rank_stability'] = (ranks == observed_rank).mean(axis=0)
+
+            # Two-sided paired bootstrap p-values of the accuracy differences (resamples x models x models)
+            differences = accuracies[:, :, None] - accuracies[:, None, :]
+            bootstrap_p = np.minimum(1.0, 2 * np.minimum((differences <= 0).mean(axis=0),
+                                                         (differences >= 0).mean(axis=0)))
+            np.fill_diagonal(bootstrap_p, 1.0)
+
+        _, mcnemar_p = pairwise_mcnemar(self.result_matrix)
+        for j in range(num_models):
+            table[f'mcnemar_p_vs_{self.model_names[j]}'] = mcnemar_p[:, j]
+            if bootstrap is not None:
+                table[f'bootstrap_p_vs_{self.model_names[j]}'] = bootstrap_p[:, j]
+
+        table = table.sort_values('overall_acc', ascending=False, kind='stable').reset_index(drop=True)
+        self.table = table
+
+        table.to_csv(self.output_path, index=False)
+        logger.info(f"Leaderboard of {num_models} models saved to {self.output_path}")
+        logger.info(f"\n{table[['model', 'num_questions', 'overall_acc']].to_string(index=False)}")
+
+        # Round-trip through json to store native types, with NaN as null
+        records = json.loads(table.to_json(orient='records'))
+        write_to_database(self.target_db_name, 'table', records)
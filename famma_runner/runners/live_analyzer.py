@@ -0,0 +1,81 @@
+import json
+import os
+import time
+
+from easyllm_kit.utils.io_utils import initialize_database, write_to_database
+from easyllm_kit.utils import get_logger, read_json
+
+from famma_runner.runners.base_runner import Runner
+from famma_runner.utils import load_release
+from famma_runner.utils.eval_utils import StreamingAccuracy
+
+logger = get_logger('live_analyzer', 'live_analyzer.log')
+
+
+@Runner.register("live_analyzer")
+class LiveAnalyzer(Runner):
+    """
+    Follow the result store of a running evaluation and publish the running metrics.
+
+    The store is polled every `poll_interval` seconds and only records not seen before are counted,
+    so the metrics of a run can be watched (and a broken run spotted) from another process.
+    """
+
+    def __init__(self, config):
+        self.data_config = config["data"]
+        self.config = config
+
+        self.poll_interval = self.data_config.get('poll_interval', 10)
+        # Stop after this many polls without new records
+        self.max_idle_polls = self.data_config.get('max_idle_polls', 60)
+        self.abort_below_acc = self.data_config.get('abort_below_acc')
+        self.abort_after_progress = self.data_config.get('abort_after_progress', 0.05)
+
+        self.target_db_name = f'{self.data_config.model_name_to_eval}_live_result'
+        self.target_db = initialize_database(output_db=self.target_db_name)
+
+        self.tracker = StreamingAccuracy(total_questions=self.get_total_questions())
+
+    def get_total_questions(self):
+        """Number of questions the evaluation will judge, from `total_questions` or the gold release."""
+        if self.data_config.get('total_questions'):
+            return int(self.data_config.total_questions)
+        if self.data_config.get('gold_dir'):
+            return len(load_release(self.data_config.gold_dir))
+        return None
+
+    def poll(self):
+        """Count the records added to the store since the last poll, returns the number of new records."""
+        if not os.path.exists(self.data_config.data_dir):
+            return 0
+        try:
+            store = read_json(self.data_config.data_dir)
+        except (json.JSONDecodeError, ValueError):
+            # The store is being rewritten, read it again at the next poll
+            return 0
+        return sum(self.tracker.update(record) for record in store.values())
+
+    def run(self):
+        idle_polls = 0
+        while True:
+            num_new_records = self.poll()
+            idle_polls = 0 if num_new_records else idle_polls + 1
+
+            snapshot = self.tracker.snapshot()
+            snapshot['below_threshold'] = self.tracker.is_below(self.abort_below_acc, self.abort_after_progress)
+            write_to_database(self.target_db_name, 'snapshot', snapshot)
+
+            overall_acc = snapshot['metrics']['consolidated']['overall_acc']
+            logger.info(f"{snapshot['num_records']}/{snapshot['total_questions']} questions judged, "
+                        f"running accuracy {overall_acc:.2%}")
+            if snapshot['below_threshold']:
+                logger.warning(f"Running accuracy is below {self.abort_below_acc} after "
+                               f"{snapshot['num_records']} questions, the run looks broken")
+
+            if self.tracker.total_questions and self.tracker.num_records >= self.tracker.total_questions:
+                logger.info('All questions judged')
+                break
+            if idle_polls >= self.max_idle_polls:
+                logger.info(f'No new records for {idle_polls} polls, stop following {self.data_config.data_dir}')
+                break
+            time.sleep(self.poll_interval)
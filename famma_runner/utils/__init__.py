@@ -1,17 +1,25 @@
-from famma_runner.utils.path_utils import find_image_file
+from famma_runner.utils.path_utils import find_image_file, index_image_dir
 from famma_runner.utils.data_const import DatasetColumns as DC
 from famma_runner.utils.data_const import ReleaseVersion
 from famma_runner.utils.data_const import LANGUAGE_ORDER
 from famma_runner.utils.data_const import ReasoningColumns as RDC
 from famma_runner.utils.gen_utils import collect_images_from_first_subquestion, safe_parse_response, \
-    generate_response_from_llm, parse_reasoning_response
+    generate_response_from_llm, parse_reasoning_response, find_unanswered_questions
 from famma_runner.utils.prompt_utils import QuestionPrompt, JudgePrompt, ProgramOfThoughtsQuestionPrompt, \
     JsonResponsePrompt, SingleQuestionGRPOPrompt,QuestionPromptForReasoningFineTune
 from famma_runner.utils.data_utils import order_by_language, sample_questions, encode_answer, decode_answer, \
     download_data
-from famma_runner.utils.eval_utils import calculate_accuracy
+from famma_runner.utils.eval_utils import calculate_accuracy, build_accuracy_cube, accuracy_from_cube, count_from_cube, \
+    clustered_bootstrap_ci
+from famma_runner.utils.snapshot_utils import PackedRelease, load_release, pack_release, get_release_image_source
+from famma_runner.utils.writer_utils import ResultWriter
+from famma_runner.utils.telemetry_utils import TelemetryRecorder
+from famma_runner.utils.cache_utils import PromptCache, prompt_digest
+from famma_runner.utils.executor_utils import Executor
+from famma_runner.utils.manifest_utils import RunManifest
 
 __all__ = ['find_image_file',
+           'index_image_dir',
            'DC',
            'ReleaseVersion',
            'collect_images_from_first_subquestion',
@@ -19,11 +27,16 @@ __all__ = ['find_image_file',
            'ProgramOfThoughtsQuestionPrompt',
            'JsonResponsePrompt',
            'safe_parse_response',
+           'find_unanswered_questions',
            'generate_response_from_llm',
            'JudgePrompt',
            'LANGUAGE_ORDER',
            'order_by_language',
            'calculate_accuracy',
+           'build_accuracy_cube',
+           'accuracy_from_cube',
+           'count_from_cube',
+           'clustered_bootstrap_ci',
            'sample_questions',
            'SingleQuestionGRPOPrompt',
            'encode_answer',
@@ -31,5 +44,15 @@ __all__ = ['find_image_file',
            'download_data',
            'parse_reasoning_response',
            'RDC',
-           'QuestionPromptForReasoningFineTune'
+           'QuestionPromptForReasoningFineTune',
+           'PackedRelease',
+           'load_release',
+           'pack_release',
+           'get_release_image_source',
+           'ResultWriter',
+           'TelemetryRecorder',
+           'PromptCache',
+           'prompt_digest',
+           'Executor',
+           'RunManifest'
            ]
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+DEFAULT_PROMPT_CACHE_PATH = './prompt_cache/prompt_cache.sqlite'
+
+
+def prompt_digest(prompt) -> str:
+    """
+    Compact cache key of a prompt: the sha256 of its canonical json, for text prompts, chat messages
+    and (prompt, extra) tuples alike.
+    """
+    if isinstance(prompt, str):
+        data = prompt
+    else:
+        data = json.dumps(prompt, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class PromptCache:
+    """
+    Outputs of the model per prompt, stored in a SQLite file keyed by prompt_digest.
+
+    The file can be used by several processes at once, so worker processes consult and fill the cache
+    directly instead of receiving a copy of it with every task. A pickled cache only carries its path,
+    the connection is opened again in the process that uses it.
+
+    Example:
+        >>> cache = PromptCache('./prompt_cache/gpt-4o.sqlite')
+        >>> key = prompt_digest(prompt)
+        >>> outputs = cache.get(key)
+        >>> if outputs is None:
+        ...     cache.put(key, outputs := runner._run_single(prompt))
+    """
+
+    def __init__(self, path: str = DEFAULT_PROMPT_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection must not cross a fork, open one per process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._pid = os.getpid()
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS prompt_outputs (key TEXT PRIMARY KEY, outputs TEXT)')
+            self._conn.commit()
+        return self._conn
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute('SELECT COUNT(*) FROM prompt_outputs').fetchone()[0]
+
+    def get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            row = self._connect().execute('SELECT outputs FROM prompt_outputs WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_many(self, keys: List[str], chunk_size: int = 500) -> Dict[str, List[str]]:
+        """Outputs of the cached keys among keys, looked up in chunks."""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            conn = self._connect()
+            for start in range(0, len(unique_keys), chunk_size):
+                chunk = unique_keys[start:start + chunk_size]
+                rows = conn.execute(f"SELECT key, outputs FROM prompt_outputs WHERE key IN "
+                                    f"({','.join('?' * len(chunk))})", chunk).fetchall()
+                found.update({key: json.loads(outputs) for key, outputs in rows})
+        return found
+
+    def put(self, key: str, outputs: List[str]):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO prompt_outputs VALUES (?, ?)',
+                         (key, json.dumps(outputs, ensure_ascii=False)))
+            conn.commit()
+
+    def __setitem__(self, key: str, outputs: List[str]):
+        self.put(key, outputs)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
@@ -0,0 +1,243 @@
+import base64
+import glob
+import json
+import os
+import random
+from typing import Dict, List, Optional
+
+import dictdatabase as DDB
+from easyllm_kit.utils import get_logger, read_json
+
+logger = get_logger('compress_utils', 'compress_utils.log')
+
+# Largest fields of reasoning stores, compressed when a store is written with compression
+COMPRESSED_FIELDS = ['thinking_trajectory', 'reasoning_content']
+
+# A compressed field is stored as {"__zstd__": "<base64 of the zstd frame>", "dict_id": <id of the dictionary>},
+# dict_id being None for fields compressed without a dictionary
+COMPRESSED_MARKER = '__zstd__'
+DICTIONARY_SUFFIX = '.zdict'
+
+DEFAULT_COMPRESSION_LEVEL = 10
+DEFAULT_DICTIONARY_SIZE = 112640
+# Traces of a group collected before its dictionary is trained when writing a new store
+DEFAULT_TRAIN_SIZE = 256
+# Below this many traces a dictionary is not trained (zstd fails on too little data),
+# the traces of the group are compressed without a dictionary
+MIN_TRAIN_SAMPLES = 32
+# Record field selecting the dictionary of a record, traces of one language share most of their phrasing
+DEFAULT_GROUP_FIELD = 'language'
+DEFAULT_GROUP = 'default'
+
+
+def get_store_path(db_name: str) -> str:
+    """Path of the json file of a DDB store."""
+    return os.path.join(DDB.config.storage_directory, f"{db_name}.json")
+
+
+def get_dictionary_path(store_path: str, group: Optional[str] = None) -> str:
+    """
+    Path of a compression dictionary of a store, e.g. ./ddb_storage/xx_distill_release_basic.english.zdict
+    for the group 'english', or ./ddb_storage/xx_distill_release_basic.zdict without a group.
+    """
+    base = os.path.splitext(store_path)[0]
+    return f"{base}.{group}{DICTIONARY_SUFFIX}" if group else f"{base}{DICTIONARY_SUFFIX}"
+
+
+def list_dictionary_paths(store_path: str) -> List[str]:
+    """All dictionaries of a store, with or without a group."""
+    base = glob.escape(os.path.splitext(store_path)[0])
+    return sorted(set(glob.glob(f"{base}{DICTIONARY_SUFFIX}") + glob.glob(f"{base}.*{DICTIONARY_SUFFIX}")))
+
+
+def is_compressed(value) -> bool:
+    return isinstance(value, dict) and COMPRESSED_MARKER in value
+
+
+class TraceCompressor:
+    """
+    Compress the trace fields of store records with zstd and one dictionary per language, trained on
+    traces of the store.
+
+    Traces of the same language share most of their phrasing, so a dictionary per language makes even
+    short traces compress well. Dictionaries are saved next to the store and all of them are loaded on read,
+    fields are decompressed with the dictionary whose id they carry. Groups with too few traces to train
+    a dictionary are compressed without one. zstandard is only imported when a compressor is created.
+
+    Example:
+        >>> compressor = TraceCompressor.for_store('./ddb_storage/xx_distill_release_basic.json')
+        >>> record = compressor.compress_record(record)
+        >>> record = compressor.decompress_record(record)
+    """
+
+    def __init__(self, store_path: str, fields: Optional[List[str]] = None,
+                 level: int = DEFAULT_COMPRESSION_LEVEL, train_size: int = DEFAULT_TRAIN_SIZE,
+                 dict_size: int = DEFAULT_DICTIONARY_SIZE, group_field: str = DEFAULT_GROUP_FIELD):
+        import zstandard
+
+        self._zstd = zstandard
+        self.store_path = store_path
+        self.fields = fields or COMPRESSED_FIELDS
+        self.level = level
+        self.train_size = train_size
+        self.dict_size = dict_size
+        self.group_field = group_field
+
+        # Dictionary id of every trained group, None for groups compressed without a dictionary
+        self.group_dict_ids = {}
+        self._samples = {}
+        self._compressors = {None: zstandard.ZstdCompressor(level=level)}
+        self._decompressors = {None: zstandard.ZstdDecompressor()}
+
+        for path in list_dictionary_paths(store_path):
+            with open(path, 'rb') as f:
+                dictionary = zstandard.ZstdCompressionDict(f.read())
+            self._add_dictionary(dictionary)
+            group = os.path.basename(path)[:-len(DICTIONARY_SUFFIX)].split('.', 1)[1:] or [DEFAULT_GROUP]
+            self.group_dict_ids[group[0]] = dictionary.dict_id()
+
+    @classmethod
+    def for_store(cls, store_path: str, **kwargs) -> "TraceCompressor":
+        return cls(store_path, **kwargs)
+
+    def _add_dictionary(self, dictionary):
+        dict_id = dictionary.dict_id()
+        self._compressors[dict_id] = self._zstd.ZstdCompressor(level=self.level, dict_data=dictionary)
+        self._decompressors[dict_id] = self._zstd.ZstdDecompressor(dict_data=dictionary)
+
+    def get_group(self, record: Dict) -> str:
+        return str(record.get(self.group_field) or DEFAULT_GROUP)
+
+    def train(self, group: str, samples: List[str]) -> Optional[int]:
+        """
+        Train the dictionary of a group on sample traces and save it next to the store.
+
+        Returns:
+            Id of the dictionary, None if there are too few samples to train one, the group is then
+            compressed without a dictionary
+        """
+        dictionary = None
+        if len(samples) >= MIN_TRAIN_SAMPLES:
+            try:
+                dictionary = self._zstd.train_dictionary(self.dict_size,
+                                                         [sample.encode('utf-8') for sample in samples])
+            except self._zstd.ZstdError as e:
+                logger.warning(f"Could not train a compression dictionary for {group} on {len(samples)} traces: {e}")
+        if dictionary is None:
+            logger.info(f"Compressing the traces of {group} without a dictionary")
+            self.group_dict_ids[group] = None
+            return None
+
+        path = get_dictionary_path(self.store_path, group)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(dictionary.as_bytes())
+        os.replace(tmp_path, path)
+        self._add_dictionary(dictionary)
+        self.group_dict_ids[group] = dictionary.dict_id()
+        logger.info(f"Trained compression dictionary {dictionary.dict_id()} for {group} on {len(samples)} traces: "
+                    f"{path}")
+        return dictionary.dict_id()
+
+    def compress_text(self, text: str, dict_id: Optional[int] = None) -> Dict:
+        frame = self._compressors[dict_id].compress(text.encode('utf-8'))
+        return {COMPRESSED_MARKER: base64.b64encode(frame).decode('ascii'), 'dict_id': dict_id}
+
+    def decompress_value(self, value):
+        """Decompress a compressed field, other values are returned as is."""
+        if not is_compressed(value):
+            return value
+        decompressor = self._decompressors.get(value.get('dict_id'))
+        if decompressor is None:
+            raise ValueError(f"Field compressed with dictionary {value.get('dict_id')}, which is not among the "
+                             f"dictionaries of {self.store_path}")
+        return decompressor.decompress(base64.b64decode(value[COMPRESSED_MARKER])).decode('utf-8')
+
+    def compress_record(self, record: Dict) -> Dict:
+        """
+        Return a copy of the record with its trace fields compressed with the dictionary of its group.
+        Until the dictionary of the group is trained, records are returned unchanged and their traces
+        are kept as training samples.
+        """
+        group = self.get_group(record)
+        if group not in self.group_dict_ids:
+            samples = self._samples.setdefault(group, [])
+            samples.extend(record[field] for field in self.fields
+                           if isinstance(record.get(field), str) and record[field])
+            if len(samples) < self.train_size:
+                return record
+            self.train(group, self._samples.pop(group))
+
+        dict_id = self.group_dict_ids[group]
+        record = dict(record)
+        for field in self.fields:
+            if isinstance(record.get(field), str) and record[field]:
+                compressed = self.compress_text(record[field], dict_id)
+                # Short traces may grow once base64 encoded, those are kept as they are
+                if len(compressed[COMPRESSED_MARKER]) < len(record[field].encode('utf-8')):
+                    record[field] = compressed
+        return record
+
+    def decompress_record(self, record: Dict) -> Dict:
+        if not any(is_compressed(record.get(field)) for field in self.fields):
+            return record
+        return {key: self.decompress_value(value) for key, value in record.items()}
+
+
+def decompress_store(store: Dict, store_path: str) -> Dict:
+    """Decompress the trace fields of every record of a store in place, the dictionary is only loaded if needed."""
+    compressor = None
+    for key, record in store.items():
+        if not isinstance(record, dict) or not any(is_compressed(value) for value in record.values()):
+            continue
+        if compressor is None:
+            compressor = TraceCompressor.for_store(store_path)
+        store[key] = {field: compressor.decompress_value(value) for field, value in record.items()}
+    return store
+
+
+def load_store(store_path: str) -> Dict:
+    """Read a result store, transparently decompressing compressed trace fields."""
+    return decompress_store(read_json(store_path), store_path)
+
+
+def compress_store(store_path: str, sample_size: int = 1000, level: int = DEFAULT_COMPRESSION_LEVEL,
+                   seed: int = 0) -> Dict:
+    """
+    Compress the trace fields of an existing store in place, training a new dictionary per language
+    on a sample of its traces.
+
+    Returns:
+        Size of the store file before and after compression, in bytes
+    """
+    size_before = os.path.getsize(store_path)
+    store = load_store(store_path)
+    if not store:
+        logger.info(f"{store_path} is empty, nothing to compress")
+        return {'size_before': size_before, 'size_after': size_before}
+
+    # Records are decompressed above, so the previous dictionaries are not needed anymore
+    for path in list_dictionary_paths(store_path):
+        os.remove(path)
+    compressor = TraceCompressor(store_path, level=level)
+
+    traces_by_group = {}
+    for record in store.values():
+        traces_by_group.setdefault(compressor.get_group(record), []).extend(
+            record[field] for field in COMPRESSED_FIELDS if isinstance(record.get(field), str) and record[field])
+    rng = random.Random(seed)
+    for group, traces in sorted(traces_by_group.items()):
+        rng.shuffle(traces)
+        compressor.train(group, traces[:sample_size])
+    compressed = {key: compressor.compress_record(record) for key, record in store.items()}
+
+    # Write to a temporary file and move it in place so that readers never see a partial store
+    tmp_path = f"{store_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(compressed, f, ensure_ascii=False)
+    os.replace(tmp_path, store_path)
+
+    size_after = os.path.getsize(store_path)
+    logger.info(f"Compressed {store_path}: {size_before} -> {size_after} bytes "
+                f"({size_before / max(size_after, 1):.1f}x)")
+    return {'size_before': size_before, 'size_after': size_after}
@@ -3,14 +3,53 @@ from PIL import Image
 from PIL.JpegImagePlugin import JpegImageFile
 from PIL.PngImagePlugin import PngImageFile
 from datasets import load_dataset
+from datasets import Image as ImageFeature
 from easyllm_kit.utils import save_json
 import numpy as np
 import pandas as pd
 import base64
 from famma_runner.utils.data_const import DatasetColumns as DC
+from famma_runner.utils.path_utils import guess_image_extension
 
 
-def convert_to_json_list(dataset, save_dir="./hf_data", release_version="release_v2406", decode_answer=False):
+def disable_image_decoding(dataset):
+    """
+    Cast every image column of the dataset to a non-decoding Image feature,
+    so that samples carry the original encoded bytes instead of PIL images.
+    """
+    for column, feature in dataset.features.items():
+        if isinstance(feature, ImageFeature):
+            dataset = dataset.cast_column(column, ImageFeature(decode=False))
+    return dataset
+
+
+def save_raw_image(value, images_dir, image_stem):
+    """
+    Write the original encoded bytes of an undecoded image to disk.
+
+    Args:
+        value: Dict with 'bytes' and 'path' as produced by Image(decode=False)
+        images_dir: Directory to save the image in
+        image_stem: File name of the image without extension
+
+    Returns:
+        File name (with the extension of the original encoding) or None if the value holds no image
+    """
+    image_bytes = value.get('bytes')
+    if image_bytes is None:
+        if not value.get('path') or not os.path.exists(value['path']):
+            return None
+        with open(value['path'], 'rb') as f:
+            image_bytes = f.read()
+
+    image_filename = f"{image_stem}{guess_image_extension(image_bytes, value.get('path'))}"
+    with open(os.path.join(images_dir, image_filename), 'wb') as f:
+        f.write(image_bytes)
+    return image_filename
+
+
+def convert_to_json_list(dataset, save_dir="./hf_data", release_version="release_v2406", decode_answer=False,
+                         raw_images=False):
     """
     Convert data in Dataset format to list format.
     Saves images locally and returns their paths.
@@ -20,16 +59,31 @@ def convert_to_json_list(dataset, save_dir="./hf_data", release_version="release
         save_dir: Base directory to save images
         release_version: Version string to append to images folder
         decode_answer: If True, decode base64-encoded answers
+        raw_images: If True, read image columns without decoding and write the original
+            encoded bytes to disk (keeping their png/jpg extension) instead of re-encoding to JPEG
     """
     json_list = []
     # Create images directory if it doesn't exist
     images_dir = os.path.join(save_dir, f"images_{release_version}")
     os.makedirs(images_dir, exist_ok=True)
 
+    if raw_images:
+        dataset = disable_image_decoding(dataset)
+        raw_image_columns = {column for column, feature in dataset.features.items()
+                             if isinstance(feature, ImageFeature)}
+    else:
+        raw_image_columns = set()
+
     for idx, sample in enumerate(dataset):
         sample_res = {}
         for key, value in sample.items():
-            if isinstance(value, (Image.Image, JpegImageFile, PngImageFile)):
+            if key in raw_image_columns:
+                image_filename = None
+                if isinstance(value, dict):
+                    image_filename = save_raw_image(value, images_dir, f"{sample['question_id']}_{key}")
+                sample_res[key] = os.path.join(f"images_{release_version}", image_filename) \
+                    if image_filename is not None else None
+            elif isinstance(value, (Image.Image, JpegImageFile, PngImageFile)):
                 # Create a unique filename for the image
                 image_filename = f"{sample['question_id']}_{key}.jpg"
                 image_path = os.path.join(images_dir, image_filename)
@@ -57,7 +111,8 @@ def convert_to_json_list(dataset, save_dir="./hf_data", release_version="release
     return json_list
 
 
-def download_data(hf_dir, split=None, save_dir="./hf_data", from_local=False, decode_answer=False):
+def download_data(hf_dir, split=None, save_dir="./hf_data", from_local=False, decode_answer=False,
+                  raw_images=False):
     """
     Download dataset from HuggingFace repo and convert to JSON files.
     Images are saved locally in {save_dir}/images/.
@@ -68,6 +123,7 @@ def download_data(hf_dir, split=None, save_dir="./hf_data", from_local=False, de
         save_dir (str): Directory to save the JSON files and images
         from_local (bool): If True, load from local cache instead of HuggingFace
         decode_answer (bool): If True, decode base64-encoded answers
+        raw_images (bool): If True, save the original image bytes without decoding/re-encoding
     """
     try:
         # Create save directory if it doesn't exist
@@ -82,7 +138,7 @@ def download_data(hf_dir, split=None, save_dir="./hf_data", from_local=False, de
                 # Load from HuggingFace
                 dataset = load_dataset(hf_dir, split=split, cache_dir=save_dir)
             json_list = convert_to_json_list(dataset, save_dir=save_dir, release_version=split,
-                                             decode_answer=decode_answer)
+                                             decode_answer=decode_answer, raw_images=raw_images)
 
             # Save to JSON file
             split_path = os.path.join(save_dir, f"{split}.json")
@@ -93,7 +149,7 @@ def download_data(hf_dir, split=None, save_dir="./hf_data", from_local=False, de
             dataset = load_dataset(hf_dir)
             for split_name in dataset.keys():
                 json_list = convert_to_json_list(dataset[split_name], save_dir=save_dir, release_version=split_name,
-                                                 decode_answer=decode_answer)
+                                                 decode_answer=decode_answer, raw_images=raw_images)
 
                 # Save to JSON file
                 split_path = os.path.join(save_dir, f"{split_name}.json")
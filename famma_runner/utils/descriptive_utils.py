@@ -1,286 +1,165 @@
 import os
-import tiktoken
+import pandas as pd
 
-from collections import defaultdict
-from easyllm_kit.utils import save_json, read_json
-
-
-def get_first_sub_question_id(question_id):
-    """
-    Get the first sub-question id from the question id
-    """
-    question_id_parts = question_id.split("_")
-    question_id_parts[2] = "1"
-    return "_".join(question_id_parts)
-
-def get_context(data, question_id):
-    """
-    Get the context of a question from the database
-    """
-    question_id = get_first_sub_question_id(question_id)
-
-    for item in data:
-        if item["question_id"] == question_id:
-            return item["context"]
-    raise ValueError(f"Context not found for question id: {question_id}")
+from easyllm_kit.utils import save_json
+from famma_runner.utils.snapshot_utils import load_release
+from famma_runner.utils.token_utils import get_first_sub_question_id, build_context_index, count_tokens, \
+    precompute_token_counts
 
 
+def _to_key(value):
+    """Convert a group key produced by pandas back to the value stored in the dataset."""
+    return None if pd.isna(value) else value
 
-def get_dataset_statistics(data_dir):
-    """
-    Calculates and saves dataset statistics
-    """
-    # Initialize the dictionary for statistical data
-    stats = {
-        "total_count": 0,
-        "total_main_question_count": 0,
-        "unique_main_question_ids": set(),
-        "language_count": defaultdict(int),
-        "question_type_count": defaultdict(int),
-        "image_type_count": defaultdict(int),
-        "image_type_set": set(),
-        "subfield_count": defaultdict(int),
-        "subfield_set": set(),
-        "topic_difficulty_count": defaultdict(int),
-        "explanation_count": 0,
-        "multiple_images_count": 0,
-        "arithmetic_count": 0,
-        "arithmetic_by_language": defaultdict(int),
-        "arithmetic_by_difficulty": defaultdict(int),
-        "token_counts": defaultdict(lambda: {"total": 0, "count": 0, "average_total": 0, "average_question": 0, "average_context": 0}),
-        "subfield_difficulty_count": defaultdict(lambda: defaultdict(lambda: {"easy": 0, "medium": 0, "hard": 0})),
-        "total_token_sum": {"total": 0, "count": 0, "average_total": 0, "average_question": 0, "average_context": 0},
-        "language_difficulty_count": defaultdict(lambda: {"easy": 0, "medium": 0, "hard": 0}),
-        "question_type_difficulty_count": defaultdict(
-            lambda: {"easy": 0, "medium": 0, "hard": 0}
-        ),
-        
-        # New fields for token counts by category
-        "token_counts_by_question_type": defaultdict(lambda: {"total": 0, "count": 0, "average_total": 0, "average_question": 0, "average_context": 0}),
-        "token_counts_by_difficulty": defaultdict(lambda: {"total": 0, "count": 0, "average_total": 0, "average_question": 0, "average_context": 0}),
-        "token_counts_by_subfield": defaultdict(lambda: {"total": 0, "count": 0, "average_total": 0, "average_question": 0, "average_context": 0}),
-    }
-
-    # read the json files in the data_dir
-    data = read_json(data_dir)
 
-    for item in data:
-        stats["total_count"] += 1
-        if "main_question_id" in item:
-            stats["unique_main_question_ids"].add(item["main_question_id"])
-        stats["language_count"][item["language"]] += 1
-        stats["question_type_count"][item["question_type"]] += 1
-        # Check for image-related columns
-        if "image_type" in item:
-            stats["image_type_count"][item["image_type"]] += 1
-            stats["image_type_set"].add(item["image_type"])
-        
-        # Check for image_1 and image_2 fields
-        if "image_1" in item and item["image_1"] != 'None':
-            stats["image_count"] = stats.get("image_count", 0) + 1
-        stats["subfield_count"][item["subfield"]] += 1
-        stats["subfield_set"].add(item["subfield"])
-        stats["topic_difficulty_count"][item["topic_difficulty"]] += 1
-        if "explanation" in item and item["explanation"]:
-            stats["explanation_count"] += 1
-        if "image_2" in item and item["image_2"] != 'None':
-            stats["multiple_images_count"] += 1
+def _count_dict(grouped):
+    """Convert a grouped count frame to {key: count} keeping the order of first appearance."""
+    return {_to_key(key): int(row["count"]) for key, row in grouped.iterrows()}
 
-        # Count arithmetic questions
-        if item.get("is_arithmetic") == '1':  # Default to False if field doesn't exist
-            stats["arithmetic_count"] += 1
-            stats["arithmetic_by_language"][item["language"]] += 1
-            stats["arithmetic_by_difficulty"][item["topic_difficulty"]] += 1
 
-        # Calculate the token count of content + question
-        tokenizer = tiktoken.get_encoding("cl100k_base")
-        
-        # Calculate question tokens
-        question_tokens = len(tokenizer.encode(item["question"]))
-        
-        # Store context for first sub-question of each main question
-        main_id = get_first_sub_question_id(item["question_id"])
-        
-        context = get_context(data, main_id)
-        context_tokens = len(tokenizer.encode(context))
-         
-        # Total tokens is context tokens (from first sub-question) + current question tokens
-        total_tokens = context_tokens + question_tokens
-        
-        # Update token counts by language
-        stats["token_counts"][item["language"]]["total"] += total_tokens
-        stats["token_counts"][item["language"]]["count"] += 1
-        stats["token_counts"][item["language"]]["question_tokens"] = stats["token_counts"][item["language"]].get("question_tokens", 0) + question_tokens
-        stats["token_counts"][item["language"]]["context_tokens"] = stats["token_counts"][item["language"]].get("context_tokens", 0) + context_tokens
-        
-        stats["total_token_sum"]["total"] += total_tokens
-        stats["total_token_sum"]["count"] += 1
-        stats["total_token_sum"]["question_tokens"] = stats["total_token_sum"].get("question_tokens", 0) + question_tokens
-        stats["total_token_sum"]["context_tokens"] = stats["total_token_sum"].get("context_tokens", 0) + context_tokens
+def _token_dict(grouped):
+    """Convert a grouped token frame to {key: average token counts}."""
+    token_stats = {}
+    for key, row in grouped.iterrows():
+        token_stats[_to_key(key)] = _average_tokens(row)
+    return token_stats
 
-        # Update token counts by question type
-        question_type = item["question_type"]
-        stats["token_counts_by_question_type"][question_type]["total"] += total_tokens
-        stats["token_counts_by_question_type"][question_type]["count"] += 1
-        stats["token_counts_by_question_type"][question_type]["question_tokens"] = stats["token_counts_by_question_type"][question_type].get("question_tokens", 0) + question_tokens
-        stats["token_counts_by_question_type"][question_type]["context_tokens"] = stats["token_counts_by_question_type"][question_type].get("context_tokens", 0) + context_tokens
 
-        # Update token counts by difficulty
-        difficulty = item["topic_difficulty"]
-        stats["token_counts_by_difficulty"][difficulty]["total"] += total_tokens
-        stats["token_counts_by_difficulty"][difficulty]["count"] += 1
-        stats["token_counts_by_difficulty"][difficulty]["question_tokens"] = stats["token_counts_by_difficulty"][difficulty].get("question_tokens", 0) + question_tokens
-        stats["token_counts_by_difficulty"][difficulty]["context_tokens"] = stats["token_counts_by_difficulty"][difficulty].get("context_tokens", 0) + context_tokens
-        
-        # Update token counts by arithmeticity
-        is_arithmetic = item.get("is_arithmetic") == '1'
-        arithmetic_key = "arithmetic" if is_arithmetic else "non_arithmetic"
-        
-        # Ensure the arithmetic key exists in token_counts_by_arithmeticity
-        if "token_counts_by_arithmeticity" not in stats:
-            stats["token_counts_by_arithmeticity"] = {}
-        if arithmetic_key not in stats["token_counts_by_arithmeticity"]:
-            stats["token_counts_by_arithmeticity"][arithmetic_key] = {
-                "total": 0,
-                "count": 0,
-                "question_tokens": 0,
-                "context_tokens": 0
-            }
-        
-        # Update token counts for arithmeticity
-        stats["token_counts_by_arithmeticity"][arithmetic_key]["total"] += total_tokens
-        stats["token_counts_by_arithmeticity"][arithmetic_key]["count"] += 1
-        stats["token_counts_by_arithmeticity"][arithmetic_key]["question_tokens"] += question_tokens
-        stats["token_counts_by_arithmeticity"][arithmetic_key]["context_tokens"] += context_tokens
-
-        # Update token counts by subfield
-        subfield = item["subfield"]
-        stats["token_counts_by_subfield"][subfield]["total"] += total_tokens
-        stats["token_counts_by_subfield"][subfield]["count"] += 1
-        stats["token_counts_by_subfield"][subfield]["question_tokens"] = stats["token_counts_by_subfield"][subfield].get("question_tokens", 0) + question_tokens
-        stats["token_counts_by_subfield"][subfield]["context_tokens"] = stats["token_counts_by_subfield"][subfield].get("context_tokens", 0) + context_tokens
-
-        # Update subfield difficulty counts
-        subfield = item["subfield"]
-        difficulty = item["topic_difficulty"]
-        stats["subfield_difficulty_count"][item["language"]][subfield][difficulty] += 1
-
-        # Update language difficulty counts
-        stats["language_difficulty_count"][item["language"]][difficulty] += 1
-
-        # Update question type difficulty counts
-        question_type = item["question_type"]
-        stats["question_type_difficulty_count"][question_type][difficulty] += 1
-
-    # Calculate the average token count for each language
-    for language, token_data in stats["token_counts"].items():
-        total_tokens = token_data["total"]
-        total_questions = token_data["count"]
-        question_tokens = token_data.get("question_tokens", 0)
-        context_tokens = token_data.get("context_tokens", 0)
-        
-        token_data["average_total"] = round(total_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_question"] = round(question_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_context"] = round(context_tokens / total_questions, 2) if total_questions > 0 else 0
-        
-        del token_data["total"]
-        del token_data["count"]
-        del token_data["question_tokens"]
-        del token_data["context_tokens"]
+def _average_tokens(row):
+    """Average total/question/context tokens of a group of questions."""
+    count = int(row["count"])
+    question_tokens = int(row["question_tokens"])
+    context_tokens = int(row["context_tokens"])
+    return {
+        "average_total": round((question_tokens + context_tokens) / count, 2) if count > 0 else 0,
+        "average_question": round(question_tokens / count, 2) if count > 0 else 0,
+        "average_context": round(context_tokens / count, 2) if count > 0 else 0,
+    }
 
-    # Calculate the average token count for all languages
-    total_tokens = stats["total_token_sum"]["total"]
-    total_questions = stats["total_token_sum"]["count"]
-    question_tokens = stats["total_token_sum"].get("question_tokens", 0)
-    context_tokens = stats["total_token_sum"].get("context_tokens", 0)
-    
-    stats["total_token_sum"]["average_total"] = round(total_tokens / total_questions, 2) if total_questions > 0 else 0
-    stats["total_token_sum"]["average_question"] = round(question_tokens / total_questions, 2) if total_questions > 0 else 0
-    stats["total_token_sum"]["average_context"] = round(context_tokens / total_questions, 2) if total_questions > 0 else 0
-    
-    del stats["total_token_sum"]["total"]
-    del stats["total_token_sum"]["count"]
-    del stats["total_token_sum"]["question_tokens"]
-    del stats["total_token_sum"]["context_tokens"]
 
-    # Calculate averages for token counts by question type
-    for question_type, token_data in stats["token_counts_by_question_type"].items():
-        total_tokens = token_data["total"]
-        total_questions = token_data["count"]
-        question_tokens = token_data.get("question_tokens", 0)
-        context_tokens = token_data.get("context_tokens", 0)
-        
-        token_data["average_total"] = round(total_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_question"] = round(question_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_context"] = round(context_tokens / total_questions, 2) if total_questions > 0 else 0
-        
-        del token_data["total"]
-        del token_data["count"]
-        del token_data["question_tokens"]
-        del token_data["context_tokens"]
+def _difficulty_dict(grouped, levels):
+    """
+    Convert a frame grouped by [*levels, topic_difficulty] into nested dictionaries
+    ending with {"easy": .., "medium": .., "hard": ..} counts.
+    """
+    nested = {}
+    for keys, row in grouped.iterrows():
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        current = nested
+        for key in keys[:levels]:
+            current = current.setdefault(_to_key(key), {})
+        if not current:
+            current.update({"easy": 0, "medium": 0, "hard": 0})
+        difficulty = _to_key(keys[levels])
+        current[difficulty] = current.get(difficulty, 0) + int(row["count"])
+    return nested
+
+
+def get_dataset_statistics(data_dir, num_threads=8, use_token_counts=False):
+    """
+    Calculates and saves dataset statistics
 
-    # Calculate averages for token counts by difficulty
-    for difficulty, token_data in stats["token_counts_by_difficulty"].items():
-        total_tokens = token_data["total"]
-        total_questions = token_data["count"]
-        question_tokens = token_data.get("question_tokens", 0)
-        context_tokens = token_data.get("context_tokens", 0)
-        
-        token_data["average_total"] = round(total_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_question"] = round(question_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_context"] = round(context_tokens / total_questions, 2) if total_questions > 0 else 0
-        
-        del token_data["total"]
-        del token_data["count"]
-        del token_data["question_tokens"]
-        del token_data["context_tokens"]
+    The context of every main question is looked up from an index built once, the unique
+    contexts and questions are tokenized in one threaded batch, and all the per-language,
+    difficulty, subfield, question type and arithmetic aggregates are rolled up from a single
+    groupby over the dataset.
 
-    # Calculate averages for token counts by arithmeticity
-    for arithmeticity, token_data in stats["token_counts_by_arithmeticity"].items():
-        total_tokens = token_data["total"]
-        total_questions = token_data["count"]
-        question_tokens = token_data.get("question_tokens", 0)
-        context_tokens = token_data.get("context_tokens", 0)
-        
-        token_data["average_total"] = round(total_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_question"] = round(question_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_context"] = round(context_tokens / total_questions, 2) if total_questions > 0 else 0
-        
-        del token_data["total"]
-        del token_data["count"]
-        del token_data["question_tokens"]
-        del token_data["context_tokens"]
-        
-    # Calculate averages for token counts by subfield
-    for subfield, token_data in stats["token_counts_by_subfield"].items():
-        total_tokens = token_data["total"]
-        total_questions = token_data["count"]
-        question_tokens = token_data.get("question_tokens", 0)
-        context_tokens = token_data.get("context_tokens", 0)
-        
-        token_data["average_total"] = round(total_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_question"] = round(question_tokens / total_questions, 2) if total_questions > 0 else 0
-        token_data["average_context"] = round(context_tokens / total_questions, 2) if total_questions > 0 else 0
-        
-        del token_data["total"]
-        del token_data["count"]
-        del token_data["question_tokens"]
-        del token_data["context_tokens"]
+    Args:
+        data_dir: Path to the release json (or packed release snapshot)
+        num_threads: Number of threads used for tokenization
+        use_token_counts: If True, read the token counts from the sidecar of the release, which is
+            written next to it if missing (see token_utils.precompute_token_counts), tokenizing only
+            the questions that changed
 
-    # Ensure all counts are integers before saving
-    for language, subfields in stats["subfield_difficulty_count"].items():
-        for subfield, difficulties in subfields.items():
-            for difficulty, count in difficulties.items():
-                # Convert count to integer
-                stats["subfield_difficulty_count"][language][subfield][difficulty] = int(count)
+    Returns:
+        Dictionary of statistics, also saved to statistics/summary.json
+    """
+    # read the json files in the data_dir
+    data = load_release(data_dir)
 
-    for language, counts in stats["language_difficulty_count"].items():
-        for difficulty, count in counts.items():
-            stats["language_difficulty_count"][language][difficulty] = int(count)
+    # Context of each question is the context of the first sub-question of its main question
+    context_index = build_context_index(data)
+    contexts = []
+    for item in data:
+        first_sub_question_id = get_first_sub_question_id(item["question_id"])
+        if first_sub_question_id not in context_index:
+            raise ValueError(f"Context not found for question id: {first_sub_question_id}")
+        contexts.append(context_index[first_sub_question_id])
+    questions = [item["question"] for item in data]
+
+    if use_token_counts:
+        release_token_counts = precompute_token_counts(data_dir, num_threads=num_threads, data=data)
+        question_tokens = [release_token_counts.get(item["question_id"])["question_tokens"] for item in data]
+        context_tokens = [release_token_counts.get(item["question_id"])["context_tokens"] for item in data]
+    else:
+        token_counts = count_tokens(contexts + questions, num_threads=num_threads)
+        question_tokens = [token_counts[question] for question in questions]
+        context_tokens = [token_counts[context] for context in contexts]
+
+    df = pd.DataFrame({
+        "language": [item["language"] for item in data],
+        "question_type": [item["question_type"] for item in data],
+        "topic_difficulty": [item["topic_difficulty"] for item in data],
+        "subfield": [item["subfield"] for item in data],
+        "arithmetic": ["arithmetic" if item.get("is_arithmetic") == '1' else "non_arithmetic" for item in data],
+        "has_image_type": ["image_type" in item for item in data],
+        "image_type": [item.get("image_type") for item in data],
+        "has_image": ["image_1" in item and item["image_1"] != 'None' for item in data],
+        "has_multiple_images": ["image_2" in item and item["image_2"] != 'None' for item in data],
+        "has_explanation": [bool("explanation" in item and item["explanation"]) for item in data],
+        "question_tokens": question_tokens,
+        "context_tokens": context_tokens,
+    }, dtype=object)
+    df["question_tokens"] = df["question_tokens"].astype("int64")
+    df["context_tokens"] = df["context_tokens"].astype("int64")
+
+    # One pass over the dataset: every statistic below is a roll-up of this cube.
+    # sort=False keeps groups in order of first appearance, as the statistics used to be accumulated item by item
+    dimensions = ["language", "question_type", "topic_difficulty", "subfield", "arithmetic",
+                  "has_image_type", "image_type", "has_image", "has_multiple_images", "has_explanation"]
+    cube = df.groupby(dimensions, sort=False, dropna=False).agg(
+        count=("question_tokens", "size"),
+        question_tokens=("question_tokens", "sum"),
+        context_tokens=("context_tokens", "sum"),
+    ).reset_index()
+
+    def rollup(by, mask=None):
+        frame = cube if mask is None else cube[mask]
+        return frame.groupby(by, sort=False, dropna=False)[["count", "question_tokens", "context_tokens"]].sum()
+
+    arithmetic_mask = cube["arithmetic"] == "arithmetic"
+    image_type_count = _count_dict(rollup("image_type", cube["has_image_type"].astype(bool)))
+    subfield_count = _count_dict(rollup("subfield"))
+    image_count = int(cube.loc[cube["has_image"].astype(bool), "count"].sum())
 
-    for question_type, counts in stats["question_type_difficulty_count"].items():
-        for difficulty, count in counts.items():
-            stats["question_type_difficulty_count"][question_type][difficulty] = int(count)
+    stats = {
+        "total_count": len(data),
+        "total_main_question_count": 0,
+        "unique_main_question_ids": {item["main_question_id"] for item in data if "main_question_id" in item},
+        "language_count": _count_dict(rollup("language")),
+        "question_type_count": _count_dict(rollup("question_type")),
+        "image_type_count": image_type_count,
+        "image_type_set": set(image_type_count.keys()),
+        "subfield_count": subfield_count,
+        "subfield_set": set(subfield_count.keys()),
+        "topic_difficulty_count": _count_dict(rollup("topic_difficulty")),
+        "explanation_count": int(cube.loc[cube["has_explanation"].astype(bool), "count"].sum()),
+        "multiple_images_count": int(cube.loc[cube["has_multiple_images"].astype(bool), "count"].sum()),
+        "arithmetic_count": int(cube.loc[arithmetic_mask, "count"].sum()),
+        "arithmetic_by_language": _count_dict(rollup("language", arithmetic_mask)),
+        "arithmetic_by_difficulty": _count_dict(rollup("topic_difficulty", arithmetic_mask)),
+        "token_counts": _token_dict(rollup("language")),
+        "subfield_difficulty_count": _difficulty_dict(rollup(["language", "subfield", "topic_difficulty"]), levels=2),
+        "total_token_sum": _average_tokens(cube[["count", "question_tokens", "context_tokens"]].sum()),
+        "language_difficulty_count": _difficulty_dict(rollup(["language", "topic_difficulty"]), levels=1),
+        "question_type_difficulty_count": _difficulty_dict(rollup(["question_type", "topic_difficulty"]), levels=1),
+        "token_counts_by_question_type": _token_dict(rollup("question_type")),
+        "token_counts_by_difficulty": _token_dict(rollup("topic_difficulty")),
+        "token_counts_by_subfield": _token_dict(rollup("subfield")),
+        "token_counts_by_arithmeticity": _token_dict(rollup("arithmetic")),
+    }
+    if image_count > 0:
+        stats["image_count"] = image_count
 
     # Update the total_main_question_count with the size of the set
     stats["total_main_question_count"] = len(stats["unique_main_question_ids"])
@@ -294,4 +173,3 @@ def get_dataset_statistics(data_dir):
 
     # Return the statistics
     return stats
-
@@ -1,5 +1,45 @@
+import math
+import re
+import threading
+import unicodedata
+import warnings
+
+import numpy as np
 import pandas as pd
 
+from famma_runner.utils.data_const import DatasetColumns as DC
+from famma_runner.utils.data_const import LANGUAGE_ORDER
+
+# Subsets of the evaluated questions that are analyzed separately: name -> (column, value), None for all questions
+ANALYSIS_TYPES = {
+    'consolidated': None,
+    'arithmetic': (DC.IS_ARITHMETIC, '1'),
+    'no_arithmetic': (DC.IS_ARITHMETIC, '0'),
+}
+
+# Dimensions of the accuracy cube, every breakdown below is rolled up from it
+CUBE_DIMENSIONS = [DC.LANGUAGE, DC.TOPIC_DIFFICULTY, DC.SUBFIELD, DC.QUESTION_TYPE]
+
+# Accuracy tables of each analysis type: metric name -> dimensions to break down by (None for the overall accuracy)
+BREAKDOWNS = {
+    'overall_acc': None,
+    'overall_acc_by_subfield': [DC.SUBFIELD],
+    'overall_acc_by_difficulty': [DC.TOPIC_DIFFICULTY],
+    'overall_acc_by_language': [DC.LANGUAGE],
+    'overall_acc_by_question_type': [DC.QUESTION_TYPE],
+}
+
+# Accuracy tables computed for every language in LANGUAGE_ORDER, '{language}' is filled in the metric name
+LANGUAGE_BREAKDOWNS = {
+    'overall_acc_by_difficulty_{language}': [DC.TOPIC_DIFFICULTY],
+}
+
+
+def to_correct_flag(value):
+    """Map the judge verdict stored in 'is_correct_by_model' to 1 (correct) or 0 (incorrect)."""
+    return 1 if value == 'correct' or value is True else 0
+
+
 def calculate_accuracy(df, target_col='is_correct_by_model', group_by=None):
         """Calculate accuracy of the model's answers."""
         if group_by:
@@ -17,4 +57,411 @@ def calculate_accuracy(df, target_col='is_correct_by_model', group_by=None):
             accuracy = {k: float(v) for k, v in accuracy.items()}
         else:
             accuracy = float(accuracy)
-        return accuracy
\ No newline at end of file
+        return accuracy
+
+def build_accuracy_cube(df, dimensions, target_col='is_correct_by_model'):
+    """
+    Count correct answers and questions for every combination of the dimensions in a single groupby.
+    Any accuracy breakdown over a subset of the dimensions can then be rolled up from the cube
+    with accuracy_from_cube, without filtering the original frame again.
+
+    Args:
+        df: DataFrame with one row per question and a 0/1 target column
+        dimensions: Columns to group by, e.g. ['language', 'topic_difficulty', 'subfield']
+        target_col: Column holding 1 for a correct answer and 0 otherwise
+
+    Returns:
+        DataFrame indexed by the dimensions with 'correct' and 'total' columns
+    """
+    cube = df.groupby(dimensions, dropna=False)[target_col].agg(['sum', 'count'])
+    return cube.rename(columns={'sum': 'correct', 'count': 'total'})
+
+
+def accuracy_from_cube(cube, group_by=None, where=None):
+    """
+    Roll an accuracy cube up to the accuracy (optionally per group), in the same format as calculate_accuracy.
+
+    Args:
+        cube: Output of build_accuracy_cube
+        group_by: Optional list of cube dimensions to break the accuracy down by
+        where: Optional dict {dimension: value} restricting the cube to a slice before rolling up
+
+    Returns:
+        float accuracy, or dict mapping group keys to accuracies
+    """
+    if where:
+        for level, value in where.items():
+            values = cube.index.get_level_values(level)
+            cube = cube[values == value]
+
+    if not group_by:
+        correct, total = cube['correct'].sum(), cube['total'].sum()
+        return float(correct / total) if total > 0 else float('nan')
+
+    # Groups with missing keys are dropped, as in DataFrame.groupby
+    rolled = cube.groupby(level=group_by).sum()
+    rolled = rolled[rolled['total'] > 0]
+    accuracy = {}
+    for key, row in rolled.iterrows():
+        if isinstance(key, tuple):
+            # Convert tuple keys to string keys if grouping by multiple columns
+            key = str(key[0]) + "_" + str(key[1]) if len(key) > 1 else key[0]
+        accuracy[key] = float(row['correct'] / row['total'])
+    return accuracy
+
+
+def count_from_cube(cube, group_by):
+    """Number of questions per group of the cube, e.g. per language."""
+    rolled = cube.groupby(level=group_by)['total'].sum()
+    return {key: int(total) for key, total in rolled.items()}
+
+
+def format_group_key(key):
+    """Format a group key the same way calculate_accuracy does."""
+    if isinstance(key, tuple):
+        return str(key[0]) + "_" + str(key[1]) if len(key) > 1 else key[0]
+    return key
+
+
+def cluster_bootstrap_weights(num_clusters, n_resamples, seed=0, max_cells=2 ** 22):
+    """
+    Yield bootstrap resamples of clusters in chunks, as matrices W (resamples x clusters) holding how
+    many times each cluster is drawn in each resample. At most max_cells entries are held at once.
+    """
+    rng = np.random.default_rng(seed)
+    chunk_size = max(1, min(n_resamples, max_cells // max(num_clusters, 1)))
+    for start in range(0, n_resamples, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+        resample_idx = rng.integers(0, num_clusters, size=(size, num_clusters))
+        offsets = (np.arange(size) * num_clusters)[:, None]
+        W = np.bincount((resample_idx + offsets).ravel(), minlength=size * num_clusters)
+        yield W.reshape(size, num_clusters).astype(np.float64)
+
+
+def clustered_bootstrap_ci(df, breakdowns, cluster_by, target_col='is_correct_by_model', n_resamples=10000,
+                           confidence_level=0.95, seed=0, max_cells=2 ** 22):
+    """
+    Percentile bootstrap confidence intervals of accuracies, resampling whole clusters of rows
+    (e.g. all sub-questions of a main question, as they share the same context).
+
+    The resampling is vectorized: each chunk of resamples is a matrix of cluster indices, turned into
+    per-cluster counts W (resamples x clusters). With S and N the per-cluster correct and question counts
+    of every group of every breakdown (clusters x groups), the resampled accuracies of all groups are W@S / W@N.
+
+    Args:
+        df: DataFrame with one row per question and a 0/1 target column
+        breakdowns: Dict metric name -> (group_by, where), group_by is a list of columns or None for the
+            overall accuracy, where an optional dict {column: value} restricting the rows
+        cluster_by: Columns identifying a cluster, e.g. ['language', 'main_question_id']
+        target_col: Column holding 1 for a correct answer and 0 otherwise
+        n_resamples: Number of bootstrap resamples
+        confidence_level: Confidence level of the intervals
+        seed: Seed of the random generator
+        max_cells: Upper bound on resamples x clusters held in memory at once
+
+    Returns:
+        Dict metric name -> [low, high] for the overall accuracy, or {group key: [low, high]} for a breakdown,
+        with the same keys as calculate_accuracy
+    """
+    cluster_codes = df.groupby(cluster_by, dropna=False, sort=False).ngroup().to_numpy()
+    num_clusters = int(cluster_codes.max()) + 1 if len(cluster_codes) else 0
+    correct = df[target_col].to_numpy(dtype=np.float64)
+
+    # Per-cluster correct/total counts of all groups of all breakdowns, side by side
+    columns, layout = [], {}
+    for metric_name, (group_by, where) in breakdowns.items():
+        mask = np.ones(len(df), dtype=bool)
+        for column, value in (where or {}).items():
+            mask &= (df[column] == value).to_numpy()
+        if group_by:
+            grouped = df[mask].groupby(group_by, sort=True)
+            group_codes, keys = grouped.ngroup().to_numpy(), [format_group_key(k) for k in grouped.size().index]
+        else:
+            group_codes, keys = np.zeros(int(mask.sum()), dtype=np.int64), None
+        layout[metric_name] = (len(columns), keys)
+        num_groups = len(keys) if keys is not None else 1
+        # Rows with missing group keys have no group code and are left out, as in DataFrame.groupby
+        valid = np.nan_to_num(group_codes, nan=-1) >= 0
+        flat = cluster_codes[mask][valid] * num_groups + group_codes[valid].astype(np.int64)
+        size = num_clusters * num_groups
+        sums = np.bincount(flat, weights=correct[mask][valid], minlength=size).reshape(num_clusters, num_groups)
+        counts = np.bincount(flat, minlength=size).reshape(num_clusters, num_groups)
+        columns.extend(zip(sums.T, counts.T))
+
+    if not columns or num_clusters == 0:
+        return {metric_name: ([float('nan')] * 2 if keys is None else {}) for metric_name, (_, keys) in layout.items()}
+
+    S = np.stack([column[0] for column in columns], axis=1)
+    N = np.stack([column[1] for column in columns], axis=1).astype(np.float64)
+
+    accuracies = []
+    for W in cluster_bootstrap_weights(num_clusters, n_resamples, seed=seed, max_cells=max_cells):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            accuracies.append((W @ S) / (W @ N))
+    accuracies = np.concatenate(accuracies, axis=0)
+
+    alpha = (1 - confidence_level) / 2
+    with warnings.catch_warnings():
+        # Groups may be empty in every resample only if they are empty in the data
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        low, high = np.nanpercentile(accuracies, [100 * alpha, 100 * (1 - alpha)], axis=0)
+
+    intervals = {}
+    for metric_name, (offset, keys) in layout.items():
+        if keys is None:
+            intervals[metric_name] = [float(low[offset]), float(high[offset])]
+        else:
+            intervals[metric_name] = {key: [float(low[offset + i]), float(high[offset + i])]
+                                      for i, key in enumerate(keys)}
+    return intervals
+
+
+def pairwise_mcnemar(correct_matrix):
+    """
+    McNemar tests (with continuity correction) between every pair of models.
+
+    Args:
+        correct_matrix: int8 array (models x questions) with 1 for correct, 0 for incorrect
+            and -1 for questions a model was not evaluated on
+
+    Returns:
+        Tuple (discordant, p_values) of (models x models) arrays, discordant[i, j] being the number of
+        questions model i answered correctly and model j did not. Pairs without discordant questions get p=1.
+    """
+    correct = (correct_matrix == 1).astype(np.float64)
+    incorrect = (correct_matrix == 0).astype(np.float64)
+    # Only questions evaluated for both models can be counted, as incorrect excludes missing ones
+    discordant = correct @ incorrect.T
+    b, c = discordant, discordant.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistic = np.where(b + c > 0, (np.abs(b - c) - 1).clip(min=0) ** 2 / (b + c), 0.0)
+    # Survival function of the chi-squared distribution with one degree of freedom
+    p_values = np.vectorize(math.erfc)(np.sqrt(statistic / 2))
+    return discordant.astype(np.int64), p_values
+
+
+class StreamingAccuracy:
+    """
+    Running accuracy of evaluated questions, updated one record at a time.
+
+    For every analysis type and breakdown it keeps [correct, total] counts per group, so an update is a
+    constant number of dictionary increments and a snapshot of the metrics can be taken at any time,
+    in the same layout as the metrics of the Analyzer.
+
+    Example:
+        >>> tracker = StreamingAccuracy(total_questions=len(gold_df))
+        >>> tracker.update(data_to_save)
+        >>> tracker.snapshot()['metrics']['consolidated']['overall_acc']
+    """
+
+    def __init__(self, total_questions=None):
+        self.total_questions = total_questions
+        # analysis type -> metric name -> group key (None for the overall accuracy) -> [correct, total]
+        self.counts = {analysis_type: {} for analysis_type in ANALYSIS_TYPES}
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    @property
+    def num_records(self):
+        return len(self._seen)
+
+    @staticmethod
+    def _group_key(record, group_by):
+        values = [record.get(column) for column in group_by]
+        # Records with missing keys belong to no group, as in DataFrame.groupby
+        if any(value is None or (isinstance(value, float) and math.isnan(value)) for value in values):
+            return None
+        return format_group_key(tuple(values))
+
+    def _add(self, analysis_type, metric_name, key, correct):
+        counts = self.counts[analysis_type].setdefault(metric_name, {}).setdefault(key, [0, 0])
+        counts[0] += correct
+        counts[1] += 1
+
+    def update(self, record):
+        """
+        Count an evaluated record. Records are identified by question_id and only counted once.
+
+        Returns:
+            True if the record was counted, False if it had been counted before
+        """
+        correct = to_correct_flag(record.get('is_correct_by_model'))
+        language = record.get(DC.LANGUAGE)
+        with self._lock:
+            if record.get(DC.QUESTION_ID) in self._seen:
+                return False
+            self._seen.add(record.get(DC.QUESTION_ID))
+
+            for analysis_type, condition in ANALYSIS_TYPES.items():
+                if condition is not None and record.get(condition[0]) != condition[1]:
+                    continue
+                for metric_name, group_by in BREAKDOWNS.items():
+                    if group_by is None:
+                        self._add(analysis_type, metric_name, None, correct)
+                        continue
+                    key = self._group_key(record, group_by)
+                    if key is not None:
+                        self._add(analysis_type, metric_name, key, correct)
+                if language not in LANGUAGE_ORDER:
+                    continue
+                for metric_name, group_by in LANGUAGE_BREAKDOWNS.items():
+                    key = self._group_key(record, group_by)
+                    if key is not None:
+                        self._add(analysis_type, metric_name.format(language=language), key, correct)
+        return True
+
+    def accuracy(self, analysis_type='consolidated', metric_name='overall_acc'):
+        """Current accuracy of a metric, a float for the overall accuracy and a dict for a breakdown."""
+        counts = self.counts[analysis_type].get(metric_name, {})
+        if metric_name in BREAKDOWNS and BREAKDOWNS[metric_name] is None:
+            correct, total = counts.get(None, [0, 0])
+            return correct / total if total > 0 else float('nan')
+        return {key: correct / total for key, (correct, total) in sorted(counts.items(), key=lambda kv: str(kv[0]))}
+
+    def snapshot(self):
+        """Current progress and metrics of every analysis type."""
+        with self._lock:
+            metrics = {}
+            for analysis_type in ANALYSIS_TYPES:
+                by_language = self.counts[analysis_type].get('overall_acc_by_language', {})
+                current_metrics = {
+                    'total_questions': self.counts[analysis_type].get('overall_acc', {}).get(None, [0, 0])[1]}
+                for language in LANGUAGE_ORDER:
+                    current_metrics[f'total_{language}_questions'] = by_language.get(language, [0, 0])[1]
+                for metric_name in BREAKDOWNS:
+                    current_metrics[metric_name] = self.accuracy(analysis_type, metric_name)
+                for language in LANGUAGE_ORDER:
+                    for metric_name in LANGUAGE_BREAKDOWNS:
+                        metric_name = metric_name.format(language=language)
+                        current_metrics[metric_name] = self.accuracy(analysis_type, metric_name)
+                metrics[analysis_type] = current_metrics
+
+            return {
+                'num_records': self.num_records,
+                'total_questions': self.total_questions,
+                'progress': self.num_records / self.total_questions if self.total_questions else None,
+                'metrics': metrics,
+            }
+
+    def is_below(self, min_accuracy, min_progress=0.05):
+        """
+        Check whether the overall accuracy is below min_accuracy once at least min_progress
+        of the questions have been evaluated. Never true if the total number of questions is unknown.
+        """
+        if min_accuracy is None:
+            return False
+        progress = self.num_records / self.total_questions if self.total_questions else 0
+        if progress < min_progress:
+            return False
+        accuracy = self.accuracy()
+        return not math.isnan(accuracy) and accuracy < min_accuracy
+
+
+# Option letters of a multiple-choice answer, e.g. 'B', '(B)', 'B. Stock market', 'A, C'
+_OPTION_LETTER_PATTERN = re.compile(r'(?<![A-Za-z])\(?([A-H])\)?(?=[\s.,:;、)）]|$)')
+_NUMBER_PATTERN = re.compile(r'-?\d+(?:\.\d+)?%?')
+
+
+def _normalize_answer_text(text):
+    # Sign, decimal point and percent are kept: '-12' and '12' or '3.5' and '35' are different answers
+    text = unicodedata.normalize('NFKC', str(text)).lower()
+    return re.sub(r'[^\w.%-]+|_', '', text).strip('.')
+
+
+def _extract_option_letters(text):
+    """Option letters of an answer, only if the answer starts with an option."""
+    text = unicodedata.normalize('NFKC', str(text)).strip()
+    if not re.match(r'^\(?[A-H]\)?(?:[\s.,:;、)）]|$)', text):
+        return set()
+    return set(_OPTION_LETTER_PATTERN.findall(text.split('.')[0] if '.' in text[:3] else text))
+
+
+def _extract_numbers(text):
+    numbers = []
+    for match in _NUMBER_PATTERN.findall(unicodedata.normalize('NFKC', str(text)).replace(',', '')):
+        value = float(match.rstrip('%'))
+        numbers.append((value, match.endswith('%')))
+    return numbers
+
+
+def _numbers_match(gold, candidate, rel_tol):
+    gold_value, gold_percent = gold
+    candidate_value, candidate_percent = candidate
+    values = [candidate_value]
+    # 5% and 0.05 are the same answer
+    if gold_percent != candidate_percent:
+        values += [candidate_value * 100, candidate_value / 100]
+    return any(math.isclose(gold_value, value, rel_tol=rel_tol, abs_tol=1e-9) for value in values)
+
+
+def judge_answer_locally(model_answer, gold_answer, question_type, rel_tol=1e-2):
+    """
+    Rule-based approximation of the judge prompt, to check answers without calling a model.
+
+    Multiple-choice answers are correct if they select the same options as the ground truth (by letter
+    or by option text). Open-ended answers with numbers in the ground truth are correct if the numbers of
+    the answer and of the ground truth match each other (within rel_tol, percentages and fractions are
+    interchangeable): every gold number is in the answer and the answer has no other number, so that
+    answers listing several candidate values are rejected. For ground truths without numbers, the answer
+    is correct if it contains the normalized ground truth.
+
+    Args:
+        model_answer: The answer of the model
+        gold_answer: The ground-truth answer
+        question_type: 'multiple-choice' or 'open question'
+        rel_tol: Relative tolerance when comparing numbers
+
+    Returns:
+        True if the answer is judged correct
+
+    Examples:
+        >>> judge_answer_locally('3.5', '3.5', 'open question')
+        True
+        >>> judge_answer_locally('35', '3.5', 'open question')
+        False
+        >>> judge_answer_locally('-12', '12', 'open question')
+        False
+        >>> judge_answer_locally('1.05', '105', 'open question')
+        False
+        >>> judge_answer_locally('5%', '0.05', 'open question')
+        True
+        >>> judge_answer_locally('5% (0.05)', '5%', 'open question')
+        True
+        >>> judge_answer_locally('Year 2020: 5', '5', 'open question')
+        False
+        >>> judge_answer_locally('Either 3, 5 or 7', '5', 'open question')
+        False
+        >>> judge_answer_locally('NPV = 12.5, IRR = 8%', '12.5; 8%', 'open question')
+        True
+        >>> judge_answer_locally('B. Stock market', 'B', 'multiple-choice')
+        True
+    """
+    if model_answer is None or gold_answer is None:
+        return False
+    if isinstance(model_answer, (list, tuple)):
+        model_answer = ', '.join(str(answer) for answer in model_answer)
+    if isinstance(gold_answer, (list, tuple)):
+        gold_answer = ', '.join(str(answer) for answer in gold_answer)
+    model_text, gold_text = _normalize_answer_text(model_answer), _normalize_answer_text(gold_answer)
+    if not model_text or not gold_text:
+        return False
+    if model_text == gold_text:
+        return True
+
+    if 'multiple' in str(question_type).lower():
+        gold_letters = _extract_option_letters(gold_answer)
+        model_letters = _extract_option_letters(model_answer)
+        if gold_letters and model_letters:
+            return gold_letters == model_letters
+        # Compare the option text, e.g. 'Stock market' for 'A. Stock market'
+        gold_content = _normalize_answer_text(re.sub(r'^\(?[A-H]\)?[.:)）]?\s*', '', str(gold_answer).strip()))
+        return bool(gold_content) and gold_content == model_text
+
+    gold_numbers = _extract_numbers(gold_answer)
+    if gold_numbers:
+        model_numbers = _extract_numbers(model_answer)
+        return all(any(_numbers_match(gold, candidate, rel_tol) for candidate in model_numbers)
+                   for gold in gold_numbers) and \
+            all(any(_numbers_match(gold, candidate, rel_tol) for gold in gold_numbers)
+                for candidate in model_numbers)
+    return gold_text in model_text
@@ -0,0 +1,329 @@
+import asyncio
+import concurrent.futures
+import itertools
+import multiprocessing as mp
+import pickle
+import queue
+import sys
+import threading
+import traceback
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+import tqdm
+from easyllm_kit.utils import get_logger
+from registrable import Registrable
+
+logger = get_logger('executor_utils', 'executor_utils.log')
+
+DEFAULT_BACKEND = 'threads'
+
+_FEED_DONE = object()
+
+
+def get_execution_config(config) -> Dict:
+    """
+    Backend and number of workers of the model calls from the `execution` section of a runner config.
+    max_workers falls back to data.num_workers for configs written before the section existed.
+    """
+    execution_config = dict(config.get('execution') or {})
+    data_config = config.get('data') or {}
+    max_workers = execution_config.get('max_workers') or data_config.get('num_workers', 1) or 1
+    return {'backend': str(execution_config.get('backend') or DEFAULT_BACKEND).lower(),
+            'max_workers': max(1, int(max_workers))}
+
+
+class TaskOutcome:
+    """Result of one task run by an Executor: the result, or the exception and its formatted traceback."""
+
+    __slots__ = ('index', 'task', 'result', 'error', 'traceback')
+
+    def __init__(self, index: int, task: Any, result: Any = None, error: Optional[BaseException] = None,
+                 traceback: Optional[str] = None):
+        self.index = index
+        self.task = task
+        self.result = result
+        self.error = error
+        self.traceback = traceback
+
+    def is_success(self) -> bool:
+        return self.error is None
+
+
+class Executor(Registrable):
+    """
+    Run a function over tasks with at most max_workers of them in flight, on the backend of the subclass.
+
+    map pulls the tasks lazily, so an iterable that blocks (e.g. a queue) or never ends is fine, and yields
+    a TaskOutcome per task in completion order. Exceptions of the tasks are captured in the outcomes, never
+    raised by map. cancel() stops the submission of new tasks, those in flight still complete.
+
+    A plain map starts the workers and shuts them down when it ends. Used as a context manager, the executor
+    keeps its workers across map calls until it is closed, e.g. for many small maps from the same thread.
+
+    Backends are registered by name and picked from the `execution` section of the configs:
+    `threads` for blocking calls, `async` for coroutine functions (blocking functions are run in the thread
+    pool of the event loop) and `processes` for CPU-bound work, which needs a picklable function.
+
+    Example:
+        >>> executor = Executor.build('threads', max_workers=8, use_progress_bar=True)
+        >>> for outcome in executor.map(call_model, prompts):
+        ...     if not outcome.is_success():
+        ...         logger.error(outcome.traceback)
+    """
+
+    # The function is bound to the workers when they start (processes), a map of another function restarts them
+    binds_func = False
+
+    def __init__(self, max_workers: int = 1, use_progress_bar: bool = False, desc: Optional[str] = None):
+        self.max_workers = max(1, int(max_workers))
+        self.use_progress_bar = use_progress_bar
+        self.desc = desc
+        # State of the current map, a feeder of an earlier map keeps its own
+        self._cancelled = threading.Event()
+        self._slots = None
+        self._persistent = False
+        self._started_func = None
+        self._started = False
+
+    def __enter__(self):
+        self._persistent = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Shut the workers down, tasks left running by an early-stopped map are not waited for."""
+        self._persistent = False
+        if self._started:
+            self.cancel()
+            self._shutdown(wait=False)
+            self._started = False
+
+    @staticmethod
+    def build(backend: str = DEFAULT_BACKEND, **kwargs) -> "Executor":
+        if not Executor.is_registered(backend.lower()):
+            raise ValueError(f"Unknown execution backend {backend}, choose from {sorted(Executor.list_available())}")
+        return Executor.by_name(backend.lower())(**kwargs)
+
+    @staticmethod
+    def build_from_config(config, **kwargs) -> "Executor":
+        execution_config = get_execution_config(config)
+        return Executor.build(execution_config['backend'], max_workers=execution_config['max_workers'], **kwargs)
+
+    def _start(self, func: Callable):
+        """Prepare the backend for a map call."""
+        raise NotImplementedError
+
+    def _submit(self, func: Callable, task: Any) -> concurrent.futures.Future:
+        raise NotImplementedError
+
+    def _shutdown(self, wait: bool):
+        raise NotImplementedError
+
+    def cancel(self):
+        """Stop submitting tasks, the tasks in flight still complete."""
+        self._cancelled.set()
+        if self._slots is not None:
+            # Wake up the feeder if it waits for a free slot
+            for _ in range(self.max_workers):
+                self._slots.release()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def _feed(self, func: Callable, tasks: Iterable, outcomes: queue.Queue, cancelled: threading.Event,
+              slots: threading.Semaphore):
+        num_submitted = 0
+        try:
+            tasks = iter(tasks)
+            for index in itertools.count():
+                # Wait for a free slot before pulling the task, so that no task is taken from the source
+                # once the map is cancelled
+                slots.acquire()
+                if cancelled.is_set():
+                    break
+                try:
+                    task = next(tasks)
+                except StopIteration:
+                    break
+                num_submitted += 1
+                if cancelled.is_set():
+                    # Cancelled while the source blocked, the task gets an outcome rather than being lost
+                    outcomes.put(TaskOutcome(index, task, error=concurrent.futures.CancelledError()))
+                    break
+                try:
+                    future = self._submit(func, task)
+                except Exception as e:
+                    outcomes.put(TaskOutcome(index, task, error=e, traceback=traceback.format_exc()))
+                else:
+                    future.add_done_callback(lambda f, index=index, task=task: outcomes.put((index, task, f)))
+        except Exception as e:
+            logger.error(f"Error while pulling tasks: {str(e)}")
+            outcomes.put(TaskOutcome(num_submitted, None, error=e, traceback=traceback.format_exc()))
+            num_submitted += 1
+        finally:
+            outcomes.put((_FEED_DONE, num_submitted))
+
+    @staticmethod
+    def _to_outcome(index: int, task: Any, future: concurrent.futures.Future) -> TaskOutcome:
+        if future.cancelled():
+            return TaskOutcome(index, task, error=concurrent.futures.CancelledError())
+        error = future.exception()
+        if error is None:
+            return TaskOutcome(index, task, result=future.result())
+        return TaskOutcome(index, task, error=error,
+                           traceback=''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+    def map(self, func: Callable, tasks: Iterable) -> Iterator[TaskOutcome]:
+        """Run func on every task, yielding the outcomes as they complete."""
+        self._cancelled = cancelled = threading.Event()
+        self._slots = slots = threading.Semaphore(self.max_workers)
+        outcomes = queue.Queue()
+        total = len(tasks) if hasattr(tasks, '__len__') else None
+        pbar = tqdm.tqdm(desc=self.desc, total=total, dynamic_ncols=True, file=sys.stdout) \
+            if self.use_progress_bar else None
+
+        if self._started and self.binds_func and func != self._started_func:
+            self._shutdown(wait=True)
+            self._started = False
+        if not self._started:
+            self._start(func)
+            self._started, self._started_func = True, func
+        feeder = threading.Thread(target=self._feed, args=(func, tasks, outcomes, cancelled, slots), daemon=True,
+                                  name=f'{type(self).__name__}-feeder')
+        feeder.start()
+
+        num_submitted, num_done, num_failed = None, 0, 0
+        finished = False
+        try:
+            while num_submitted is None or num_done < num_submitted:
+                item = outcomes.get()
+                if isinstance(item, tuple) and item[0] is _FEED_DONE:
+                    num_submitted = item[1]
+                    continue
+                outcome = item if isinstance(item, TaskOutcome) else self._to_outcome(*item)
+                num_done += 1
+                num_failed += not outcome.is_success()
+                slots.release()
+                if pbar is not None:
+                    pbar.update(1)
+                    pbar.set_postfix(failed=num_failed)
+                yield outcome
+            finished = True
+        finally:
+            # Reached when the caller stops iterating early: nothing new is submitted, and the tasks
+            # in flight are left to finish in the background
+            cancelled.set()
+            for _ in range(self.max_workers):
+                slots.release()
+            if not self._persistent:
+                self._shutdown(wait=finished)
+                self._started = False
+            if pbar is not None:
+                pbar.close()
+
+
+@Executor.register('threads')
+class ThreadExecutor(Executor):
+    """Tasks run in a thread pool, for blocking I/O such as API requests."""
+
+    def _start(self, func):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                           thread_name_prefix='executor')
+
+    def _submit(self, func, task):
+        return self._pool.submit(func, task)
+
+    def _shutdown(self, wait):
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+# Function of the process worker, sent once per worker by the pool initializer instead of with every task
+_process_func = None
+
+
+def _init_process_worker(func, initializer, initargs):
+    global _process_func
+    _process_func = func
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _call_process_func(task):
+    return _process_func(task)
+
+
+@Executor.register('processes')
+class ProcessExecutor(Executor):
+    """
+    Tasks run in spawned worker processes, for CPU-bound work. The function (e.g. a bound method with its
+    object) is pickled once per worker rather than once per task, and only the tasks travel to the workers.
+    """
+
+    binds_func = True
+
+    def __init__(self, max_workers: int = 1, use_progress_bar: bool = False, desc: Optional[str] = None,
+                 initializer: Optional[Callable] = None, initargs: tuple = ()):
+        super().__init__(max_workers, use_progress_bar, desc)
+        self.initializer = initializer
+        self.initargs = initargs
+
+    def _start(self, func):
+        try:
+            pickle.dumps(func)
+        except Exception as e:
+            raise ValueError(f"The processes backend needs a picklable function, {func} is not: {str(e)}") from e
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                            mp_context=mp.get_context('spawn'),
+                                                            initializer=_init_process_worker,
+                                                            initargs=(func, self.initializer, self.initargs))
+
+    def _submit(self, func, task):
+        return self._pool.submit(_call_process_func, task)
+
+    def _shutdown(self, wait):
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+@Executor.register('async')
+class AsyncExecutor(Executor):
+    """
+    Tasks run as coroutines on an event loop in a background thread, at most max_workers at once.
+    Blocking functions are run in the thread pool of the loop, coroutine functions are awaited directly.
+    """
+
+    def _start(self, func):
+        self._loop = asyncio.new_event_loop()
+        self._default_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                       thread_name_prefix='executor')
+        self._loop.set_default_executor(self._default_executor)
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True, name='executor-loop')
+        self._thread.start()
+
+    @staticmethod
+    async def _run(func, task):
+        if asyncio.iscoroutinefunction(func):
+            return await func(task)
+        return await asyncio.to_thread(func, task)
+
+    def _submit(self, func, task):
+        return asyncio.run_coroutine_threadsafe(self._run(func, task), self._loop)
+
+    def _shutdown(self, wait):
+        loop = self._loop
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        # Coroutines still running (the map stopped early) are cancelled and run to their end,
+        # blocking functions left in the thread pool finish in the background
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        if wait:
+            loop.run_until_complete(loop.shutdown_default_executor())
+        else:
+            self._default_executor.shutdown(wait=False, cancel_futures=True)
+        loop.close()
@@ -0,0 +1,194 @@
+import glob
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from easyllm_kit.utils import get_logger, read_json
+
+from famma_runner.utils.compress_utils import load_store
+from famma_runner.utils.data_const import ReasoningColumns as RDC
+from famma_runner.utils.plan_utils import estimate_token_counts
+
+logger = get_logger('filter_utils', 'filter_utils.log')
+
+# Reason codes of rejected traces, in the order they are reported
+REASON_EMPTY_ANSWER = 'empty_answer'
+REASON_TRUNCATED = 'truncated'
+REASON_LANGUAGE_MISMATCH = 'language_mismatch'
+REASON_DUPLICATE = 'duplicate'
+REASON_TOO_SHORT = 'too_short'
+REASON_TOO_LONG = 'too_long'
+REASON_INCORRECT = 'incorrect'
+
+# Tags of the distillation prompt, every opened tag must be closed in a complete trace
+TRACE_TAGS = ['think', 'python', 'search', 'information', 'answer']
+
+DEFAULT_FILTER_CONFIG = {
+    'min_tokens': 200,
+    'max_tokens': 16000,
+    # Share of CJK characters above which a trace is considered Chinese
+    'min_cjk_ratio': 0.1,
+    # Characters of each trace used for language identification
+    'language_id_chars': 2000,
+    # Reject traces whose answer was judged incorrect by the local rules (if the store has the verdict)
+    'require_correct': False,
+    # Treat traces without a closing </answer> tag as truncated
+    'require_answer_tag': True,
+    'tokenizer_name': 'cl100k_base',
+}
+
+_CJK_PATTERN = '[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]'
+_ENGLISH_MARKERS = r'\b(?:the|and|is|are|of|to|that|this|with|for|we|it)\b'
+_FRENCH_MARKERS = r'\b(?:le|la|les|des|est|sont|une|du|que|pour|dans|nous|et|avec)\b'
+
+
+def load_trace_store(data_dir: str) -> pd.DataFrame:
+    """Load a distillation store ({question_id: record}) into a DataFrame, one row per trace."""
+    store = load_store(data_dir)
+    df = pd.DataFrame.from_dict(store, orient='index')
+    df.index.name = 'store_key'
+    return df.reset_index()
+
+
+def identify_language(texts: pd.Series, min_cjk_ratio: float = 0.1, num_chars: int = 2000) -> pd.Series:
+    """
+    Cheap language identification of texts as 'chinese', 'french' or 'english': Chinese if enough
+    characters are CJK, otherwise French or English by counting common function words.
+    """
+    head = texts.fillna('').astype(str).str.slice(0, num_chars)
+    lengths = head.str.len().replace(0, 1)
+    cjk_ratio = head.str.count(_CJK_PATTERN) / lengths
+    lowered = head.str.lower()
+    french = lowered.str.count(_FRENCH_MARKERS)
+    english = lowered.str.count(_ENGLISH_MARKERS)
+    language = np.where(cjk_ratio >= min_cjk_ratio, 'chinese', np.where(french > english, 'french', 'english'))
+    return pd.Series(language, index=texts.index)
+
+
+def compute_reject_masks(df: pd.DataFrame, config: Optional[Dict] = None) -> Dict[str, pd.Series]:
+    """
+    Compute one boolean mask per reason code, True for the traces to reject for that reason.
+
+    Args:
+        df: Traces as loaded by load_trace_store
+        config: Overrides of DEFAULT_FILTER_CONFIG
+
+    Returns:
+        Dict reason code -> boolean Series aligned with df, plus the '_num_tokens' Series
+    """
+    config = {**DEFAULT_FILTER_CONFIG, **(config or {})}
+    trajectory = df[RDC.THINKING_TRAJECTORY].fillna('').astype(str) if RDC.THINKING_TRAJECTORY in df \
+        else pd.Series('', index=df.index)
+    answer = df['model_answer'] if 'model_answer' in df else pd.Series(None, index=df.index)
+
+    masks = {}
+    masks[REASON_EMPTY_ANSWER] = answer.isna() | (answer.astype(str).str.strip() == '')
+
+    # A trace cut off by the output limit leaves tags unbalanced or has no final answer tag
+    truncated = pd.Series(False, index=df.index)
+    for tag in TRACE_TAGS:
+        truncated |= trajectory.str.count(f'<{tag}>') != trajectory.str.count(f'</{tag}>')
+    if config['require_answer_tag']:
+        truncated |= ~trajectory.str.contains('</answer>', regex=False)
+    masks[REASON_TRUNCATED] = truncated
+
+    if RDC.LANGUAGE in df:
+        detected = identify_language(trajectory, config['min_cjk_ratio'], config['language_id_chars'])
+        masks[REASON_LANGUAGE_MISMATCH] = df[RDC.LANGUAGE].notna() & (detected != df[RDC.LANGUAGE])
+    else:
+        masks[REASON_LANGUAGE_MISMATCH] = pd.Series(False, index=df.index)
+
+    # Same trace up to whitespace and case, the first occurrence is kept
+    normalized = trajectory.str.lower().str.replace(r'\s+', ' ', regex=True).str.strip()
+    masks[REASON_DUPLICATE] = normalized.duplicated(keep='first') & (normalized != '')
+
+    num_tokens = pd.Series(estimate_token_counts(trajectory.tolist(), config['tokenizer_name']), index=df.index)
+    masks[REASON_TOO_SHORT] = num_tokens < config['min_tokens']
+    masks[REASON_TOO_LONG] = num_tokens > config['max_tokens']
+
+    if config['require_correct'] and 'is_correct_by_rules' in df:
+        masks[REASON_INCORRECT] = ~df['is_correct_by_rules'].fillna(False).astype(bool)
+    masks['_num_tokens'] = num_tokens
+    return masks
+
+
+def filter_traces(df: pd.DataFrame, config: Optional[Dict] = None):
+    """
+    Split traces into accepted and rejected ones.
+
+    Returns:
+        Tuple (accepted_df, rejected_df, summary), rejected_df having a 'reject_reasons' column with the
+        comma separated reason codes and summary the number of traces per reason
+    """
+    masks = compute_reject_masks(df, config)
+    num_tokens = masks.pop('_num_tokens')
+
+    reasons = pd.Series('', index=df.index)
+    for reason, mask in masks.items():
+        reasons = reasons + np.where(mask.to_numpy(), f'{reason},', '')
+    reasons = reasons.str.rstrip(',')
+
+    df = df.assign(num_trace_tokens=num_tokens)
+    rejected = reasons != ''
+    accepted_df = df[~rejected]
+    rejected_df = df[rejected].assign(reject_reasons=reasons[rejected])
+
+    summary = {'total': len(df), 'accepted': int((~rejected).sum()), 'rejected': int(rejected.sum())}
+    summary.update({reason: int(mask.sum()) for reason, mask in masks.items()})
+    return accepted_df, rejected_df, summary
+
+
+def write_shards(df: pd.DataFrame, output_dir: str, prefix: str, shard_size: int = 10000) -> List[str]:
+    """
+    Write traces as json shards in the store format ({question_id: record}), e.g. accepted-00000.json.
+    """
+    paths = []
+    records = df.set_index('store_key')
+    for shard_idx, start in enumerate(range(0, len(records), shard_size)):
+        path = os.path.join(output_dir, f'{prefix}-{shard_idx:05d}.json')
+        shard = records.iloc[start:start + shard_size]
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(shard.to_json(orient='index', force_ascii=False))
+        paths.append(path)
+    return paths
+
+
+def run_trace_filter(data_dir: str, output_dir: str, config: Optional[Dict] = None,
+                     shard_size: int = 10000) -> Dict:
+    """
+    Filter the traces of a distillation store and write accepted and rejected shards to output_dir.
+
+    Args:
+        data_dir: Path to the distillation store, e.g. './ddb_storage/DeepSeek-R1_distill_release_basic_txt.json'
+        output_dir: Directory of the shards and the summary
+        config: Overrides of DEFAULT_FILTER_CONFIG
+        shard_size: Number of traces per shard
+
+    Returns:
+        Number of traces accepted, rejected and rejected per reason
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Remove shards of a previous run, their number may differ
+    for path in glob.glob(os.path.join(output_dir, 'accepted-*.json')) + \
+            glob.glob(os.path.join(output_dir, 'rejected-*.json')):
+        os.remove(path)
+
+    df = load_trace_store(data_dir)
+    accepted_df, rejected_df, summary = filter_traces(df, config)
+    write_shards(accepted_df, output_dir, 'accepted', shard_size)
+    write_shards(rejected_df, output_dir, 'rejected', shard_size)
+
+    with open(os.path.join(output_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    logger.info(f"Accepted {summary['accepted']}/{summary['total']} traces of {data_dir}: {summary}")
+    return summary
+
+
+def load_accepted_traces(output_dir: str) -> Dict:
+    """Merge the accepted shards written by run_trace_filter back into one store dict."""
+    store = {}
+    for path in sorted(glob.glob(os.path.join(output_dir, 'accepted-*.json'))):
+        store.update(read_json(path))
+    return store
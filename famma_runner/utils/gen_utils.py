@@ -1,14 +1,34 @@
+import functools
 import json
-import os
 import re
+import time
 import base64
-from easyllm_kit.utils import get_logger, extract_json_from_text
+from easyllm_kit.utils import get_logger
 from typing import Optional, List, Union, Dict
 from pathlib import Path
 import json_repair
+from famma_runner.utils.path_utils import resolve_image_path, guess_image_mime_type
+from famma_runner.utils.snapshot_utils import PackedRelease, is_packed_release, open_packed_release
+from famma_runner.utils.ocr_utils import run_ocr, decode_image
 
 logger = get_logger('famma', 'famma.log')
 
+# Fenced json blocks, ```json {...} ``` (the json tag is optional)
+_FENCED_JSON_RE = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.DOTALL)
+# Tokens of the brace scanner: whole strings (braces inside them do not count) and braces
+_JSON_SCAN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]', re.DOTALL)
+# Decoder accepting raw newlines and tabs inside strings, as models often write them in explanations
+_JSON_DECODER = json.JSONDecoder(strict=False)
+
+
+def _guess_base64_image_mime_type(img: str) -> str:
+    """Guess the MIME type of a base64 encoded image from its first bytes."""
+    try:
+        # 16 base64 characters decode to the 12 leading bytes, enough for the magic number
+        return guess_image_mime_type(base64.b64decode(img[:16]))
+    except (ValueError, TypeError):
+        return 'image/jpeg'
+
 
 def _prepare_litellm_message(prompt: str, images: Optional[List[str]] = None) -> List[Dict]:
     """Helper function to prepare message for LiteLLM-based models."""
@@ -17,28 +37,29 @@ def _prepare_litellm_message(prompt: str, images: Optional[List[str]] = None) ->
         message.extend([
             {
                 "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{img}"}
+                "image_url": {"url": f"data:{_guess_base64_image_mime_type(img)};base64,{img}"}
             } for img in images
         ])
     return message
 
 
-def _handle_ocr(ocr_model, images: List[str], prompt: str) -> str:
-    """Process images with OCR and append results to prompt."""
+def _handle_ocr(ocr_model, images: List[str], prompt: str, ocr_cache=None) -> str:
+    """
+    Process images with OCR and append results to prompt, reusing the results of ocr_cache if given.
+    Images are decoded in memory, and the call is safe from concurrent worker threads.
+    """
     for i, img in enumerate(images):
-        # Convert base64 to bytes and save as temporary jpg
+        # Convert base64 to bytes, OCR the image unless its result is cached
         img_bytes = base64.b64decode(img)
-        temp_img_path = f"temp_img_{i}.jpg"
-        with open(temp_img_path, "wb") as f:
-            f.write(img_bytes)
-
-        # Perform OCR on jpg file
-        ocr_result = ocr_model.ocr(temp_img_path)
-        ocr_text = f'\n <image_{i + 1}> OCR result: '.join([line[1][0] for res in ocr_result for line in res])
+        pages = ocr_cache.get(img_bytes) if ocr_cache is not None else None
+        if pages is None:
+            # Perform OCR on the decoded array, no temporary file is written
+            pages = run_ocr(ocr_model, decode_image(img_bytes))
+            if ocr_cache is not None:
+                ocr_cache.put(img_bytes, pages)
+
+        ocr_text = f'\n <image_{i + 1}> OCR result: '.join([line for lines in pages for line in lines])
         prompt = f"{prompt}\n{ocr_text}"
-
-        # Clean up temporary file
-        os.remove(temp_img_path)
     return prompt
 
 
@@ -47,7 +68,9 @@ def generate_response_from_llm(
         input_prompt: str,
         images: Optional[Union[List[str], List[Path]]] = None,
         use_ocr: bool = False,
-        ocr_model=None
+        ocr_model=None,
+        ocr_cache=None,
+        telemetry=None
 ) -> str:
     """
     Generate responses from various LLM models with optional image input and OCR processing.
@@ -58,6 +81,9 @@ def generate_response_from_llm(
         images (Optional[Union[List[str], List[Path]]]): List of image paths or base64 encoded images
         use_ocr (bool): Whether to use OCR processing on the images
         ocr_model: OCR model instance (required if use_ocr is True)
+        ocr_cache: Optional OCRCache (see ocr_utils) matching the configuration of ocr_model
+        telemetry: Optional TelemetryContext (see telemetry_utils) recording the latency, tokens,
+            payload and error of the call
 
     Returns:
         str: The generated response from the model
@@ -70,12 +96,36 @@ def generate_response_from_llm(
     if not hasattr(model, 'model_name'):
         raise ValueError("Model must have 'model_name' attribute")
 
+    ocr_latency = None
     if use_ocr:
         if ocr_model is None:
             raise ValueError("ocr_model is required when use_ocr is True")
         if not images:
             raise ValueError("Images are required when use_ocr is True")
-        input_prompt = _handle_ocr(ocr_model, images, input_prompt)
+        # Local OCR is timed on its own, so that it does not count as provider latency
+        ocr_start_time = time.perf_counter()
+        input_prompt = _handle_ocr(ocr_model, images, input_prompt, ocr_cache)
+        ocr_latency = time.perf_counter() - ocr_start_time
+
+    if telemetry is None:
+        return _generate_response(model, input_prompt, images, use_ocr)
+
+    start_time = time.perf_counter()
+    try:
+        response = _generate_response(model, input_prompt, images, use_ocr)
+    except Exception as e:
+        telemetry.record(input_prompt, images, latency=time.perf_counter() - start_time, error=e,
+                         ocr_latency=ocr_latency)
+        raise
+    telemetry.record(input_prompt, images, latency=time.perf_counter() - start_time, response=response,
+                     ocr_latency=ocr_latency)
+    return response
+
+
+def _generate_response(model, input_prompt, images=None, use_ocr=False):
+    """Send one request to the model, see generate_response_from_llm."""
+    if use_ocr:
+        # The OCR text of the images is already in the prompt
         return model.generate(input_prompt)
 
     if model.model_name in ['qwen', 'qwen_vl']:
@@ -107,13 +157,14 @@ def _extract_thinking_trajectory_and_answer(content):
     answer = ''
 
     # Extract JSON and reasoning from string
-    json_pattern = r'```json\s*({.*?})\s*```'
-    json_match = re.search(json_pattern, content, re.DOTALL)
+    json_match = _FENCED_JSON_RE.search(content)
 
     # Extract answer from JSON if present
     if json_match:
         try:
-            json_data = json_repair.loads(json_match.group(1))
+            json_data = _loads_json_object(json_match.group(1))
+            if json_data is None:
+                json_data = json_repair.loads(json_match.group(1))
             if isinstance(json_data, dict) and 'answer' in json_data:
                 answer = json_data['answer']
 
@@ -181,9 +232,91 @@ def parse_reasoning_response(response):
     return response_dict
 
 
+def _loads_json_object(text: str) -> Optional[Dict]:
+    """Strict json.loads of a candidate object, None if it is not a valid JSON object."""
+    try:
+        parsed = _JSON_DECODER.decode(text)
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def _iter_outermost_json_objects(text: str):
+    """Yield the top-level {...} spans of a text in one pass, skipping the braces inside strings."""
+    start = text.find('{')
+    while start != -1:
+        depth = 0
+        for match in _JSON_SCAN_RE.finditer(text, start):
+            token = match.group()
+            if token == '{':
+                depth += 1
+            elif token == '}':
+                depth -= 1
+                if depth == 0:
+                    yield text[start:match.end()]
+                    break
+        else:
+            # The last object is not closed
+            return
+        start = text.find('{', match.end())
+
+
+def parse_json_object(text: str) -> Optional[Dict]:
+    """
+    Parse the JSON object of a model response, from the fastest layer to the most tolerant one:
+    the whole text with json.loads, the fenced ```json blocks, the outermost objects found by a brace scanner,
+    and json_repair as a last resort.
+
+    Returns:
+        The first layer's object, None if the text holds no JSON object, even a repaired one
+
+    Examples:
+        >>> parse_json_object('Reasoning... ```json\n{"q1": {"answer": "A", "explanation": "..."}}\n```')
+        {'q1': {'answer': 'A', 'explanation': '...'}}
+        >>> parse_json_object('The answer is {"q1": {"answer": "B", "explanation": "see {x}"}} as shown')
+        {'q1': {'answer': 'B', 'explanation': 'see {x}'}}
+        >>> parse_json_object('no json here') is None
+        True
+    """
+    if not text:
+        return None
+    stripped = text.strip()
+    if stripped.startswith('{'):
+        parsed = _loads_json_object(stripped)
+        if parsed is not None:
+            return parsed
+
+    if '```' in text:
+        for match in _FENCED_JSON_RE.finditer(text):
+            parsed = _loads_json_object(match.group(1))
+            if parsed is not None:
+                return parsed
+
+    for candidate in _iter_outermost_json_objects(text):
+        parsed = _loads_json_object(candidate)
+        if parsed is not None:
+            return parsed
+
+    try:
+        repaired = json_repair.loads(text)
+    except Exception as e:
+        logger.warning(f"Error repairing JSON: {e}")
+        return None
+    if isinstance(repaired, list):
+        # Several objects in the text, keep the first one like the layers above
+        repaired = next((item for item in repaired if isinstance(item, dict)), None)
+    return repaired if isinstance(repaired, dict) and repaired else None
+
+
+@functools.lru_cache(maxsize=4096)
+def _answer_pattern(question_id: str) -> re.Pattern:
+    # Pattern to match: "q1": {"answer": "some answer", "explanation": "some explanation"}
+    return re.compile(rf'"{re.escape(question_id)}"\s*:\s*\{{\s*"answer"\s*:\s*"(.*?)"\s*,\s*"explanation"\s*:\s*"(.*?)"\s*\}}')
+
+
 def safe_parse_response(response, question_id_list):
     """
-    Parse the response string as JSON or extracts data using regex if JSON parsing fails.
+    Parse the response string as JSON (see parse_json_object) or extracts data using regex if JSON parsing fails.
     Args:
         response: The text response from the model, can be a string or a dictionary
         question_id_list: List of question IDs to look for
@@ -195,26 +328,17 @@ def safe_parse_response(response, question_id_list):
 
     # If reasoning is attached, response should be a dictionary
     if isinstance(response, dict):
-        response_text = response.get('content', '')
+        response_text = response.get('content', '') or ''
         reasoning = response.get('reasoning_content', '')
         response_dict['reasoning'] = reasoning
     else:
-        response_text = response
+        response_text = response or ''
 
-    if response_text == '':
+    parsed_json = parse_json_object(response_text)
+    if parsed_json is None:
         response_dict['result'] = 'error parsing'
-
-    # Try to parse as JSON
-    try:
-        parsed_json = json_repair.loads(response_text)
+    else:
         response_dict.update(parsed_json)
-    except json.JSONDecodeError:
-        try:
-            extracted_json = extract_json_from_text(response_text)
-            response_dict.update(extracted_json)
-        except Exception as e:
-            logger.warning(f"Error extracting JSON: {e}")
-            response_dict['result'] = 'error parsing'
 
     # If JSON parsing fails, use regex
     if response_dict.get('result', None) == 'error parsing':
@@ -222,10 +346,7 @@ def safe_parse_response(response, question_id_list):
         parsed_response = {}
 
         for idx, question_id in enumerate(question_id_list):
-            # Pattern to match: "q1": {"answer": "some answer", "explanation": "some explanation"}
-            pattern = rf'"{question_id}"\s*:\s*\{{\s*"answer"\s*:\s*"(.*?)"\s*,\s*"explanation"\s*:\s*"(.*?)"\s*\}}'
-
-            match = re.search(pattern, response_text)
+            match = _answer_pattern(question_id).search(response_text)
             if match:
                 answer, explanation = match.groups()
                 parsed_response[question_id] = {
@@ -255,10 +376,37 @@ def safe_parse_response(response, question_id_list):
     return response_dict
 
 
+def find_unanswered_questions(parsed_response: Dict, question_id_list: List[str]) -> List[str]:
+    """
+    Question IDs of the parsed response (see safe_parse_response) without an answer:
+    missing from the response, or with an empty answer, as set by the regex fallback.
+    """
+    unanswered = []
+    for question_id in question_id_list:
+        entry = parsed_response.get(question_id)
+        answer = entry.get('answer') if isinstance(entry, dict) else None
+        if answer is None or not str(answer).strip():
+            unanswered.append(question_id)
+    return unanswered
+
+
 def collect_images_from_first_subquestion(sub_question_set_df, parent_dir):
     """
     Collects unique images from the first sub-question in the question set and returns them as a list.
+    Images are returned base64 encoded in their original format (jpg, png, ...).
+
+    Args:
+        sub_question_set_df: DataFrame of the sub-questions of one main question
+        parent_dir: Parent directory of the release json, or a packed release snapshot
+            (path or PackedRelease) to read the images from
     """
+    if isinstance(parent_dir, PackedRelease):
+        packed_release = parent_dir
+    elif is_packed_release(parent_dir):
+        packed_release = open_packed_release(parent_dir)
+    else:
+        packed_release = None
+
     images = []
     sub_question_set_df.sort_values(by='sub_question_id', inplace=True)
     if not sub_question_set_df.empty:
@@ -267,7 +415,10 @@ def collect_images_from_first_subquestion(sub_question_set_df, parent_dir):
         for i in range(1, 8):
             image_key = f"image_{i}"
             if first_row.get(image_key) is not None and first_row[image_key] != 'None':
-                image_dir = os.path.join(parent_dir, first_row[image_key])
+                if packed_release is not None:
+                    images.append(base64.b64encode(packed_release.read_image(first_row[image_key])).decode('utf-8'))
+                    continue
+                image_dir = resolve_image_path(parent_dir, first_row[image_key])
                 # encode image to base64
                 with open(image_dir, 'rb') as image_file:
                     encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
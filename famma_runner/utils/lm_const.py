@@ -34,6 +34,17 @@ class LanguageModel:
     release_date: datetime | None  # XXX Should we use timezone.utc?
     link: str | None = None
 
+    # Parameters used by the run planner (plan_utils) to estimate tokens, wall time and cost offline.
+    # Entries of LanguageModelList set approximate values: list prices of the providers (late 2024),
+    # typical single-request throughput and the input tokens of a ~1000x1000 image. Self-hosted models
+    # have no price. The `planner` section of a run config overrides any of them.
+    tokenizer_name: str = "cl100k_base"  # tiktoken encoding used to approximate the model's tokenizer
+    tokens_per_image: int = 765  # input tokens charged per image
+    output_tokens_per_second: float = 50.0  # decoding throughput of a single request
+    time_to_first_token: float = 1.0  # seconds
+    input_price_per_mtok: float | None = None  # USD per million input tokens
+    output_price_per_mtok: float | None = None  # USD per million output tokens
+
     def __hash__(self) -> int:
         return hash(self.model_name)
 
@@ -46,6 +57,9 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2024, 9, 19),
         link="https://huggingface.co/meta-llama/Llama-3.2-11B-Vision-Instruct",
+        tokens_per_image=1601,
+        output_tokens_per_second=40.0,
+        time_to_first_token=0.5,
     ),
     LanguageModel(
         "gpt-4o-2024-08-06",
@@ -54,6 +68,12 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 4, 30),
         link="https://openai.com/index/spring-update",
+        tokenizer_name="o200k_base",
+        tokens_per_image=765,
+        output_tokens_per_second=90.0,
+        time_to_first_token=0.5,
+        input_price_per_mtok=2.5,
+        output_price_per_mtok=10.0,
     ),
     LanguageModel(
         "gpt-4o-mini-2024-07-18",
@@ -62,6 +82,12 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 4, 30),
         link="https://openai.com/index/spring-update",
+        tokenizer_name="o200k_base",
+        tokens_per_image=25501,
+        output_tokens_per_second=90.0,
+        time_to_first_token=0.5,
+        input_price_per_mtok=0.15,
+        output_price_per_mtok=0.6,
     ),
     LanguageModel(
         "o1-preview-2024-09-12",
@@ -70,6 +96,12 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 4, 30),
         link="https://openai.com/index/spring-update",
+        tokenizer_name="o200k_base",
+        tokens_per_image=765,
+        output_tokens_per_second=40.0,
+        time_to_first_token=20.0,
+        input_price_per_mtok=15.0,
+        output_price_per_mtok=60.0,
     ),
     LanguageModel(
         "o1-mini-2024-09-12",
@@ -78,6 +110,12 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 4, 30),
         link="https://openai.com/index/spring-update",
+        tokenizer_name="o200k_base",
+        tokens_per_image=765,
+        output_tokens_per_second=70.0,
+        time_to_first_token=10.0,
+        input_price_per_mtok=3.0,
+        output_price_per_mtok=12.0,
     ),
     LanguageModel(
         "claude-2",
@@ -86,6 +124,11 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2022, 12, 31),
         link="https://www.anthropic.com/index/claude-2",
+        tokens_per_image=1334,
+        output_tokens_per_second=40.0,
+        time_to_first_token=1.0,
+        input_price_per_mtok=8.0,
+        output_price_per_mtok=24.0,
     ),
     LanguageModel(
         "claude-3-opus-20240229",
@@ -94,6 +137,11 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 9, 1),
         link="https://www.anthropic.com/index/claude-3",
+        tokens_per_image=1334,
+        output_tokens_per_second=25.0,
+        time_to_first_token=2.0,
+        input_price_per_mtok=15.0,
+        output_price_per_mtok=75.0,
     ),
     LanguageModel(
         "claude-3-sonnet-20240229",
@@ -102,6 +150,11 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 9, 1),
         link="https://www.anthropic.com/index/claude-3",
+        tokens_per_image=1334,
+        output_tokens_per_second=60.0,
+        time_to_first_token=1.0,
+        input_price_per_mtok=3.0,
+        output_price_per_mtok=15.0,
     ),
     LanguageModel(
         "claude-3-5-sonnet-20240620",
@@ -110,6 +163,11 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2024, 3, 31),
         link="https://www.anthropic.com/news/claude-3-5-sonnet",
+        tokens_per_image=1334,
+        output_tokens_per_second=70.0,
+        time_to_first_token=1.0,
+        input_price_per_mtok=3.0,
+        output_price_per_mtok=15.0,
     ),
     LanguageModel(
         "claude-3-haiku-20240307",
@@ -118,6 +176,11 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 4, 30),
         link="https://www.anthropic.com/index/claude-3",
+        tokens_per_image=1334,
+        output_tokens_per_second=120.0,
+        time_to_first_token=0.5,
+        input_price_per_mtok=0.25,
+        output_price_per_mtok=1.25,
     ),
     LanguageModel(
         "gemini-1.5-pro-002",
@@ -126,6 +189,11 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 4, 30),
         link="https://blog.google/technology/ai/gemini-api-developers-cloud",
+        tokens_per_image=258,
+        output_tokens_per_second=60.0,
+        time_to_first_token=1.0,
+        input_price_per_mtok=1.25,
+        output_price_per_mtok=5.0,
     ),
     LanguageModel(
         "gemini-1.5-flash-002",
@@ -134,6 +202,11 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 4, 30),
         link="https://blog.google/technology/ai/gemini-api-developers-cloud",
+        tokens_per_image=258,
+        output_tokens_per_second=180.0,
+        time_to_first_token=0.4,
+        input_price_per_mtok=0.075,
+        output_price_per_mtok=0.3,
     ),
     LanguageModel(
         "Qwen/Qwen2-72B",
@@ -142,6 +215,8 @@ LanguageModelList: list[LanguageModel] = [
         False,
         datetime(2023, 8, 30),
         link="https://huggingface.co/Qwen/Qwen2-72B",
+        output_tokens_per_second=30.0,
+        time_to_first_token=0.5,
     ),
     LanguageModel(
         "Qwen/Qwen2-72B-Instruct",
@@ -150,6 +225,8 @@ LanguageModelList: list[LanguageModel] = [
         False,
         datetime(2023, 8, 30),
         link="https://huggingface.co/Qwen/Qwen2-72B-Instruct",
+        output_tokens_per_second=30.0,
+        time_to_first_token=0.5,
     ),
     LanguageModel(
         "Qwen/Qwen2.5-7B",
@@ -158,6 +235,8 @@ LanguageModelList: list[LanguageModel] = [
         False,
         datetime(2023, 8, 30),
         link="https://huggingface.co/Qwen/Qwen2.5-7B",
+        output_tokens_per_second=80.0,
+        time_to_first_token=0.2,
     ),
     LanguageModel(
         "Qwen/Qwen2.5-7B-Instruct",
@@ -166,6 +245,8 @@ LanguageModelList: list[LanguageModel] = [
         False,
         datetime(2023, 8, 30),
         link="https://huggingface.co/Qwen/Qwen2.5-7B-Instruct",
+        output_tokens_per_second=80.0,
+        time_to_first_token=0.2,
     ),
     LanguageModel(
         "Qwen/Qwen2-VL-72B-Instruct",
@@ -174,6 +255,9 @@ LanguageModelList: list[LanguageModel] = [
         True,
         datetime(2023, 9, 17),
         link="https://huggingface.co/Qwen/Qwen2-VL-72B-Instruct",
+        tokens_per_image=1276,
+        output_tokens_per_second=30.0,
+        time_to_first_token=0.5,
     ),
 ]
 
@@ -181,5 +265,15 @@ LanguageModelStore: dict[str, LanguageModel] = {
     lm.model_name: lm for lm in LanguageModelList
 }
 
+
+def get_language_model(model_name: str) -> LanguageModel | None:
+    """Look up a model by its full name (e.g. 'gpt-4o-2024-08-06') or its short repr."""
+    if model_name in LanguageModelStore:
+        return LanguageModelStore[model_name]
+    for lm in LanguageModelList:
+        if lm.model_repr == model_name:
+            return lm
+    return None
+
 if __name__ == "__main__":
     print(list(LanguageModelStore.keys()))
\ No newline at end of file
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+from easyllm_kit.utils import get_logger
+
+logger = get_logger('manifest_utils', 'manifest_utils.log')
+
+DEFAULT_MANIFEST_DIR = './manifests'
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+TASK_STATES = (PENDING, IN_FLIGHT, DONE, FAILED)
+
+
+def get_manifest_path(target_db_name: str, manifest_dir: str = DEFAULT_MANIFEST_DIR) -> str:
+    """Manifest of the runs writing to a result database, model names with / are flattened."""
+    return os.path.join(manifest_dir, f"{target_db_name.replace('/', '_')}.manifest.jsonl")
+
+
+class RunManifest:
+    """
+    Journal of the state of every task of a run: pending, in_flight, done or failed, with its attempts.
+
+    Every change is appended to a JSONL file as one line and flushed, so a crash or a kill loses nothing
+    that was recorded, and a line cut short by the crash is ignored when the journal is read back.
+    When a manifest is opened or closed, the journal is compacted to one line per task through a temporary
+    file and an atomic rename.
+
+    With resume, the journal of the previous run is replayed: tasks that were in flight when it stopped
+    are pending again, and the done tasks tell the runner what to skip without reading the result store.
+
+    Example:
+        >>> manifest = RunManifest(get_manifest_path('gpt-4o_ans_release_basic'), resume=True)
+        >>> manifest.register(keys)
+        >>> manifest.start(key)
+        >>> manifest.done(key)
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self.resumed = False
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if resume:
+            if os.path.exists(path):
+                self._tasks = self._replay(path)
+                self.resumed = True
+                interrupted = [key for key, task in self._tasks.items() if task['state'] == IN_FLIGHT]
+                for key in interrupted:
+                    self._tasks[key]['state'] = PENDING
+                logger.info(f"Resuming from {path}: {dict(self.counts())}, "
+                            f"{len(interrupted)} tasks interrupted in flight are pending again")
+            else:
+                logger.warning(f"No manifest at {path} to resume from, starting a new one")
+        self._compact()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def _replay(path: str) -> Dict[str, Dict]:
+        tasks = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a run that was killed while writing it
+                    continue
+                tasks[entry.pop('key')] = entry
+        return tasks
+
+    def _compact(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, task in self._tasks.items():
+                f.write(json.dumps(dict(key=key, **task), ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _set(self, keys: Iterable[str], state: str, error: Optional[str] = None, new_attempt: bool = False,
+             only_new: bool = False):
+        lines = []
+        with self._lock:
+            if self._file.closed:
+                logger.warning(f"Run manifest {self.path} is closed, state {state} of {len(list(keys))} tasks "
+                               f"is not recorded")
+                return
+            for key in keys:
+                task = self._tasks.get(key)
+                if task is None:
+                    task = self._tasks[key] = {'state': PENDING, 'attempts': 0, 'error': None}
+                elif only_new:
+                    continue
+                task['state'] = state
+                task['attempts'] += int(new_attempt)
+                task['error'] = error
+                task['updated_at'] = time.time()
+                lines.append(json.dumps(dict(key=key, **task), ensure_ascii=False, default=str))
+            if lines:
+                self._file.write('\n'.join(lines) + '\n')
+                self._file.flush()
+
+    def register(self, keys: Iterable[str]):
+        """Record the tasks of the run as pending, tasks the manifest already knows keep their state."""
+        self._set(keys, PENDING, only_new=True)
+
+    def start(self, key: str):
+        """A new attempt of the task is in flight."""
+        self._set([key], IN_FLIGHT, new_attempt=True)
+
+    def done(self, key: str):
+        self._set([key], DONE)
+
+    def done_many(self, keys: Iterable[str]):
+        self._set(keys, DONE)
+
+    def fail(self, key: str, error: Optional[BaseException] = None):
+        self._set([key], FAILED, error=None if error is None else f"{type(error).__name__}: {error}")
+
+    def release(self, key: str):
+        """Set a task back to pending, e.g. when the run stopped before it was processed."""
+        self._set([key], PENDING)
+
+    def state(self, key: str) -> Optional[str]:
+        task = self._tasks.get(key)
+        return None if task is None else task['state']
+
+    def attempts(self, key: str) -> int:
+        task = self._tasks.get(key)
+        return 0 if task is None else task['attempts']
+
+    def is_done(self, key: str) -> bool:
+        return self.state(key) == DONE
+
+    def keys(self, state: Optional[str] = None):
+        with self._lock:
+            return [key for key, task in self._tasks.items() if state is None or task['state'] == state]
+
+    def counts(self) -> Counter:
+        with self._lock:
+            return Counter(task['state'] for task in self._tasks.values())
+
+    def close(self):
+        """Compact the journal to the last state of every task."""
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.close()
+            self._compact()
+        logger.info(f"Run manifest {self.path}: {dict(self.counts())}")
@@ -0,0 +1,167 @@
+import hashlib
+import importlib.metadata
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+from easyllm_kit.utils import get_logger
+
+logger = get_logger('ocr_utils', 'ocr_utils.log')
+
+# Resolved against the repository root rather than the working directory, so that the scripts of
+# misc_scripts/ and main_scripts/ share one cache file
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_OCR_CACHE_PATH = os.path.join(REPO_ROOT, 'ocr_cache', 'ocr_cache.sqlite')
+
+# Options of every OCR call, shared by ocr_and_merge and the generation runner so that their cache keys match
+OCR_OPTIONS = {'use_angle_cls': True, 'cls': True}
+
+# PaddleOCR language code of each dataset language
+OCR_LANGUAGE_MAP = {
+    'english': 'en',
+    'chinese': 'ch',
+    'french': 'fr'
+}
+
+
+def get_ocr_language(language: str) -> str:
+    """PaddleOCR language code of a dataset language (english, chinese, french), 'en' for unknown languages."""
+    return OCR_LANGUAGE_MAP.get(language, 'en')
+
+
+def build_ocr_model(lang: str, **kwargs):
+    """Create a PaddleOCR model with the shared OCR_OPTIONS, paddleocr is only imported here."""
+    from paddleocr import PaddleOCR
+    return PaddleOCR(use_angle_cls=OCR_OPTIONS['use_angle_cls'], lang=lang, **kwargs)
+
+
+# One lock per OCR model: a paddle predictor must not run two images at once, but different
+# models (e.g. of different languages) can run in parallel
+_ocr_model_locks = weakref.WeakKeyDictionary()
+_ocr_model_locks_guard = threading.Lock()
+
+
+def _get_ocr_model_lock(ocr_model) -> threading.Lock:
+    with _ocr_model_locks_guard:
+        lock = _ocr_model_locks.get(ocr_model)
+        if lock is None:
+            lock = _ocr_model_locks[ocr_model] = threading.Lock()
+        return lock
+
+
+def decode_image(image_bytes: bytes) -> np.ndarray:
+    """Decode encoded image bytes (jpg, png, ...) once into the BGR uint8 array PaddleOCR reads from files."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        rgb = np.asarray(image.convert('RGB'))
+    return np.ascontiguousarray(rgb[:, :, ::-1])
+
+
+def run_ocr(ocr_model, image) -> List[List[str]]:
+    """
+    OCR an image (path or BGR array, see decode_image) with the shared OCR_OPTIONS, returns the text lines
+    of each page. Safe to call from several threads, calls on the same model are serialized.
+    """
+    with _get_ocr_model_lock(ocr_model):
+        result = ocr_model.ocr(image, cls=OCR_OPTIONS['cls'])
+    return extract_ocr_lines(result)
+
+
+def resolve_ocr_cache_path(path: Optional[str]) -> Optional[str]:
+    """Cache path of a config value: the default for 'default' (or True), None to disable the cache."""
+    if not path:
+        return None
+    if path is True or path == 'default':
+        return DEFAULT_OCR_CACHE_PATH
+    return path
+
+
+def get_ocr_engine_name() -> str:
+    """Name and version of the OCR engine, part of the cache key so that an upgrade invalidates old results."""
+    try:
+        # Read from the package metadata, so that paddle is not imported just for the key
+        return f"paddleocr-{importlib.metadata.version('paddleocr')}"
+    except importlib.metadata.PackageNotFoundError:
+        return 'paddleocr'
+
+
+def extract_ocr_lines(ocr_result) -> List[List[str]]:
+    """Text lines of a PaddleOCR result, one list per page."""
+    pages = []
+    for page in ocr_result or []:
+        lines = []
+        for line in page or []:
+            if len(line) >= 2 and line[1] and len(line[1]) >= 1:
+                lines.append(line[1][0])
+        pages.append(lines)
+    return pages
+
+
+class OCRCache:
+    """
+    OCR results shared by all runs, stored in a SQLite file and keyed by the content of the image.
+
+    A cache handle is bound to one OCR configuration (engine, language and options), which is part of the key
+    together with the sha256 of the image bytes, so the same image OCRed with other settings is a miss.
+    The results are stored as the text lines of each page, every caller formats them as it needs.
+    Handles are safe to share between threads, and several processes can use the same file.
+
+    Example:
+        >>> cache = OCRCache(lang='en')
+        >>> pages = cache.get(image_bytes)
+        >>> if pages is None:
+        ...     pages = run_ocr(ocr_model, image_path)
+        ...     cache.put(image_bytes, pages)
+    """
+
+    def __init__(self, path: str = DEFAULT_OCR_CACHE_PATH, engine: Optional[str] = None, lang: str = 'ch',
+                 options: Optional[Dict] = None):
+        self.path = path
+        self.engine = engine or get_ocr_engine_name()
+        self.lang = lang
+        self.options = dict(OCR_OPTIONS if options is None else options)
+        self._config_digest = hashlib.sha256(json.dumps(
+            {'engine': self.engine, 'lang': lang, 'options': self.options}, sort_keys=True).encode('utf-8')
+        ).hexdigest()[:16]
+        self.num_hits = 0
+        self.num_misses = 0
+
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS ocr_results ('
+                               'key TEXT PRIMARY KEY, engine TEXT, lang TEXT, pages TEXT, created_at REAL)')
+            self._conn.commit()
+
+    def key(self, image_bytes: bytes) -> str:
+        return f"{hashlib.sha256(image_bytes).hexdigest()}:{self._config_digest}"
+
+    def get(self, image_bytes: bytes) -> Optional[List[List[str]]]:
+        """OCR lines of an image, None if it was not OCRed with this configuration yet."""
+        key = self.key(image_bytes)
+        with self._lock:
+            row = self._conn.execute('SELECT pages FROM ocr_results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.num_misses += 1
+                return None
+            self.num_hits += 1
+        return json.loads(row[0])
+
+    def put(self, image_bytes: bytes, pages: List[List[str]]):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO ocr_results VALUES (?, ?, ?, ?, ?)',
+                               (self.key(image_bytes), self.engine, self.lang,
+                                json.dumps(pages, ensure_ascii=False), time.time()))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
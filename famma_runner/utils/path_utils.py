@@ -1,8 +1,33 @@
+import os
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
     
 from easyllm_kit.utils import ensure_dir
 
+# Image extensions we may find on disk, in lookup order
+IMAGE_EXTENSIONS = ['.jpg', '.png', '.jpeg', '.webp', '.gif', '.bmp', '.tiff']
+
+# Leading magic bytes of the encodings that the dataset images come in
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'BM', '.bmp'),
+    (b'II*\x00', '.tiff'),
+    (b'MM\x00*', '.tiff'),
+]
+
+IMAGE_MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.tiff': 'image/tiff',
+}
+
 def get_cache_dir(model_repr:str, args) -> str:
     n = args.n
     temperature = args.temperature
@@ -29,7 +54,7 @@ def get_eval_all_output_dir(model_repr:str, args) -> str:
 
 def find_image_file(parent_dir: Path, image_name: str) -> Optional[Path]:
     """
-    Find image file with either .jpg or .png extension.
+    Find image file with any of the supported image extensions (.jpg, .png, ...).
     
     Args:
         parent_dir: Root directory containing images
@@ -38,8 +63,88 @@ def find_image_file(parent_dir: Path, image_name: str) -> Optional[Path]:
     Returns:
         Path to image if found, None otherwise
     """
-    for ext in ['.jpg', '.png']:
+    parent_dir = Path(parent_dir)
+    for ext in IMAGE_EXTENSIONS:
         image_path = parent_dir / f"{image_name}{ext}"
         if image_path.exists():
             return image_path
-    return None
\ No newline at end of file
+    return None
+
+
+def index_image_dir(parent_dir) -> Dict[str, Path]:
+    """
+    Map the base name of every image of a directory to its file, from a single listing of the directory.
+    Where a name exists with several extensions, the file find_image_file would return is kept.
+
+    Args:
+        parent_dir: Directory containing images
+
+    Returns:
+        Dict from image names without extension to their paths, empty if the directory does not exist
+    """
+    rank = {ext: i for i, ext in enumerate(IMAGE_EXTENSIONS)}
+    index, index_rank = {}, {}
+    try:
+        entries = list(os.scandir(parent_dir))
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+    for entry in entries:
+        stem, ext = os.path.splitext(entry.name)
+        if ext in rank and rank[ext] < index_rank.get(stem, len(rank)) and entry.is_file():
+            index[stem] = Path(entry.path)
+            index_rank[stem] = rank[ext]
+    return index
+
+
+def resolve_image_path(parent_dir: str, image_name: str) -> str:
+    """
+    Resolve an image referenced in the dataset to a file on disk.
+    Falls back to looking up the same stem with any supported extension,
+    e.g. when the release was downloaded with original (png) bytes.
+
+    Args:
+        parent_dir: Parent directory of the dataset json
+        image_name: Image path relative to parent_dir as stored in the dataset
+
+    Returns:
+        Path to the image file
+
+    Raises:
+        FileNotFoundError: If no image with that stem exists
+    """
+    image_dir = os.path.join(parent_dir, image_name)
+    if os.path.exists(image_dir):
+        return image_dir
+    image_path = Path(image_dir)
+    found = find_image_file(image_path.parent, os.path.splitext(image_path.name)[0])
+    if found is None:
+        raise FileNotFoundError(f"Image not found: {image_dir}")
+    return str(found)
+
+
+def guess_image_extension(image_bytes: bytes, path: Optional[str] = None) -> str:
+    """
+    Guess the file extension of encoded image bytes from their magic number.
+
+    Args:
+        image_bytes: The encoded image
+        path: Original file path of the image, used as a fallback
+
+    Returns:
+        Extension including the leading dot, '.jpg' if it cannot be determined
+    """
+    for signature, ext in IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return ext
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return '.webp'
+    if path:
+        ext = os.path.splitext(path)[1].lower()
+        if ext in IMAGE_EXTENSIONS:
+            return ext
+    return '.jpg'
+
+
+def guess_image_mime_type(image_bytes: bytes, path: Optional[str] = None) -> str:
+    """Return the MIME type of encoded image bytes, e.g. 'image/png'."""
+    return IMAGE_MIME_TYPES[guess_image_extension(image_bytes, path)]
\ No newline at end of file
@@ -0,0 +1,363 @@
+import concurrent.futures
+import contextlib
+import functools
+import queue
+import signal
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import omegaconf
+import pandas as pd
+from easyllm_kit.utils import get_logger
+
+from famma_runner.utils.data_const import DatasetColumns as DC
+from famma_runner.utils.data_const import LANGUAGE_ORDER
+from famma_runner.utils.data_utils import order_by_language
+from famma_runner.utils.executor_utils import DEFAULT_BACKEND, Executor, get_execution_config
+from famma_runner.utils.manifest_utils import RunManifest
+from famma_runner.utils.snapshot_utils import load_release
+
+logger = get_logger('pipeline_utils', 'pipeline_utils.log')
+
+_STOP = object()
+
+DEFAULT_QUEUE_SIZE = 8
+
+
+def load_release_df(data_dir: str) -> pd.DataFrame:
+    """Load a release (json or packed snapshot) into a DataFrame ordered by language and question."""
+    dataset_df = pd.DataFrame(load_release(data_dir))
+    # Create a new column for sorting languages
+    order_by_language(dataset_df, LANGUAGE_ORDER, DC.MAIN_QUESTION_ID, DC.SUB_QUESTION_ID, DC.LANGUAGE)
+    return dataset_df
+
+
+def iter_main_question_groups(dataset_df: pd.DataFrame) -> Iterator[Tuple[str, int, pd.DataFrame]]:
+    """Yield (language, main_question_id, sub-questions) of each main question, in dataset order."""
+    for (_, language, main_question_id), group in dataset_df.groupby(
+            ['language_order', DC.LANGUAGE, DC.MAIN_QUESTION_ID]):
+        yield language, main_question_id, group
+
+
+def filter_dataset_by_question_id(dataset_df, question_ids):
+    """
+    Filter dataset by specific question_ids.
+
+    Args:
+        dataset_df: The dataset DataFrame to filter
+        question_ids: A single question_id or list of question_ids in format
+                     {language}_{main_question_id}_{sub_question_id}_{version}
+
+    Returns:
+        Filtered DataFrame containing only rows matching the main_question_ids and languages, and the
+        list of the matched main_question_ids (None if the dataset is not filtered)
+    """
+    filtered_main_question_ids = None
+    if not question_ids:
+        return dataset_df, filtered_main_question_ids
+
+    # Convert single question_id to list for consistent processing
+    if not isinstance(question_ids, (omegaconf.ListConfig, list, tuple)):
+        question_ids = [question_ids]
+
+    if len(question_ids) == 0:
+        return dataset_df, filtered_main_question_ids
+
+    # Collect the matching rows of every language-main_question_id pair once
+    masks = []
+    processed_pairs = set()
+
+    for question_id in question_ids:
+        try:
+            # Parse the question_id to extract components
+            parts = question_id.split('_')
+            if len(parts) >= 3:  # Ensure we have at least language, main_question_id, and sub_question_id
+                language = parts[0]
+                main_question_id = int(parts[1])
+
+                pair_key = f"{language}_{main_question_id}"
+                if pair_key in processed_pairs:
+                    continue
+                processed_pairs.add(pair_key)
+
+                logger.info(f"Filtering dataset for language: {language}, main_question_id: {main_question_id}")
+
+                # Filter the dataset by both main_question_id and language
+                mask = (dataset_df[DC.MAIN_QUESTION_ID] == main_question_id) & (dataset_df[DC.LANGUAGE] == language)
+                if not mask.any():
+                    logger.warning(f"No matching questions found for {question_id}")
+                else:
+                    logger.info(f"Found {int(mask.sum())} questions matching {question_id}")
+                    masks.append(mask)
+            else:
+                logger.warning(f"Invalid question_id format: {question_id}")
+        except Exception as e:
+            logger.error(f"Error parsing question_id {question_id}: {str(e)}")
+
+    # If we didn't find any matches, return the original dataset
+    if not masks:
+        logger.warning("No matching questions found for any of the provided question_ids")
+        return dataset_df, filtered_main_question_ids
+
+    filtered_results = dataset_df[pd.concat(masks, axis=1).any(axis=1)]
+    logger.info(f"Total of {len(filtered_results)} questions matched across all filters")
+
+    # Extract unique main_question_ids from filtered results
+    filtered_main_question_ids = filtered_results[DC.MAIN_QUESTION_ID].unique().tolist()
+    return filtered_results, filtered_main_question_ids
+
+
+def get_pipeline_config(config) -> Dict:
+    """
+    Queue size and workers of each stage from the `pipeline` section of a runner config.
+    The calls to the model run on the backend and with the workers of the `execution` section,
+    the other stages in threads, one by default.
+    """
+    pipeline_config = dict(config.get('pipeline') or {})
+    execution_config = get_execution_config(config)
+    if execution_config['backend'] == 'processes':
+        # The runners hold model clients, locks and writer threads, which cannot be sent to other processes
+        raise ValueError("The model calls of the runners cannot run on the processes backend, use threads or async")
+    return {
+        'queue_size': max(1, int(pipeline_config.get('queue_size') or DEFAULT_QUEUE_SIZE)),
+        'render_workers': max(1, int(pipeline_config.get('render_workers') or 1)),
+        'call_backend': execution_config['backend'],
+        'call_workers': execution_config['max_workers'],
+        'parse_workers': max(1, int(pipeline_config.get('parse_workers') or 1)),
+    }
+
+
+class Stage:
+    """
+    One step of a Pipeline, applying func to every task with num_workers workers of an executor backend.
+
+    func takes a task (a dict with at least a 'key') and returns the task for the next stage,
+    or None to drop it. With drain=False, the stage stops taking tasks once the pipeline is stopped,
+    so the stages up to the model calls do not start new work while the later ones finish theirs.
+    A dispatch stage (the model calls) records a new attempt of the task in the manifest of the pipeline
+    each time it starts one.
+    """
+
+    def __init__(self, name: str, func: Callable[[Dict], Optional[Dict]], num_workers: int = 1, drain: bool = True,
+                 backend: str = DEFAULT_BACKEND, dispatch: bool = False):
+        self.name = name
+        self.func = func
+        self.num_workers = max(1, int(num_workers))
+        self.drain = drain
+        self.backend = backend
+        self.dispatch = dispatch
+
+    def __repr__(self):
+        return f"Stage({self.name}, {self.backend}, workers={self.num_workers})"
+
+
+class Pipeline:
+    """
+    Run tasks through a sequence of stages connected by bounded queues.
+
+    Every stage has its own workers, so e.g. prompts are rendered and responses parsed while
+    the calls to the model are in flight, and the bounded queues keep the memory flat however large the
+    dataset is: the source is only pulled when the first stage has room. With one worker per stage,
+    tasks are processed in the order of the source.
+
+    A task that raises in a stage is logged, passed to on_error and dropped; the other tasks go on.
+    With a RunManifest, the state of every task is recorded: in flight when a dispatch stage starts it,
+    done once it went through the last stage (unless mark_done is False, e.g. when the results are
+    written later by a ResultWriter), failed when it raised, and pending again when it was cancelled.
+
+    Example:
+        >>> pipeline = Pipeline('generation', [Stage('render', render), Stage('call', call, num_workers=4),
+        ...                                    Stage('parse', parse), Stage('persist', persist)])
+        >>> stats = pipeline.run(iter_tasks())
+    """
+
+    def __init__(self, name: str, stages: List[Stage], queue_size: int = DEFAULT_QUEUE_SIZE,
+                 on_error: Optional[Callable[[str, Dict, BaseException], None]] = None,
+                 on_cancel: Optional[Callable[[Dict], None]] = None, log_every: int = 20,
+                 manifest: Optional[RunManifest] = None, mark_done: bool = True):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.name = name
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+        # Called for the tasks dropped because the pipeline was stopped before they were processed
+        self.on_cancel = on_cancel
+        self.log_every = log_every
+        self.manifest = manifest
+        self.mark_done = mark_done
+
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def stop(self):
+        """Stop pulling tasks from the source, tasks past the stages with drain=False are still finished."""
+        if not self._stop_event.is_set():
+            logger.info(f"Stopping pipeline {self.name}, finishing the tasks in flight")
+        self._stop_event.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+            if name == 'completed' and self._stats['completed'] % self.log_every == 0:
+                self._log_progress()
+
+    def _log_progress(self):
+        elapsed = max(time.time() - self._start_time, 1e-9)
+        logger.info(f"Pipeline {self.name}: {self._stats['completed']} completed, {self._stats['failed']} failed, "
+                    f"{self._stats['skipped']} skipped, throughput {self._stats['completed'] / elapsed:.2f} tasks/s")
+
+    def _feed(self, tasks: Iterable[Dict], out_queue: queue.Queue):
+        try:
+            tasks = iter(tasks)
+            # Checked before pulling a task, so that the source (e.g. claiming keys) is not pulled once stopped
+            while not self.stopped:
+                try:
+                    task = next(tasks)
+                except StopIteration:
+                    break
+                if self.stopped:
+                    self._cancel(task)
+                    break
+                out_queue.put(task)
+        except BaseException as e:
+            self._source_error = e
+        finally:
+            out_queue.put(_STOP)
+
+    def _stage_inputs(self, stage: Stage, in_queue: queue.Queue, executor: Executor) -> Iterator[Dict]:
+        while True:
+            task = in_queue.get()
+            if task is _STOP:
+                # Left for the drain of _run_stage if the stage stopped while this was waiting
+                in_queue.put(_STOP)
+                return
+            if executor.cancelled:
+                # The stage stopped while this was waiting for the task, the drain of _run_stage takes the rest
+                self._cancel(task)
+                return
+            if self.stopped and not stage.drain:
+                self._cancel(task)
+                continue
+            yield task
+
+    def _cancel(self, task: Dict):
+        self._count('cancelled')
+        if self.manifest is not None:
+            self.manifest.release(task['key'])
+        if self.on_cancel is not None:
+            self.on_cancel(task)
+
+    def _dispatch(self, stage: Stage, task: Dict) -> Optional[Dict]:
+        self.manifest.start(task['key'])
+        return stage.func(task)
+
+    def _run_stage(self, index: int, executor: Executor, queues: List[queue.Queue]):
+        stage = self.stages[index]
+        out_queue = queues[index + 1] if index + 1 < len(self.stages) else None
+        try:
+            func = stage.func
+            if stage.dispatch and self.manifest is not None:
+                func = functools.partial(self._dispatch, stage)
+            for outcome in executor.map(func, self._stage_inputs(stage, queues[index], executor)):
+                if isinstance(outcome.error, concurrent.futures.CancelledError):
+                    self._cancel(outcome.task)
+                elif not outcome.is_success():
+                    self._count('failed')
+                    task = outcome.task
+                    key = task.get('key') if isinstance(task, dict) else task
+                    logger.error(f"Error in stage {stage.name} of {self.name} for {key}: {str(outcome.error)}")
+                    if self.manifest is not None:
+                        self.manifest.fail(key, outcome.error)
+                    if self.on_error is not None:
+                        try:
+                            self.on_error(stage.name, task, outcome.error)
+                        except Exception as handler_error:
+                            logger.error(f"Error handler of {self.name} failed: {str(handler_error)}")
+                elif outcome.result is None:
+                    self._count('skipped')
+                elif out_queue is not None:
+                    out_queue.put(outcome.result)
+                else:
+                    self._count('completed')
+                    if self.manifest is not None and self.mark_done:
+                        self.manifest.done(outcome.result['key'])
+        except BaseException as e:
+            # The stage cannot run anymore: stop the pipeline and drain the input queue,
+            # so that the previous stages are not blocked on a full queue
+            logger.error(f"Stage {stage.name} of {self.name} stopped: {str(e)}")
+            self._stage_error = e
+            self.stop()
+            for task in iter(queues[index].get, _STOP):
+                self._cancel(task)
+        finally:
+            # Close the next stage once all the tasks of this one are done
+            if out_queue is not None:
+                out_queue.put(_STOP)
+
+    def run(self, tasks: Iterable[Dict]) -> Dict:
+        """
+        Process the tasks and block until all of them went through the pipeline (or were dropped).
+
+        Returns:
+            Number of tasks completed, failed, skipped (dropped by a stage) and cancelled, and the elapsed time
+        """
+        self._stop_event.clear()
+        self._stats = {'completed': 0, 'failed': 0, 'skipped': 0, 'cancelled': 0}
+        self._source_error = None
+        self._stage_error = None
+        self._start_time = time.time()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        logger.info(f"Starting pipeline {self.name} with stages {self.stages}, queue size {self.queue_size}")
+        threads = [threading.Thread(target=self._feed, args=(tasks, queues[0]), name=f'{self.name}-source',
+                                    daemon=True)]
+        for index, stage in enumerate(self.stages):
+            executor = Executor.build(stage.backend, max_workers=stage.num_workers)
+            threads.append(threading.Thread(target=self._run_stage, args=(index, executor, queues),
+                                            name=f'{self.name}-{stage.name}', daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._source_error is not None:
+            raise self._source_error
+        if self._stage_error is not None:
+            raise self._stage_error
+
+        stats = dict(self._stats, elapsed_s=time.time() - self._start_time)
+        self._log_progress()
+        return stats
+
+
+@contextlib.contextmanager
+def stop_on_signals(pipeline: Pipeline, signals=(signal.SIGINT, signal.SIGTERM)):
+    """
+    Stop the pipeline gracefully on SIGINT or SIGTERM: no new task is dispatched and the calls in flight
+    are finished and stored. A second signal interrupts the run right away.
+    Signal handlers can only be set from the main thread, elsewhere the pipeline runs without them.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        if pipeline.stopped:
+            raise KeyboardInterrupt
+        logger.warning(f"Received {signal.Signals(signum).name}, finishing the tasks in flight "
+                       f"(send it again to stop right away)")
+        pipeline.stop()
+
+    previous = {sig: signal.signal(sig, handler) for sig in signals}
+    try:
+        yield
+    finally:
+        for sig, previous_handler in previous.items():
+            signal.signal(sig, previous_handler)
@@ -0,0 +1,263 @@
+import os
+from dataclasses import fields
+from typing import Dict, List
+
+import dictdatabase as DDB
+import pandas as pd
+from easyllm_kit.utils import get_logger, read_json
+from easyllm_kit.configs.llm_base_config import GenerationArguments
+
+from famma_runner.utils.data_const import DatasetColumns as DC
+from famma_runner.utils.executor_utils import get_execution_config
+from famma_runner.utils.lm_const import LanguageModel, get_language_model
+from famma_runner.utils.prompt_utils import QuestionPrompt, ProgramOfThoughtsQuestionPrompt, JudgePrompt, \
+    ReasoningDistillationPrompt
+from famma_runner.utils.pipeline_utils import filter_dataset_by_question_id, iter_main_question_groups, \
+    load_release_df
+from famma_runner.utils.token_utils import count_tokens, FALLBACK_CHARS_PER_TOKEN
+
+logger = get_logger('plan_utils', 'plan_utils.log')
+
+# Fields of LanguageModel that parameterize the planner
+PLANNER_MODEL_PARAMETERS = ['tokenizer_name', 'tokens_per_image', 'output_tokens_per_second',
+                            'time_to_first_token', 'input_price_per_mtok', 'output_price_per_mtok']
+
+
+def get_planner_parameters(model_full_name: str, planner_config=None) -> Dict:
+    """
+    Collect the per-model parameters for planning a run.
+    Defaults come from the LanguageModel dataclass, are replaced by the entry of the model in
+    lm_const.LanguageModelList if there is one, and finally by the `planner` section of the run config.
+
+    Args:
+        model_full_name: Full name of the model, e.g. 'gpt-4o-2024-08-06'
+        planner_config: Optional `planner` section of the run config
+    """
+    params = {f.name: f.default for f in fields(LanguageModel) if f.name in PLANNER_MODEL_PARAMETERS}
+    language_model = get_language_model(model_full_name)
+    if language_model is not None:
+        params.update({name: getattr(language_model, name) for name in PLANNER_MODEL_PARAMETERS})
+
+    # Rate limits of the provider and the expected share of max_length actually generated
+    params.update({'requests_per_minute': None, 'tokens_per_minute': None, 'output_fill_ratio': 1.0})
+
+    if planner_config:
+        params.update({k: v for k, v in dict(planner_config).items() if v is not None})
+    return params
+
+
+def estimate_token_counts(texts: List[str], encoding_name: str) -> List[int]:
+    """
+    Count the tokens of each text. Falls back to a character based estimate if the
+    tokenizer cannot be loaded (e.g. its files are not cached and there is no network).
+    """
+    try:
+        token_counts = count_tokens(texts, encoding_name)
+        return [token_counts[text] for text in texts]
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer {encoding_name} ({e}), estimating tokens from characters")
+        return [len(text) // FALLBACK_CHARS_PER_TOKEN + 1 for text in texts]
+
+
+def _count_images(row) -> int:
+    return sum(1 for i in range(1, 8)
+               if pd.notna(row.get(f"image_{i}")) and row.get(f"image_{i}") != 'None')
+
+
+def _load_run_df(data_config) -> pd.DataFrame:
+    """The questions of a run, loaded and filtered by data.question_id with the helpers of the runners."""
+    dataset_df = load_release_df(data_config.data_dir)
+    dataset_df, _ = filter_dataset_by_question_id(dataset_df, data_config.get('question_id'))
+    return dataset_df
+
+
+def _read_done_keys(db_name: str) -> set:
+    """Keys already stored in a result database, without creating it."""
+    db_path = os.path.join(DDB.config.storage_directory, f"{db_name}.json")
+    if not os.path.exists(db_path):
+        return set()
+    return set(read_json(db_path).keys())
+
+
+def _release_version(data_dir: str) -> str:
+    return data_dir.split('/')[-1].split('.')[0]
+
+
+def render_generation_requests(config) -> List[Dict]:
+    """One request per main question, with the images of its first sub-question."""
+    from famma_runner.runners.generation_runner import GenerationRunner
+
+    data_config = config["data"]
+    use_pot = config["model"].get('use_pot', False)
+    prompt_template = ProgramOfThoughtsQuestionPrompt.init() if use_pot else QuestionPrompt.init()
+
+    requests = []
+    for language, main_question_id, group in iter_main_question_groups(_load_run_df(data_config)):
+        group = group.sort_values(by=DC.SUB_QUESTION_ID)
+        first_row = group.iloc[0]
+        requests.append({
+            'key': f'{language}_{main_question_id}',
+            'prompt': prompt_template.format(context=first_row.get("context", ""),
+                                             sub_questions=GenerationRunner.build_sub_questions(group)),
+            'num_images': _count_images(first_row),
+        })
+    return requests
+
+
+def render_distillation_requests(config) -> List[Dict]:
+    """
+    Up to rejection_sampling.num_samples text-only requests per sub-question. This is an upper bound,
+    sampling stops early once enough samples are correct.
+    """
+    from famma_runner.runners.distillation_runner import DistillationRunner
+
+    data_config = config["data"]
+    prompt_template = ReasoningDistillationPrompt.init()
+    num_samples = max(1, int((config.get('rejection_sampling') or {}).get('num_samples', 1)))
+
+    requests = []
+    for _, _, group in iter_main_question_groups(_load_run_df(data_config)):
+        group = group.sort_values(by=DC.SUB_QUESTION_ID)
+        context = group.iloc[0].get("context", "")
+        for _, row in group.iterrows():
+            prompt = prompt_template.format(context=context, question=DistillationRunner.build_question_dict(row))
+            requests.extend({'key': row[DC.QUESTION_ID], 'prompt': prompt, 'num_images': 0}
+                            for _ in range(num_samples))
+    return requests
+
+
+def render_judge_requests(config) -> List[Dict]:
+    """One text-only request per gold sub-question, including the answer of the evaluated model."""
+    from famma_runner.runners.eval_runner import EvaluationRunner
+
+    data_config = config["data"]
+    prompt_template = JudgePrompt.init()
+
+    answers_df = EvaluationRunner.json_to_df(data_config.data_dir)
+    if data_config.get('gold_dir') is None or data_config.gold_dir == data_config.data_dir:
+        gold_df = answers_df.copy()
+    else:
+        gold_df = load_release_df(data_config.gold_dir)
+    answers_by_id = answers_df.drop_duplicates(DC.QUESTION_ID).set_index(DC.QUESTION_ID)
+
+    requests = []
+    for _, row in gold_df.iterrows():
+        gold_row = row.to_dict()
+        question_id = gold_row[DC.QUESTION_ID]
+        if question_id not in answers_by_id.index:
+            # The runner does not call the judge for questions without an answer
+            continue
+        gold_row['model_answer'] = answers_by_id.at[question_id, 'model_answer']
+        gold_row['model_explanation'] = answers_by_id.at[question_id, 'model_explanation']
+        requests.append({
+            'key': question_id,
+            'prompt': prompt_template.format(question=EvaluationRunner.build_judge_question(gold_row)),
+            'num_images': 0,
+        })
+    return requests
+
+
+def get_target_db_name(config) -> str:
+    """Name of the result database the runner of the config writes to."""
+    runner_name = config["runner_name"].lower()
+    data_config = config["data"]
+    model_config = config["model"]
+    if runner_name == 'generation':
+        return f'{model_config.model_full_name}_ans_{_release_version(data_config.data_dir)}'
+    if runner_name == 'distillation':
+        return f'{model_config.model_full_name}_distill_{_release_version(data_config.data_dir)}'
+    if runner_name == 'evaluation':
+        return f'{data_config["model_name_to_eval"]}_evaluated_by_{model_config.model_name}'
+    raise ValueError(f"Runner {runner_name} does not call a model, nothing to plan")
+
+
+def get_concurrency(config) -> int:
+    """Number of requests the runner of the config keeps in flight."""
+    concurrency = get_execution_config(config)['max_workers']
+    sampling_config = config.get('rejection_sampling') or {}
+    if config["runner_name"].lower() == 'distillation' and sampling_config:
+        num_samples = max(1, int(sampling_config.get('num_samples', 1)))
+        concurrency *= min(num_samples, max(1, int(sampling_config.get('sample_workers', num_samples))))
+    return concurrency
+
+
+REQUEST_RENDERERS = {
+    'generation': render_generation_requests,
+    'distillation': render_distillation_requests,
+    'evaluation': render_judge_requests,
+}
+
+
+def plan_run(config, skip_done: bool = True) -> Dict:
+    """
+    Estimate the tokens, requests, duration and cost of a runner config before launching it.
+    Everything is computed offline from the rendered prompts.
+
+    Args:
+        config: The runner config (as used by Runner.build_from_config)
+        skip_done: If True, leave out requests whose results are already in the target database
+
+    Returns:
+        Dictionary with the plan of the run
+    """
+    runner_name = config["runner_name"].lower()
+    if runner_name not in REQUEST_RENDERERS:
+        raise ValueError(f"Runner {runner_name} does not call a model, nothing to plan")
+
+    model_full_name = config["model"].get('model_full_name') or config["model"].model_name
+    params = get_planner_parameters(model_full_name, config.get('planner'))
+    max_length = config.get('generation', {}).get('max_length', GenerationArguments().max_length)
+
+    requests = REQUEST_RENDERERS[runner_name](config)
+    target_db_name = get_target_db_name(config)
+    done_keys = _read_done_keys(target_db_name) if skip_done else set()
+    pending = [request for request in requests if request['key'] not in done_keys]
+
+    prompt_tokens = estimate_token_counts([request['prompt'] for request in pending], params['tokenizer_name'])
+    num_images = sum(request['num_images'] for request in pending)
+    input_text_tokens = sum(prompt_tokens)
+    image_tokens = num_images * params['tokens_per_image']
+    input_tokens = input_text_tokens + image_tokens
+    output_tokens_upper_bound = len(pending) * max_length
+    expected_output_tokens = int(output_tokens_upper_bound * params['output_fill_ratio'])
+
+    # Duration is bounded by request latency under the configured concurrency and by the rate limits
+    concurrency = get_concurrency(config)
+    expected_output_per_request = max_length * params['output_fill_ratio']
+    request_latency = params['time_to_first_token'] + expected_output_per_request / params['output_tokens_per_second']
+    duration_bounds = {'latency': len(pending) * request_latency / concurrency}
+    if params['requests_per_minute']:
+        duration_bounds['requests_per_minute'] = len(pending) / params['requests_per_minute'] * 60
+    if params['tokens_per_minute']:
+        duration_bounds['tokens_per_minute'] = (input_tokens + expected_output_tokens) / params['tokens_per_minute'] * 60
+    bound_by = max(duration_bounds, key=duration_bounds.get)
+
+    plan = {
+        'runner_name': runner_name,
+        'model': model_full_name,
+        'target_db_name': target_db_name,
+        'num_requests_total': len(requests),
+        'num_requests_done': len(requests) - len(pending),
+        'num_requests': len(pending),
+        'num_images': num_images,
+        'input_text_tokens': input_text_tokens,
+        'image_tokens': image_tokens,
+        'input_tokens': input_tokens,
+        'max_input_tokens_per_request': max(prompt_tokens, default=0),
+        'output_tokens_upper_bound': output_tokens_upper_bound,
+        'expected_output_tokens': expected_output_tokens,
+        'concurrency': concurrency,
+        'estimated_request_latency_seconds': round(request_latency, 2),
+        'estimated_duration_seconds': round(duration_bounds[bound_by], 1),
+        'duration_bound_by': bound_by,
+        'estimated_cost_usd': None,
+        'parameters': params,
+    }
+    if params['input_price_per_mtok'] is not None and params['output_price_per_mtok'] is not None:
+        plan['estimated_cost_usd'] = round((input_tokens * params['input_price_per_mtok']
+                                            + expected_output_tokens * params['output_price_per_mtok']) / 1e6, 4)
+
+    logger.info(f"Plan for {target_db_name}: {len(pending)} requests, {input_tokens} input tokens, "
+                f"<= {output_tokens_upper_bound} output tokens, ~{plan['estimated_duration_seconds']}s "
+                f"(bound by {bound_by})")
+    return plan
@@ -0,0 +1,215 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from easyllm_kit.utils import get_logger, read_json
+from famma_runner.utils.path_utils import resolve_image_path
+
+logger = get_logger('snapshot_utils', 'snapshot_utils.log')
+
+# A packed release is laid out as
+#   MAGIC (8 bytes) | header length (uint64, little endian) | header (json) | data section
+# The header holds the offset/length (relative to the start of the data section) of every
+# question record (json encoded) and every image (original encoded bytes).
+PACKED_RELEASE_MAGIC = b'FAMMAPK1'
+PACKED_RELEASE_SUFFIX = '.famma'
+PACKED_RELEASE_FORMAT_VERSION = 1
+
+_HEADER_LENGTH_STRUCT = struct.Struct('<Q')
+
+
+def _image_columns(record: Dict) -> List[str]:
+    """Image columns (question and answer images) of a record."""
+    return [key for key in record.keys()
+            if (key.startswith('image_') and key != 'image_type') or key.startswith('ans_image_')]
+
+
+class PackedRelease:
+    """
+    Read-only view on a packed release snapshot.
+
+    The file is memory-mapped, so opening it only parses the header and every record or
+    image lookup is a dictionary lookup plus a slice of the mapping.
+
+    Example:
+        >>> with PackedRelease('./hf_data/release_basic.famma') as release:
+        ...     record = release.get_record('english_1_1_r1')
+        ...     image_bytes = release.read_image(record['image_1'])
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic = self._mmap[:len(PACKED_RELEASE_MAGIC)]
+        if magic != PACKED_RELEASE_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a packed release snapshot")
+
+        header_start = len(PACKED_RELEASE_MAGIC) + _HEADER_LENGTH_STRUCT.size
+        (header_length,) = _HEADER_LENGTH_STRUCT.unpack_from(self._mmap, len(PACKED_RELEASE_MAGIC))
+        header = json.loads(self._mmap[header_start:header_start + header_length].decode('utf-8'))
+
+        self.release = header['release']
+        self._data_start = header_start + header_length
+        # question_id -> (offset, length), kept in dataset order
+        self._records = {question_id: (offset, length) for question_id, offset, length in header['records']}
+        # image key -> (offset, length)
+        self._images = {key: (offset, length) for key, offset, length in header['images']}
+
+    def _slice(self, offset: int, length: int) -> bytes:
+        start = self._data_start + offset
+        return self._mmap[start:start + length]
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, question_id: str) -> bool:
+        return question_id in self._records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def question_ids(self) -> List[str]:
+        return list(self._records.keys())
+
+    @property
+    def image_keys(self) -> List[str]:
+        return list(self._images.keys())
+
+    def get_record(self, question_id: str) -> Dict:
+        """Return the question record for a question_id."""
+        return json.loads(self._slice(*self._records[question_id]).decode('utf-8'))
+
+    def records(self) -> List[Dict]:
+        """Return all question records in dataset order, i.e., the content of the release json."""
+        return [self.get_record(question_id) for question_id in self._records]
+
+    def has_image(self, key: str) -> bool:
+        return key in self._images
+
+    def read_image(self, key: str) -> bytes:
+        """
+        Return the encoded bytes of an image.
+
+        Args:
+            key: The image path as referenced in the question record, e.g. 'images_release_basic/xx_image_1.jpg'
+        """
+        if key not in self._images:
+            raise FileNotFoundError(f"Image {key} not found in packed release {self.path}")
+        return self._slice(*self._images[key])
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def is_packed_release(path) -> bool:
+    """Check whether the path points to a packed release snapshot."""
+    if not isinstance(path, (str, os.PathLike)) or not os.path.isfile(path):
+        return False
+    if str(path).endswith(PACKED_RELEASE_SUFFIX):
+        return True
+    with open(path, 'rb') as f:
+        return f.read(len(PACKED_RELEASE_MAGIC)) == PACKED_RELEASE_MAGIC
+
+
+@lru_cache(maxsize=None)
+def open_packed_release(path: str) -> PackedRelease:
+    """Open a packed release once per process and share the mapping between callers."""
+    return PackedRelease(path)
+
+
+def load_release(data_dir: str) -> List[Dict]:
+    """
+    Load the question records of a release from either the release json or a packed snapshot.
+    """
+    if is_packed_release(data_dir):
+        return open_packed_release(data_dir).records()
+    return read_json(data_dir)
+
+
+def get_release_image_source(data_dir: str):
+    """
+    Return where the images of a release are read from: the packed snapshot itself
+    or the parent directory of the release json.
+    """
+    if is_packed_release(data_dir):
+        return data_dir
+    return os.path.dirname(data_dir)
+
+
+def pack_release(data_dir: str, output_path: Optional[str] = None) -> str:
+    """
+    Pack a release json and all images it references into a single snapshot file.
+
+    Args:
+        data_dir: Path to the release json, e.g. './hf_data/release_basic.json'
+        output_path: Path of the snapshot, defaults to the release json path with the '.famma' suffix
+
+    Returns:
+        Path to the written snapshot
+    """
+    if output_path is None:
+        output_path = os.path.splitext(data_dir)[0] + PACKED_RELEASE_SUFFIX
+
+    data = read_json(data_dir)
+    parent_dir = os.path.dirname(data_dir)
+    release = os.path.basename(data_dir).split('.')[0]
+
+    record_index = []
+    image_index = {}
+    offset = 0
+
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    # Write the data section first, as the header size depends on the offsets
+    with tempfile.TemporaryFile(dir=output_dir) as data_file:
+        for record in data:
+            for image_key in _image_columns(record):
+                image_name = record[image_key]
+                if not isinstance(image_name, str) or image_name == 'None' or image_name in image_index:
+                    continue
+                with open(resolve_image_path(parent_dir, image_name), 'rb') as f:
+                    image_bytes = f.read()
+                data_file.write(image_bytes)
+                image_index[image_name] = (offset, len(image_bytes))
+                offset += len(image_bytes)
+
+            record_bytes = json.dumps(record, ensure_ascii=False).encode('utf-8')
+            data_file.write(record_bytes)
+            record_index.append((record['question_id'], offset, len(record_bytes)))
+            offset += len(record_bytes)
+
+        header = json.dumps({
+            'format_version': PACKED_RELEASE_FORMAT_VERSION,
+            'release': release,
+            'records': record_index,
+            'images': [(key, image_offset, length) for key, (image_offset, length) in image_index.items()],
+        }, ensure_ascii=False).encode('utf-8')
+
+        # Write to a temporary file and move it in place so readers never see a partial snapshot
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(PACKED_RELEASE_MAGIC)
+            f.write(_HEADER_LENGTH_STRUCT.pack(len(header)))
+            f.write(header)
+            data_file.seek(0)
+            shutil.copyfileobj(data_file, f, length=16 * 1024 * 1024)
+        os.replace(tmp_path, output_path)
+
+    logger.info(f"Packed {len(record_index)} questions and {len(image_index)} images of {release} into {output_path}")
+    return output_path
@@ -0,0 +1,227 @@
+import glob
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+from easyllm_kit.utils import get_logger
+
+from famma_runner.utils.token_utils import count_text_tokens, load_encoding
+
+logger = get_logger('telemetry_utils', 'telemetry_utils.log')
+
+DEFAULT_TELEMETRY_DIR = './telemetry'
+
+# Tags attached to every event of a call, runner and model are set by the recorder
+TELEMETRY_TAGS = ['runner', 'model', 'key', 'attempt', 'language', 'difficulty']
+
+# Breakdowns of the summary, every breakdown is also split by runner and model
+TELEMETRY_BREAKDOWNS = {
+    'overall': [],
+    'language': ['language'],
+    'difficulty': ['difficulty'],
+    'num_images': ['num_images'],
+}
+
+LATENCY_PERCENTILES = [50, 95, 99]
+
+
+def _payload_bytes(image) -> int:
+    """Bytes sent for one image: the base64 string itself, or the size of the file for Path images."""
+    if isinstance(image, (str, bytes)):
+        return len(image)
+    try:
+        return os.path.getsize(image)
+    except (OSError, TypeError):
+        return 0
+
+
+def _split_response(response):
+    """Split a model response into (completion text, reasoning text)."""
+    if response is None:
+        return '', ''
+    if isinstance(response, dict):
+        return str(response.get('content', '') or ''), str(response.get('reasoning_content', '') or '')
+    return str(response), ''
+
+
+class TelemetryRecorder:
+    """
+    Record one structured event per provider call as a line of a JSONL file.
+
+    Events hold the latency of the call, the prompt, completion and reasoning tokens, the number of images
+    and the payload size, and the error if the call failed. They are tagged with the runner and the model,
+    and with the key and attempt of the call through `bind`. Events are appended under a lock, so one
+    recorder can be shared by all worker threads of a runner.
+
+    Tokens are counted with the tiktoken encoding `tokenizer_name`, or estimated from characters if the
+    encoding cannot be loaded, since the providers do not return their usage through easyllm_kit.
+
+    Example:
+        >>> recorder = TelemetryRecorder('./telemetry/gpt-4o_generation.jsonl', runner='generation', model='gpt-4o')
+        >>> telemetry = recorder.bind(key='english_12', attempt=0, language='english', difficulty='hard')
+        >>> generate_response_from_llm(llm, prompt, images, telemetry=telemetry)
+    """
+
+    def __init__(self, path: str, runner: str, model: str, tokenizer_name: Optional[str] = 'cl100k_base'):
+        self.path = path
+        self.runner = runner
+        self.model = model
+        self.num_events = 0
+        self._lock = threading.Lock()
+        # Loaded once, so a missing tokenizer does not cost a download attempt on every call
+        self._encoding = load_encoding(tokenizer_name)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def count_tokens(self, text: str) -> int:
+        return count_text_tokens(text, self._encoding)
+
+    def bind(self, **tags) -> "TelemetryContext":
+        """Tag the events of a call, e.g. with key, attempt, language and difficulty."""
+        return TelemetryContext(self, tags)
+
+    def record(self, tags: Dict, prompt: str, images: Optional[List] = None, latency: float = 0.0,
+               response=None, error: Optional[BaseException] = None, ocr_latency: Optional[float] = None) -> Dict:
+        """
+        Build the event of one call and append it to the JSONL file. With OCR (ocr_latency set), the images
+        were turned into text locally: they are counted but not part of the payload.
+        """
+        completion, reasoning = _split_response(response)
+        images = images or []
+        prompt_bytes = len(prompt.encode('utf-8')) if isinstance(prompt, str) else 0
+        image_bytes = 0 if ocr_latency is not None else sum(_payload_bytes(image) for image in images)
+        completion_tokens = self.count_tokens(completion)
+        reasoning_tokens = self.count_tokens(reasoning)
+
+        event = {'timestamp': time.time(), 'runner': self.runner, 'model': self.model}
+        event.update({tag: tags.get(tag) for tag in TELEMETRY_TAGS if tag not in event})
+        event.update({
+            'latency_s': latency,
+            'ocr_latency_s': ocr_latency,
+            'prompt_tokens': self.count_tokens(prompt) if isinstance(prompt, str) else 0,
+            'completion_tokens': completion_tokens,
+            'reasoning_tokens': reasoning_tokens,
+            'tokens_per_second': (completion_tokens + reasoning_tokens) / latency if latency > 0 else None,
+            'num_images': len(images),
+            'prompt_bytes': prompt_bytes,
+            'image_bytes': image_bytes,
+            'payload_bytes': prompt_bytes + image_bytes,
+            'status': 'ok' if error is None else 'error',
+            'error': None if error is None else f"{type(error).__name__}: {error}",
+        })
+
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+            self.num_events += 1
+        return event
+
+
+class TelemetryContext:
+    """A recorder with the tags of one call, passed to generate_response_from_llm."""
+
+    def __init__(self, recorder: TelemetryRecorder, tags: Dict):
+        self.recorder = recorder
+        self.tags = tags
+
+    def record(self, prompt: str, images: Optional[List] = None, latency: float = 0.0,
+               response=None, error: Optional[BaseException] = None, ocr_latency: Optional[float] = None) -> Dict:
+        return self.recorder.record(self.tags, prompt, images, latency, response, error, ocr_latency)
+
+
+def setup_telemetry(config, runner: str, model: str) -> Optional[TelemetryRecorder]:
+    """
+    Create the recorder of a runner from the `telemetry` section of its config, None if telemetry is disabled.
+
+    The events are written to `telemetry.path`, by default ./telemetry/<model>_<runner>.jsonl.
+    """
+    telemetry_config = dict(config.get('telemetry') or {})
+    if not telemetry_config.get('enabled', False):
+        return None
+    path = telemetry_config.get('path') or os.path.join(DEFAULT_TELEMETRY_DIR,
+                                                        f"{model.replace('/', '_')}_{runner}.jsonl")
+    recorder = TelemetryRecorder(path, runner=runner, model=model,
+                                 tokenizer_name=telemetry_config.get('tokenizer_name', 'cl100k_base'))
+    logger.info(f"Recording telemetry of the {runner} calls of {model} to {path}")
+    return recorder
+
+
+def load_telemetry(paths: Union[str, List[str]]) -> pd.DataFrame:
+    """
+    Load telemetry events into a DataFrame.
+
+    Args:
+        paths: JSONL files, directories of JSONL files or glob patterns
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.jsonl'))))
+        else:
+            files.extend(sorted(glob.glob(path)))
+
+    events = []
+    for file in files:
+        with open(file, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    events.append(json.loads(line))
+    logger.info(f"Loaded {len(events)} telemetry events from {len(files)} files")
+    return pd.DataFrame(events)
+
+
+def _summarize_group(df: pd.DataFrame) -> Dict:
+    ok = df[df['status'] == 'ok']
+    latencies = ok['latency_s'].to_numpy(dtype=np.float64)
+    generated_tokens = ok['completion_tokens'].sum() + ok['reasoning_tokens'].sum()
+    total_latency = latencies.sum()
+
+    summary = {'num_calls': len(df), 'num_errors': int((df['status'] != 'ok').sum())}
+    summary['error_rate'] = summary['num_errors'] / len(df) if len(df) else np.nan
+    for q, value in zip(LATENCY_PERCENTILES, np.percentile(latencies, LATENCY_PERCENTILES) if len(latencies)
+                        else [np.nan] * len(LATENCY_PERCENTILES)):
+        summary[f'latency_p{q}'] = value
+    # Throughput of the successful calls: generated tokens over the time spent waiting for them
+    summary['tokens_per_second'] = generated_tokens / total_latency if total_latency > 0 else np.nan
+    summary['mean_prompt_tokens'] = ok['prompt_tokens'].mean()
+    summary['mean_completion_tokens'] = ok['completion_tokens'].mean()
+    summary['mean_reasoning_tokens'] = ok['reasoning_tokens'].mean()
+    summary['mean_payload_bytes'] = df['payload_bytes'].mean()
+    # Local OCR time, kept out of the provider latency
+    summary['mean_ocr_latency'] = df['ocr_latency_s'].mean() if 'ocr_latency_s' in df else np.nan
+    return summary
+
+
+def summarize_telemetry(df: pd.DataFrame, breakdowns: Optional[Dict[str, List[str]]] = None) -> pd.DataFrame:
+    """
+    Latency percentiles, throughput and error rates of the calls, per runner and model and per breakdown.
+
+    Args:
+        df: Events as loaded by load_telemetry
+        breakdowns: Dict breakdown name -> columns to group by, defaults to TELEMETRY_BREAKDOWNS
+
+    Returns:
+        One row per breakdown group, with the 'breakdown' and 'group' of the row
+    """
+    breakdowns = breakdowns or TELEMETRY_BREAKDOWNS
+    rows, metrics = [], []
+    for name, columns in breakdowns.items():
+        group_by = ['runner', 'model'] + [column for column in columns if column in df.columns]
+        for key, group in df.groupby(group_by, dropna=False, sort=True):
+            row = dict(zip(group_by, key))
+            row['breakdown'] = name
+            row['group'] = '_'.join(str(row[column]) for column in group_by[2:]) or 'all'
+            group_summary = _summarize_group(group)
+            metrics = list(group_summary)
+            row.update(group_summary)
+            rows.append(row)
+
+    return pd.DataFrame(rows, columns=['runner', 'model', 'breakdown', 'group'] + metrics)
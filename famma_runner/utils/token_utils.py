@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+import tiktoken
+from easyllm_kit.utils import get_logger, read_json
+
+from famma_runner.utils.snapshot_utils import load_release
+
+logger = get_logger('token_utils', 'token_utils.log')
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# Rough characters per token, used when the tokenizer files are not available offline
+FALLBACK_CHARS_PER_TOKEN = 4
+
+# Token count columns stored in the sidecar file of a release
+TOKEN_COUNT_COLUMNS = ["question_tokens", "context_tokens", "options_tokens"]
+
+
+def get_first_sub_question_id(question_id):
+    """
+    Get the first sub-question id from the question id
+    """
+    question_id_parts = question_id.split("_")
+    question_id_parts[2] = "1"
+    return "_".join(question_id_parts)
+
+
+def build_context_index(data):
+    """
+    Map every question_id to its context, so that the context of a main question
+    (stored in its first sub-question) can be looked up in O(1).
+    """
+    return {item["question_id"]: item["context"] for item in data}
+
+
+def count_tokens(texts: Iterable[str], encoding_name: str = DEFAULT_ENCODING, num_threads: int = 8) -> Dict[str, int]:
+    """
+    Count the tokens of each unique text, tokenizing them in one threaded batch.
+
+    Args:
+        texts: Iterable of strings, duplicates are only tokenized once
+        encoding_name: Name of the tiktoken encoding
+        num_threads: Number of threads used by tiktoken's encode_batch
+
+    Returns:
+        Dictionary mapping each unique text to its token count
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    if not unique_texts:
+        return {}
+    tokenizer = tiktoken.get_encoding(encoding_name)
+    encoded = tokenizer.encode_batch(unique_texts, num_threads=num_threads)
+    return {text: len(tokens) for text, tokens in zip(unique_texts, encoded)}
+
+
+def load_encoding(encoding_name: str = DEFAULT_ENCODING):
+    """
+    Load a tiktoken encoding once, None if it cannot be loaded (e.g. its files are not cached and
+    there is no network) or no encoding_name is given, in which case count_text_tokens estimates tokens
+    from characters.
+    """
+    if not encoding_name:
+        return None
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer {encoding_name} ({e}), estimating tokens from characters")
+        return None
+
+
+def count_text_tokens(text: str, encoding=None) -> int:
+    """Count the tokens of one text with an encoding returned by load_encoding."""
+    if not text:
+        return 0
+    if encoding is None:
+        return len(text) // FALLBACK_CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def format_options(options) -> str:
+    """Render the options of a question as plain text, one option per line."""
+    if options is None:
+        return ""
+    if isinstance(options, (list, tuple)):
+        return "\n".join(str(option) for option in options)
+    return str(options)
+
+
+def text_hash(*texts: str) -> str:
+    """Short digest of the texts a row's token counts were computed from."""
+    return hashlib.blake2b(json.dumps(texts, ensure_ascii=False).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def get_token_counts_path(data_dir: str, encoding_name: str = DEFAULT_ENCODING) -> str:
+    """
+    Path of the token count sidecar of a release,
+    e.g. ./hf_data/release_basic.tokens.cl100k_base.json for ./hf_data/release_basic.json
+    """
+    return f"{os.path.splitext(data_dir)[0]}.tokens.{encoding_name}.json"
+
+
+class TokenCounts:
+    """
+    Per-question token counts of a release, stored column-wise:
+
+        {
+            "encoding": "cl100k_base",
+            "question_id": [...],
+            "text_hash": [...],
+            "question_tokens": [...],
+            "context_tokens": [...],
+            "options_tokens": [...]
+        }
+
+    context_tokens is the token count of the context of the main question (stored in its first
+    sub-question), i.e., the context that is sent along with every sub-question.
+    """
+
+    def __init__(self, columns: Dict[str, List]):
+        self.columns = columns
+        self.encoding = columns["encoding"]
+        self._index = {question_id: idx for idx, question_id in enumerate(columns["question_id"])}
+
+    @classmethod
+    def empty(cls, encoding_name: str = DEFAULT_ENCODING) -> "TokenCounts":
+        columns = {"encoding": encoding_name, "question_id": [], "text_hash": []}
+        columns.update({column: [] for column in TOKEN_COUNT_COLUMNS})
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path: str) -> "TokenCounts":
+        return cls(read_json(path))
+
+    def save(self, path: str):
+        # Write to a temporary file and move it in place so that readers never see a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.columns, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, question_id: str) -> bool:
+        return question_id in self._index
+
+    def get_hash(self, question_id: str) -> Optional[str]:
+        idx = self._index.get(question_id)
+        return None if idx is None else self.columns["text_hash"][idx]
+
+    def get(self, question_id: str) -> Dict[str, int]:
+        """Return the token counts of a question, e.g. {'question_tokens': 12, 'context_tokens': 80, ...}"""
+        idx = self._index[question_id]
+        return {column: self.columns[column][idx] for column in TOKEN_COUNT_COLUMNS}
+
+    def column(self, name: str) -> List:
+        return self.columns[name]
+
+
+def load_token_counts(data_dir: str, encoding_name: str = DEFAULT_ENCODING) -> Optional[TokenCounts]:
+    """Load the token count sidecar of a release, None if it has not been computed."""
+    path = get_token_counts_path(data_dir, encoding_name)
+    if not os.path.exists(path):
+        return None
+    return TokenCounts.load(path)
+
+
+def precompute_token_counts(data_dir: str, encoding_name: str = DEFAULT_ENCODING, num_threads: int = 8,
+                            data: Optional[List[Dict]] = None) -> TokenCounts:
+    """
+    Compute question/context/options token counts of a release and store them in a sidecar file
+    next to it. Rows whose texts did not change since the last run (same text hash) are reused,
+    so only new or edited questions are tokenized.
+
+    Args:
+        data_dir: Path to the release json (or packed release snapshot)
+        encoding_name: Name of the tiktoken encoding
+        num_threads: Number of threads used for tokenization
+        data: Already loaded records of the release, loaded from data_dir if None
+
+    Returns:
+        The up-to-date TokenCounts of the release
+    """
+    if data is None:
+        data = load_release(data_dir)
+    path = get_token_counts_path(data_dir, encoding_name)
+    existing = load_token_counts(data_dir, encoding_name) or TokenCounts.empty(encoding_name)
+
+    context_index = build_context_index(data)
+    rows = []
+    for item in data:
+        first_sub_question_id = get_first_sub_question_id(item["question_id"])
+        if first_sub_question_id not in context_index:
+            raise ValueError(f"Context not found for question id: {first_sub_question_id}")
+        question = item["question"] or ""
+        context = context_index[first_sub_question_id] or ""
+        options = format_options(item.get("options"))
+        rows.append((item["question_id"], text_hash(question, context, options), question, context, options))
+
+    stale_rows = [row for row in rows if existing.get_hash(row[0]) != row[1]]
+    token_counts = count_tokens([text for row in stale_rows for text in row[2:]], encoding_name, num_threads)
+
+    updated = TokenCounts.empty(encoding_name)
+    stale_ids = {row[0] for row in stale_rows}
+    for question_id, row_hash, question, context, options in rows:
+        if question_id in stale_ids:
+            counts = [token_counts[question], token_counts[context], token_counts[options]]
+        else:
+            counts = [existing.get(question_id)[column] for column in TOKEN_COUNT_COLUMNS]
+        updated.columns["question_id"].append(question_id)
+        updated.columns["text_hash"].append(row_hash)
+        for column, count in zip(TOKEN_COUNT_COLUMNS, counts):
+            updated.columns[column].append(count)
+    updated = TokenCounts(updated.columns)
+
+    if stale_rows or len(existing) != len(updated):
+        updated.save(path)
+        logger.info(f"Updated token counts of {len(stale_rows)}/{len(rows)} questions in {path}")
+    return updated
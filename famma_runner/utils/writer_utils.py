@@ -0,0 +1,150 @@
+import queue
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+import dictdatabase as DDB
+from easyllm_kit.utils import get_logger
+
+logger = get_logger('writer_utils', 'writer_utils.log')
+
+_STOP = object()
+
+
+class ResultWriter:
+    """
+    Persist the results of concurrent workers through a single writer thread.
+
+    Workers put results on a queue, and the writer thread stores everything that queued up
+    while it was busy in one database session, so the database file is rewritten once per batch
+    instead of once per result and is never written by two threads at the same time.
+
+    The writer also keeps the set of keys that are stored, queued or being worked on, which backs
+    the skip logic of the workers: a key is only processed by the worker that claimed it.
+
+    Example:
+        >>> with ResultWriter('gpt-4o_distill_release_basic', existing_keys=target_db.keys()) as writer:
+        ...     if writer.claim(question_id):
+        ...         writer.put(question_id, result)
+    """
+
+    def __init__(self, db_name: str, existing_keys: Iterable[str] = (), batch_size: int = 64,
+                 transform: Optional[Callable[[Dict], Dict]] = None,
+                 on_written: Optional[Callable[[List[str]], None]] = None):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        # Applied to every record on the writer thread before it is stored, e.g. compression
+        self.transform = transform
+        # Called with the keys of every batch once it is stored, e.g. to mark them done in a run manifest
+        self.on_written = on_written
+        self.num_written = 0
+
+        self._done = set(existing_keys)
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._error = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._done
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f'writer-{self.db_name}', daemon=True)
+            self._thread.start()
+
+    @property
+    def failed(self) -> bool:
+        """True once the writer thread stopped on an error, no result can be stored anymore."""
+        return self._error is not None
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(f"Writer of {self.db_name} failed") from self._error
+
+    def claim(self, key: str) -> bool:
+        """
+        Reserve a key for the calling worker.
+
+        Returns:
+            False if the key is already stored, queued or claimed by another worker, True otherwise
+
+        Raises:
+            RuntimeError: If the writer thread failed, so that workers stop before paying for results
+                that could not be stored
+        """
+        self._raise_if_failed()
+        with self._lock:
+            if key in self._done or key in self._claimed:
+                return False
+            self._claimed.add(key)
+            return True
+
+    def release(self, key: str):
+        """Give up a claimed key without a result, e.g. after a failed request, so it can be retried."""
+        with self._lock:
+            self._claimed.discard(key)
+
+    def put(self, key: str, value: Dict):
+        """Queue a result for writing, the key counts as done from now on."""
+        if self._error is not None:
+            self.release(key)
+            self._raise_if_failed()
+        with self._lock:
+            self._done.add(key)
+            self._claimed.discard(key)
+        self._queue.put((key, value))
+
+    def _write_batch(self, batch: Dict):
+        with DDB.at(self.db_name).session() as (sess, obj):
+            obj.update(batch)
+            sess.write()
+        self.num_written += len(batch)
+        logger.info(f"Stored {len(batch)} records in {self.db_name} ({self.num_written} in total)")
+
+    def _run(self):
+        stop = False
+        while not stop:
+            items = [self._queue.get()]
+            # Take everything that queued up while the previous batch was written
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            batch = {}
+            for item in items:
+                if item is _STOP:
+                    stop = True
+                else:
+                    batch[item[0]] = item[1]
+            if not batch:
+                continue
+            try:
+                if self.transform is not None:
+                    batch = {key: self.transform(value) for key, value in batch.items()}
+                self._write_batch(batch)
+                if self.on_written is not None:
+                    self.on_written(list(batch))
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} records to {self.db_name}: {str(e)}")
+                self._error = e
+                return
+
+    def close(self):
+        """Write the remaining results and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._raise_if_failed()
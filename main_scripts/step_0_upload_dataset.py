@@ -2,10 +2,15 @@ import pandas as pd
 from datasets import Dataset, DatasetDict, Image
 from huggingface_hub import HfApi
 import ast
+import hashlib
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from omegaconf import OmegaConf
 from easyllm_kit.utils import get_logger
-from famma_runner.utils import find_image_file, DC, ReleaseVersion, LANGUAGE_ORDER, encode_answer
+from famma_runner.utils import index_image_dir, DC, ReleaseVersion, LANGUAGE_ORDER, encode_answer
 from PIL import Image
 import re
 logger = get_logger('dataset_maker', '../question_maker.log')
@@ -170,14 +175,104 @@ def validate_columns(df):
 
     return True
 
-def prepare_dataset(csv_path, image_parent_dir, version, mask_answer=False):
+# Number of main questions whose images are loaded ahead of the record being written, per image worker
+IMAGE_PREFETCH_PER_WORKER = 4
+
+
+def parse_options(row):
+    """Convert options from string to list if it exists and question is multiple-choice."""
+    if row[DC.QUESTION_TYPE] != 'multiple-choice' or pd.isna(row[DC.OPTIONS]):
+        return None
+    try:
+        return ast.literal_eval(row[DC.OPTIONS])
+    except (ValueError, SyntaxError):
+        logger.warning(f"Invalid format in OPTIONS for question {row[DC.QUESTION_ID]}")
+        return None
+
+
+def resolve_image_columns(df, image_parent_dir, image_keys, parent_dir_column, is_first_subquestion):
+    """
+    Resolve the images of the first sub-questions to files, listing every image directory once
+    instead of looking up each image with its possible extensions.
+
+    Returns:
+        Dict from image column to a Series of paths (None where there is no image)
+    """
+    # Construct the image directories by joining parent_dir + subdir
+    image_dirs = image_parent_dir + df[parent_dir_column].astype(str).str[3:]
+    dir_indexes = {}
+    resolved = {}
+    for image_key in image_keys:
+        paths = pd.Series(None, index=df.index, dtype=object)
+        names = df.loc[is_first_subquestion, image_key].dropna()
+        for idx, image_name in names.items():
+            image_name = image_name.split('.')[0]
+            image_dir = image_dirs[idx]
+            if image_dir not in dir_indexes:
+                dir_indexes[image_dir] = index_image_dir(image_dir)
+            full_path = dir_indexes[image_dir].get(image_name)
+            if full_path is None:
+                logger.warning(f"Image not found: {Path(image_dir) / image_name}.[jpg|png]")
+            else:
+                paths[idx] = str(full_path)
+        resolved[image_key] = paths
+    return resolved
+
+
+def load_image(path):
+    """Read an image file and check that it decodes, as the Image feature of the dataset stores it."""
+    with open(path, 'rb') as f:
+        image_bytes = f.read()
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.verify()
+    except Exception as e:
+        raise ValueError(f"Invalid image {path}: {str(e)}") from e
+    return {'bytes': image_bytes, 'path': path}
+
+
+def generate_samples(shards, image_keys, image_workers=8):
+    """
+    Yield the samples of the shards in order, with their images loaded by a thread pool.
+    Only the images of the next image_workers * IMAGE_PREFETCH_PER_WORKER samples are in memory at once,
+    the samples written are flushed to the Arrow file of the dataset.
+    """
+    window = max(1, image_workers * IMAGE_PREFETCH_PER_WORKER)
+    with ThreadPoolExecutor(max_workers=max(1, image_workers)) as executor:
+        for shard in shards:
+            pending = deque()
+            for sample in shard:
+                pending.append((sample, {image_key: executor.submit(load_image, sample[image_key])
+                                         for image_key in image_keys if sample[image_key] is not None}))
+                if len(pending) > window:
+                    yield finish_sample(*pending.popleft())
+            while pending:
+                yield finish_sample(*pending.popleft())
+
+
+def finish_sample(sample, image_futures):
+    sample = dict(sample)
+    for image_key, future in image_futures.items():
+        sample[image_key] = future.result()
+    return sample
+
+
+def prepare_dataset(csv_path, image_parent_dir, version, mask_answer=False, image_workers=8, num_proc=None):
     """
     Prepare dataset from CSV and convert it to HuggingFace format.
-    
+
+    The columns are built for all rows at once, the images are resolved from one listing per image directory,
+    and the samples are streamed into the dataset by Dataset.from_generator, one shard per release
+    (and language) with their images loaded by a thread pool, so the memory does not grow with the images.
+    A build from the same CSV and images is reused from the datasets cache.
+
     Args:
         csv_path: Path to CSV file
         image_parent_dir: Path to image directory
         version: Version to use as split name
+        mask_answer: Whether to encode the answers and explanations
+        image_workers: Number of threads loading and validating the images
+        num_proc: Number of processes building the shards, one by default
     """
     # Read CSV file
     df = pd.read_csv(csv_path, header=0)
@@ -202,119 +297,82 @@ def prepare_dataset(csv_path, image_parent_dir, version, mask_answer=False):
     # Add index column
     df[DC.INDEX] = range(len(df))
 
-    def process_row(row, is_first_subquestion):
-        """Process a single row, attaching images only if it's the first sub-question"""
-        # Convert options from string to list if it exists and question is multiple-choice
-        options = None
-        if row[DC.QUESTION_TYPE] == 'multiple-choice' and pd.notna(row[DC.OPTIONS]):
-            try:
-                options = ast.literal_eval(row[DC.OPTIONS])
-            except (ValueError, SyntaxError):
-                logger.warning(f"Invalid format in OPTIONS for question {row[DC.QUESTION_ID]}")
-                options = None
-
-        # Get short release name
-        release_short = ReleaseVersion.to_short_name(row[DC.RELEASE])
-
-        # question id = language + main_question_id + sub_question_id + release_short
-        question_id = f"{row[DC.LANGUAGE]}_{row[DC.MAIN_QUESTION_ID]}_{row[DC.SUB_QUESTION_ID]}_{release_short}"
-
-        sample = {
-            DC.INDEX: row[DC.INDEX],
-            DC.QUESTION_ID: question_id,
-            DC.CONTEXT: row[DC.CONTEXT],
-            DC.QUESTION: row[DC.QUESTION],
-            DC.OPTIONS: options,
-        }
-
-        # Add image columns - only if this is the first sub-question
-        for i in range(1, 8):
-            image_key = f'image_{i}'
-            if is_first_subquestion and version.split('_')[-1] != 'txt':
-                image_name = row[image_key]
-                if pd.notna(image_name):
-                    image_name = image_name.split('.')[0]
-                    # Construct full image path by joining parent_dir + subdir + filename
-                    image_path = Path(image_parent_dir + row['question_image_parent_dir'][3:]) / image_name
-                    # Try to find image with either jpg or png extension
-                    full_path = find_image_file(image_path.parent, image_path.name)
-                    if full_path is not None:
-                        # Read the image file into PIL Image
-                        img = Image.open(full_path)
-                        # Store the PIL Image object directly
-                        sample[image_key] = img
-                    else:
-                        logger.warning(f"Image not found: {image_path}.[jpg|png]")
-                        sample[image_key] = None
-                else:
-                    sample[image_key] = None
-            else:
-                sample[image_key] = None
-
-        sample[DC.IMAGE_TYPE] = row[DC.IMAGE_TYPE]
-
-        if mask_answer:
-            sample[DC.ANSWER] = encode_answer(row[DC.ANSWER])
-            sample[DC.EXPLANATION] = encode_answer(row[DC.EXPLANATION])
-        else:
-            sample[DC.ANSWER] = row[DC.ANSWER]
-            sample[DC.EXPLANATION] = row[DC.EXPLANATION]
-        sample[DC.TOPIC_DIFFICULTY] = row[DC.TOPIC_DIFFICULTY]
-        sample[DC.QUESTION_TYPE] = row[DC.QUESTION_TYPE]
-        sample[DC.SUBFIELD] = row[DC.SUBFIELD]
-        sample[DC.LANGUAGE] = row[DC.LANGUAGE]
-        sample[DC.MAIN_QUESTION_ID] = row[DC.MAIN_QUESTION_ID]
-        sample[DC.SUB_QUESTION_ID] = row[DC.SUB_QUESTION_ID]
-        sample[DC.IS_ARITHMETIC] = row[DC.IS_ARITHMETIC]
-
-        # Add answer image columns - only if this is the first sub-question
-        for i in range(1, 7):
-            ans_image_key = f'ans_image_{i}'
-            if is_first_subquestion and version.split('_')[-1] != 'txt':
-                image_name = row[ans_image_key]
-                if pd.notna(image_name):
-                    image_name = image_name.split('.')[0]
-                    # Construct full image path by joining parent_dir + subdir + filename
-                    image_path = Path(image_parent_dir + row['ans_image_parent_dir'][3:]) / image_name
-                    # Try to find image with either jpg or png extension
-                    full_path = find_image_file(image_path.parent, image_path.name)
-                    if full_path is not None:
-                        # Read the image file into PIL Image
-                        img = Image.open(full_path)
-                        # we dont need to encode the answer image as we assume we will try to avoid the answer image in the fuure 
-                        # Store the PIL Image object directly
-                        sample[ans_image_key] = img
-                    else:
-                        logger.warning(f"Answer image not found: {image_path}.[jpg|png]")
-                        sample[ans_image_key] = None
-                else:
-                    sample[ans_image_key] = None
-            else:
-                sample[ans_image_key] = None
-
-        sample[DC.RELEASE] = row[DC.RELEASE]
-
-        # Validate the sample
-        DC.validate_sample(sample)
-        return sample
-
-    # Process all rows
-    current_main_id = None
-    data = []
-
-    for _, row in df.iterrows():
-        is_first_subquestion = row[DC.MAIN_QUESTION_ID] != current_main_id
-        if is_first_subquestion:
-            current_main_id = row[DC.MAIN_QUESTION_ID]
+    # question id = language + main_question_id + sub_question_id + release_short
+    release_short = df[DC.RELEASE].map(ReleaseVersion.to_short_name)
+    question_ids = (df[DC.LANGUAGE].astype(str) + '_' + df[DC.MAIN_QUESTION_ID].astype(str) + '_' +
+                    df[DC.SUB_QUESTION_ID].astype(str) + '_' + release_short.astype(str))
+    options = df.apply(parse_options, axis=1) if len(df) else pd.Series(dtype=object)
+
+    # Images are only attached to the first sub-question of each main question
+    is_first_subquestion = df[DC.MAIN_QUESTION_ID].ne(df[DC.MAIN_QUESTION_ID].shift())
+    image_keys = [f'image_{i}' for i in range(1, 8)]
+    # we dont need to encode the answer image as we assume we will try to avoid the answer image in the fuure
+    ans_image_keys = [f'ans_image_{i}' for i in range(1, 7)]
+    if version.split('_')[-1] != 'txt':
+        image_paths = resolve_image_columns(df, image_parent_dir, image_keys, 'question_image_parent_dir',
+                                            is_first_subquestion)
+        image_paths.update(resolve_image_columns(df, image_parent_dir, ans_image_keys, 'ans_image_parent_dir',
+                                                 is_first_subquestion))
+    else:
+        image_paths = {image_key: pd.Series(None, index=df.index, dtype=object)
+                       for image_key in image_keys + ans_image_keys}
 
-        processed_sample = process_row(row, is_first_subquestion)
-        data.append(processed_sample)
+    if mask_answer:
+        answers = df[DC.ANSWER].map(encode_answer)
+        explanations = df[DC.EXPLANATION].map(encode_answer)
+    else:
+        answers = df[DC.ANSWER]
+        explanations = df[DC.EXPLANATION]
+
+    samples_df = pd.DataFrame({
+        DC.INDEX: df[DC.INDEX],
+        DC.QUESTION_ID: question_ids,
+        DC.CONTEXT: df[DC.CONTEXT],
+        DC.QUESTION: df[DC.QUESTION],
+        DC.OPTIONS: options,
+        **{image_key: image_paths[image_key] for image_key in image_keys},
+        DC.IMAGE_TYPE: df[DC.IMAGE_TYPE],
+        DC.ANSWER: answers,
+        DC.EXPLANATION: explanations,
+        DC.TOPIC_DIFFICULTY: df[DC.TOPIC_DIFFICULTY],
+        DC.QUESTION_TYPE: df[DC.QUESTION_TYPE],
+        DC.SUBFIELD: df[DC.SUBFIELD],
+        DC.LANGUAGE: df[DC.LANGUAGE],
+        DC.MAIN_QUESTION_ID: df[DC.MAIN_QUESTION_ID],
+        DC.SUB_QUESTION_ID: df[DC.SUB_QUESTION_ID],
+        DC.IS_ARITHMETIC: df[DC.IS_ARITHMETIC],
+        **{ans_image_key: image_paths[ans_image_key] for ans_image_key in ans_image_keys},
+        DC.RELEASE: df[DC.RELEASE],
+    }).astype(object)
+    samples_df = samples_df.where(samples_df.notna(), None)
+    # Validate the columns of the samples
+    DC.validate_sample(dict.fromkeys(samples_df.columns))
+
+    # One shard per run of the same release and language, in the order of the sorted DataFrame
+    shard_ids = (df[DC.RELEASE].ne(df[DC.RELEASE].shift()) | df[DC.LANGUAGE].ne(df[DC.LANGUAGE].shift())).cumsum()
+    shards = [shard_df.to_dict('records') for _, shard_df in samples_df.groupby(shard_ids.values, sort=False)]
+
+    # The datasets cache is keyed by the CSV, the options of the build and the image files
+    fingerprint = hashlib.sha256()
+    with open(csv_path, 'rb') as f:
+        fingerprint.update(f.read())
+    fingerprint.update(f'{version}|{mask_answer}|{image_parent_dir}'.encode('utf-8'))
+    for image_key in image_keys + ans_image_keys:
+        for path in image_paths[image_key].dropna():
+            stat = os.stat(path)
+            fingerprint.update(f'{path}|{stat.st_size}|{stat.st_mtime_ns}'.encode('utf-8'))
+
+    dataset = Dataset.from_generator(generate_samples, features=DC.get_features(),
+                                     gen_kwargs={'shards': shards, 'image_keys': tuple(image_keys + ans_image_keys),
+                                                 'image_workers': image_workers},
+                                     num_proc=min(num_proc, len(shards)) if num_proc and len(shards) > 1 else None,
+                                     fingerprint=fingerprint.hexdigest()[:32], split=version)
 
     # Create dataset with single split using the version
     splits = {
-        version: Dataset.from_list(data, features=DC.get_features())
+        version: dataset
     }
-    logger.info(f"Created split {version} with {len(data)} samples")
+    logger.info(f"Created split {version} with {len(dataset)} samples from {len(shards)} shards")
 
     # Create DatasetDict with the version split
     dataset_dict = DatasetDict(splits)
@@ -390,7 +448,9 @@ def main():
             csv_path=csv_path,
             image_parent_dir=config.data.source_image_dir,
             version=version,
-            mask_answer=mask_answer
+            mask_answer=mask_answer,
+            image_workers=config.data.get('image_workers', 8),
+            num_proc=config.data.get('num_proc', None)
         )
 
         # Add to DatasetDict with version as split name
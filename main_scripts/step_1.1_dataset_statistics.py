@@ -10,6 +10,9 @@ if __name__ == "__main__":
     parser.add_argument("--data_dir", type=str,
                         default="../hf_data/release_basic.json", help="The parent dir of dataset")
 
+    parser.add_argument("--use_token_counts", action="store_true",
+                        help="Read the token counts from the sidecar of the release, written next to it if missing")
+
     args = parser.parse_args()
 
-    get_dataset_statistics(args.data_dir)
+    get_dataset_statistics(args.data_dir, use_token_counts=args.use_token_counts)
@@ -0,0 +1,19 @@
+import argparse
+from famma_runner.utils import pack_release
+
+if __name__ == "__main__":
+    """
+    Pack a downloaded release (json + images) into a single snapshot file.
+    The snapshot can be used as data_dir in the runner configs.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_dir", type=str,
+                        default="../hf_data/release_basic.json", help="The dir of the release json")
+
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="The path of the snapshot, defaults to the release json path with the .famma suffix")
+
+    args = parser.parse_args()
+
+    pack_release(args.data_dir, args.output_path)
@@ -0,0 +1,19 @@
+import argparse
+from famma_runner.utils.token_utils import precompute_token_counts
+
+if __name__ == "__main__":
+    """
+    Precompute question/context/options token counts of a release and store them next to it.
+    Only questions that changed since the last run are tokenized again.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_dir", type=str,
+                        default="../hf_data/release_basic.json", help="The dir of the release json")
+
+    parser.add_argument("--encoding_name", type=str, default="cl100k_base",
+                        help="The tiktoken encoding to count tokens with")
+
+    args = parser.parse_args()
+
+    precompute_token_counts(args.data_dir, args.encoding_name)
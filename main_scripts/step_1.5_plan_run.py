@@ -0,0 +1,28 @@
+import argparse
+import json
+from omegaconf import OmegaConf
+from famma_runner.utils.plan_utils import plan_run
+
+if __name__ == "__main__":
+    """
+    Estimate the requests, tokens, duration and cost of a generation, evaluation or distillation run
+    before launching it. Works offline.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--config_dir", type=str, default="../configs/gen_config.yaml",
+                        help="The dir of the runner config file to plan.")
+
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="Optional path to save the plan in json format.")
+
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config_dir)
+
+    plan = plan_run(config)
+
+    print(json.dumps(plan, indent=4, ensure_ascii=False))
+    if args.output_path:
+        with open(args.output_path, "w", encoding="utf-8") as f:
+            json.dump(plan, f, indent=4, ensure_ascii=False)
@@ -41,6 +41,11 @@ def main():
         type=bool, 
         default=True,
         help="If True, decode base64-encoded answers")
+
+    parser.add_argument(
+        "--raw_images",
+        action='store_true',
+        help="If set, save the original image bytes (png/jpg) without decoding and re-encoding to JPEG")
     
     args = parser.parse_args()
     
@@ -49,7 +54,8 @@ def main():
         split=args.split,
         save_dir=args.save_dir,
         from_local=args.from_local,
-        decode_answer=args.decode_answer
+        decode_answer=args.decode_answer,
+        raw_images=args.raw_images
     )
     
     if success:
@@ -12,9 +12,14 @@ if __name__ == "__main__":
     parser.add_argument("--config_dir", type=str, default="../configs/custom_gen.yaml",
                         help="The dir of generation config file.")
 
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the run from its manifest, skipping the tasks it recorded as done.")
+
     args = parser.parse_args()
 
     config = OmegaConf.load(args.config_dir)
+    if args.resume:
+        OmegaConf.update(config, 'manifest.resume', True, force_add=True)
 
     runner = Runner.build_from_config(config)
 
@@ -0,0 +1,30 @@
+import argparse
+import pandas as pd
+from famma_runner.utils.telemetry_utils import load_telemetry, summarize_telemetry
+
+if __name__ == "__main__":
+    """
+    Summarize the telemetry events recorded by the runners (telemetry.enabled in the run config):
+    p50/p95/p99 latency, tokens per second and error rates per runner and model,
+    overall and broken down by language, difficulty and number of images.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--telemetry_dir", type=str, nargs='+', default=["./telemetry"],
+                        help="JSONL files, directories of JSONL files or glob patterns of the events")
+
+    parser.add_argument("--output_path", type=str, default="./telemetry_summary.csv",
+                        help="The path to save the summary to")
+
+    args = parser.parse_args()
+
+    events_df = load_telemetry(args.telemetry_dir)
+    if events_df.empty:
+        raise SystemExit(f"No telemetry events found in {args.telemetry_dir}")
+
+    summary_df = summarize_telemetry(events_df)
+    summary_df.to_csv(args.output_path, index=False)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(summary_df.to_string(index=False))
+    print(f"Summary saved to {args.output_path}")
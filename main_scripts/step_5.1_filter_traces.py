@@ -0,0 +1,34 @@
+import argparse
+from famma_runner.utils.filter_utils import run_trace_filter
+
+if __name__ == "__main__":
+    """
+    Filter the distilled reasoning traces of a store before uploading them (step_6): drop truncated traces,
+    empty answers, language mismatches, duplicates and traces of extreme length.
+    Accepted and rejected traces are written as json shards, rejected ones with their reason codes.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_dir", type=str,
+                        default="./ddb_storage/Pro/deepseek-ai/DeepSeek-R1_distill_release_basic_txt.json",
+                        help="The dir of the distillation store")
+
+    parser.add_argument("--output_dir", type=str, default="../hf_data/filtered_traces",
+                        help="The dir to write the accepted and rejected shards to")
+
+    parser.add_argument("--min_tokens", type=int, default=200, help="Minimum number of tokens of a trace")
+
+    parser.add_argument("--max_tokens", type=int, default=16000, help="Maximum number of tokens of a trace")
+
+    parser.add_argument("--require_correct", action='store_true',
+                        help="Whether to reject traces whose answer was judged incorrect during distillation")
+
+    parser.add_argument("--shard_size", type=int, default=10000, help="Number of traces per shard")
+
+    args = parser.parse_args()
+
+    run_trace_filter(args.data_dir, args.output_dir,
+                     config={'min_tokens': args.min_tokens,
+                             'max_tokens': args.max_tokens,
+                             'require_correct': args.require_correct},
+                     shard_size=args.shard_size)
@@ -0,0 +1,23 @@
+import argparse
+from famma_runner.utils.compress_utils import compress_store
+
+if __name__ == "__main__":
+    """
+    Compress the thinking_trajectory and reasoning_content fields of an existing reasoning store with zstd
+    and one dictionary per language trained on a sample of its traces. Requires `pip install zstandard`.
+    The dictionaries are saved next to the store and the fields are decompressed transparently when the store is read.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_dir", type=str,
+                        default="./ddb_storage/Pro/deepseek-ai/DeepSeek-R1_distill_release_basic_txt.json",
+                        help="The dir of the distillation store")
+
+    parser.add_argument("--sample_size", type=int, default=1000,
+                        help="Number of traces to train each dictionary on")
+
+    parser.add_argument("--level", type=int, default=10, help="The zstd compression level")
+
+    args = parser.parse_args()
+
+    compress_store(args.data_dir, sample_size=args.sample_size, level=args.level)
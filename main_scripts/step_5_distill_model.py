@@ -11,9 +11,14 @@ if __name__ == "__main__":
     parser.add_argument("--config_dir", type=str, default="../configs/distill_config.yaml",
                         help="The dir of evaluation config file.")
 
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the run from its manifest, skipping the tasks it recorded as done.")
+
     args = parser.parse_args()
 
     config = OmegaConf.load(args.config_dir)
+    if args.resume:
+        OmegaConf.update(config, 'manifest.resume', True, force_add=True)
 
     runner = Runner.build_from_config(config)
 
@@ -3,8 +3,11 @@ from datasets import Dataset, DatasetDict
 from huggingface_hub import HfApi
 import ast
 from omegaconf import OmegaConf
-from easyllm_kit.utils import get_logger, read_json
+from easyllm_kit.utils import get_logger
 from famma_runner.utils import RDC, LANGUAGE_ORDER
+from famma_runner.utils.filter_utils import load_accepted_traces
+from famma_runner.utils.compress_utils import load_store
+import os
 import re
 
 logger = get_logger('dataset_maker', '../question_maker.log')
@@ -15,12 +18,15 @@ def prepare_dataset(json_dir, version, source_release):
     Prepare dataset from json and convert it to HuggingFace format.
     
     Args:
-        json_dir: Path to json file
+        json_dir: Path to json file, or to the output dir of step_5.1_filter_traces.py to use the accepted traces
         version: Version to use as split name
         source_release: Source release to use as split name
     """
     # Read json file
-    json_data = read_json(json_dir)
+    if os.path.isdir(json_dir):
+        json_data = load_accepted_traces(json_dir)
+    else:
+        json_data = load_store(json_dir)
 
     df = pd.DataFrame(json_data).transpose()
 
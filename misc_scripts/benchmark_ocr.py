@@ -0,0 +1,89 @@
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from famma_runner.utils.ocr_utils import build_ocr_model, decode_image, run_ocr
+
+
+class NullOCR:
+    """
+    OCR model only reading its input, to measure the overhead of each path without the OCR itself.
+    Like PaddleOCR, it decodes images given as paths.
+    """
+
+    def ocr(self, image, cls=True):
+        if isinstance(image, str):
+            with open(image, 'rb') as f:
+                decode_image(f.read())
+        return [[]]
+
+
+def ocr_with_temp_file(ocr_model, image_bytes, i):
+    """The previous path of gen_utils._handle_ocr: write a jpg to the working directory, OCR it and remove it."""
+    temp_img_path = f"temp_img_{i}.jpg"
+    with open(temp_img_path, "wb") as f:
+        f.write(image_bytes)
+    pages = run_ocr(ocr_model, temp_img_path)
+    os.remove(temp_img_path)
+    return pages
+
+
+def ocr_in_memory(ocr_model, image_bytes, i):
+    """The current path: decode the bytes once to an array and OCR it."""
+    return run_ocr(ocr_model, decode_image(image_bytes))
+
+
+def benchmark(name, func, ocr_model, images, num_threads=1):
+    start_time = time.perf_counter()
+    if num_threads <= 1:
+        results = [func(ocr_model, image_bytes, i) for i, image_bytes in enumerate(images)]
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(lambda args: func(ocr_model, *args),
+                                        [(image_bytes, i) for i, image_bytes in enumerate(images)]))
+    elapsed = time.perf_counter() - start_time
+    print(f"{name:<28} {len(images) / elapsed:10.2f} images/sec ({elapsed:.2f}s)")
+    return results
+
+
+if __name__ == "__main__":
+    """
+    Compare the throughput of OCR from temporary files (the previous _handle_ocr) with OCR of images
+    decoded in memory, serially and from several threads sharing one model.
+    With --lang none, no OCR is run and only the overhead of each path is measured.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--image_dir", type=str, default="../hf_data/images",
+                        help="The dir of the images to OCR (jpg and png, searched recursively)")
+
+    parser.add_argument("--num_images", type=int, default=50, help="Number of images to OCR")
+
+    parser.add_argument("--lang", type=str, default="ch",
+                        help="The PaddleOCR language, or none to skip the OCR itself")
+
+    parser.add_argument("--num_threads", type=int, default=4,
+                        help="Number of threads of the concurrent in-memory run")
+
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.image_dir, '**', '*.jpg'), recursive=True) +
+                   glob.glob(os.path.join(args.image_dir, '**', '*.png'), recursive=True))[:args.num_images]
+    if not paths:
+        raise SystemExit(f"No images found in {args.image_dir}")
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+
+    ocr_model = NullOCR() if args.lang == 'none' else build_ocr_model(args.lang)
+    # Warm up the model, the first call initializes the predictors
+    run_ocr(ocr_model, decode_image(images[0]))
+
+    print(f"{len(images)} images from {args.image_dir}")
+    temp_file_results = benchmark('temp file', ocr_with_temp_file, ocr_model, images)
+    in_memory_results = benchmark('in memory', ocr_in_memory, ocr_model, images)
+    benchmark(f'in memory, {args.num_threads} threads', ocr_in_memory, ocr_model, images, args.num_threads)
+    print(f"Same text for {sum(a == b for a, b in zip(temp_file_results, in_memory_results))}/{len(images)} images")
@@ -0,0 +1,100 @@
+import argparse
+import json
+import random
+import time
+
+import json_repair
+
+from famma_runner.utils.gen_utils import parse_json_object
+
+
+def legacy_parse_json_object(text):
+    """The previous path of gen_utils.safe_parse_response: json_repair over the whole response."""
+    try:
+        parsed = json_repair.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, dict) and parsed else None
+
+
+def make_answers(question_ids, rng):
+    return {question_id: {"answer": rng.choice("ABCD"),
+                          "explanation": "The rate rises by {0} bp, so " * rng.randint(1, 5) + "the price falls."}
+            for question_id in question_ids}
+
+
+def build_corpus(num_responses, seed=0):
+    """Synthetic responses in the shapes the models return, from plain JSON to text without any JSON."""
+    rng = random.Random(seed)
+    reasoning = "Let us compute the discounted cash flows {CF_t / (1 + r)^t} year by year.\n" * 40
+    corpus = []
+    for i in range(num_responses):
+        question_ids = [f"q{j}" for j in range(1, rng.randint(2, 6))]
+        answers = json.dumps(make_answers(question_ids, rng), indent=2)
+        kind = i % 5
+        if kind == 0:
+            response = answers
+        elif kind == 1:
+            response = f"{reasoning}\n```json\n{answers}\n```"
+        elif kind == 2:
+            response = f"{reasoning}\nSo the final answer is {answers}\nHope this helps."
+        elif kind == 3:
+            # Trailing comma and missing closing brace, only json_repair can read it
+            response = f"```json\n{answers[:-2]},\n```"
+        else:
+            response = reasoning
+        corpus.append({"response": response, "question_ids": question_ids})
+    return corpus
+
+
+def benchmark(name, func, corpus, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        results = [func(item["response"]) for item in corpus]
+    elapsed = time.perf_counter() - start_time
+    print(f"{name:<12} {len(corpus) * repeat / elapsed:10.2f} responses/sec ({elapsed:.2f}s)")
+    return results
+
+
+if __name__ == "__main__":
+    """
+    Compare the throughput of the layered JSON parsing of safe_parse_response (json.loads, fenced blocks,
+    brace scanner and json_repair as the last resort) with json_repair over every response, as before.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--corpus", type=str, default=None,
+                        help="JSONL file of {\"response\": ..., \"question_ids\": [...]}, "
+                             "a synthetic corpus is built if not given")
+
+    parser.add_argument("--num_responses", type=int, default=500, help="Size of the synthetic corpus")
+
+    parser.add_argument("--repeat", type=int, default=3, help="Number of passes over the corpus")
+
+    parser.add_argument("--dump_corpus", type=str, default=None,
+                        help="Write the corpus to this JSONL file, e.g. to edit it and run it again")
+
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            corpus = [json.loads(line) for line in f if line.strip()]
+    else:
+        corpus = build_corpus(args.num_responses)
+
+    if args.dump_corpus:
+        with open(args.dump_corpus, 'w', encoding='utf-8') as f:
+            for item in corpus:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+    print(f"{len(corpus)} responses, {sum(len(item['response']) for item in corpus) / len(corpus):.0f} chars "
+          f"on average")
+    legacy_results = benchmark('json_repair', legacy_parse_json_object, corpus, args.repeat)
+    layered_results = benchmark('layered', parse_json_object, corpus, args.repeat)
+
+    same = sum(a == b for a, b in zip(legacy_results, layered_results))
+    print(f"Same object for {same}/{len(corpus)} responses")
+    for item, legacy, layered in zip(corpus, legacy_results, layered_results):
+        if legacy != layered:
+            print(f"- {item['response'][:80]!r}...\n  json_repair: {str(legacy)[:80]}\n  layered:     {str(layered)[:80]}")
+            break
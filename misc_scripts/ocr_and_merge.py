@@ -1,11 +1,19 @@
 import os
+import time
+import multiprocessing
 import pandas as pd
-from paddleocr import PaddleOCR
 from easyllm_kit.utils import read_json, save_json, get_logger
-from tqdm import tqdm
+from famma_runner.utils.ocr_utils import OCRCache, DEFAULT_OCR_CACHE_PATH, get_ocr_language, build_ocr_model, run_ocr
 
 logger = get_logger('ocr_and_merge')
 
+# OCR models of a worker process, created on first use per language
+_worker_ocr_models = {}
+_worker_cpu_threads = None
+
+# Images sent to a worker at once, all of the same language
+OCR_CHUNK_SIZE = 8
+
 def get_paddle_language(language):
     """
     Map dataset language to PaddleOCR language code.
@@ -16,12 +24,21 @@ def get_paddle_language(language):
     Returns:
         PaddleOCR language code
     """
-    language_map = {
-        'english': 'en',
-        'chinese': 'ch',
-        'french': 'fr'
-    }
-    return language_map.get(language, 'en')
+    return get_ocr_language(language)
+
+def perform_ocr_pages(image_path, ocr_model):
+    """
+    Perform OCR on the given image and return the text lines of each page, None if OCR failed.
+    """
+    try:
+        return run_ocr(ocr_model, image_path)
+    except Exception as e:
+        logger.error(f"Error performing OCR on {image_path}: {e}")
+        return None
+
+def format_ocr_text(pages):
+    """Text of the first page of an OCR result, lines joined by spaces."""
+    return " ".join(pages[0]) if pages else ""
 
 def perform_ocr(image_path, ocr_model):
     """
@@ -34,22 +51,130 @@ def perform_ocr(image_path, ocr_model):
     Returns:
         Extracted text from the image.
     """
-    try:
-        result = ocr_model.ocr(image_path, cls=True)
-        
-        # Extract text from OCR results
-        texts = []
-        if result and len(result) > 0 and result[0]:
-            for line in result[0]:
-                if len(line) >= 2 and line[1] and len(line[1]) >= 1:
-                    texts.append(line[1][0])
-        
-        return " ".join(texts)
-    except Exception as e:
-        logger.error(f"Error performing OCR on {image_path}: {e}")
-        return ""
+    return format_ocr_text(perform_ocr_pages(image_path, ocr_model))
+
+def _init_ocr_worker(cpu_threads):
+    global _worker_cpu_threads
+    _worker_cpu_threads = cpu_threads
+
+
+def _get_worker_ocr_model(language):
+    """Load the OCR model of a language in the current worker the first time it is needed."""
+    if language not in _worker_ocr_models:
+        kwargs = {'cpu_threads': _worker_cpu_threads} if _worker_cpu_threads else {}
+        _worker_ocr_models[language] = build_ocr_model(get_paddle_language(language), **kwargs)
+    return _worker_ocr_models[language]
+
+
+def _ocr_chunk(chunk):
+    """OCR a chunk of (task_idx, language, image_path) tasks, all of one language."""
+    return [(task_idx, perform_ocr_pages(image_path, _get_worker_ocr_model(language)))
+            for task_idx, language, image_path in chunk]
+
+
+def get_first_subquestion(question_group):
+    for question in question_group:
+        if question.get('sub_question_id') == '1' or question.get('sub_question_id') == 1:
+            return question
+    return question_group[0]  # Fallback to first question if no sub_question_id 1
+
+
+def build_ocr_tasks(questions_by_group, image_base_path):
+    """
+    List the images to OCR as (group_key, image_idx, language, image_path), one per existing image
+    of the first subquestion of each group, in dataset order.
+    """
+    tasks = []
+    for group_key, question_group in questions_by_group.items():
+        language = question_group[0].get('language', 'english')
+        first_subquestion = get_first_subquestion(question_group)
+        for i in range(1, 8):  # Assuming up to 7 images
+            image_path = first_subquestion.get(f'image_{i}')
+            if image_path and image_path != "None":
+                full_image_path = os.path.join(image_base_path, image_path)
+                if os.path.exists(full_image_path):
+                    tasks.append((group_key, i, language, full_image_path))
+    return tasks
+
+
+def run_ocr_tasks(tasks, num_workers=None, chunk_size=OCR_CHUNK_SIZE, ocr_cache_path=DEFAULT_OCR_CACHE_PATH):
+    """
+    OCR the images of the tasks in a process pool.
+
+    Images already in the OCR cache are not OCRed again, and the results of the others are added to it.
+    Every worker loads the OCR model of a language only when it first gets an image of that language,
+    and tasks are sent in chunks of one language sorted by language, so workers mostly reuse one model.
+    Results are collected as the chunks complete.
+
+    Returns:
+        List of the OCR texts, in the order of the tasks
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    start_time = time.time()
+    texts = [''] * len(tasks)
+
+    # Look up the cache in the main process, only the misses are sent to the workers
+    caches = {}
+    image_bytes = {}
+    pending = list(range(len(tasks)))
+    if ocr_cache_path:
+        pending = []
+        for idx, (_, _, language, image_path) in enumerate(tasks):
+            if language not in caches:
+                caches[language] = OCRCache(ocr_cache_path, lang=get_paddle_language(language))
+            with open(image_path, 'rb') as f:
+                data = f.read()
+            pages = caches[language].get(data)
+            if pages is None:
+                image_bytes[idx] = data
+                pending.append(idx)
+            else:
+                texts[idx] = format_ocr_text(pages)
+        logger.info(f'{len(tasks) - len(pending)}/{len(tasks)} images found in the OCR cache {ocr_cache_path}')
+
+    # Chunks of one language, in language order
+    chunks = []
+    for idx in sorted(pending, key=lambda idx: tasks[idx][2]):
+        task = (idx, tasks[idx][2], tasks[idx][3])
+        if chunks and len(chunks[-1]) < chunk_size and chunks[-1][-1][1] == task[1]:
+            chunks[-1].append(task)
+        else:
+            chunks.append([task])
+
+    num_done = 0
+
+    def collect(results):
+        nonlocal num_done
+        for task_idx, pages in results:
+            texts[task_idx] = format_ocr_text(pages)
+            # Failed images are not cached, so that they are retried by the next run
+            if pages is not None and task_idx in image_bytes:
+                caches[tasks[task_idx][2]].put(image_bytes.pop(task_idx), pages)
+        num_done += len(results)
+        elapsed = time.time() - start_time
+        logger.info(f'{num_done}/{len(pending)} images processed, {num_done / max(elapsed, 1e-9):.2f} images/sec')
 
-def merge_ocr_text_into_dataset(json_path, image_base_path, output_csv_path):
+    if num_workers <= 1 or not chunks:
+        _init_ocr_worker(None)
+        for chunk in chunks:
+            collect(_ocr_chunk(chunk))
+    else:
+        # Split the cores between the workers, so that paddle does not oversubscribe them
+        cpu_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        # spawn: paddle is not fork-safe
+        with multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_ocr_worker,
+                                                       initargs=(cpu_threads,)) as pool:
+            for results in pool.imap_unordered(_ocr_chunk, chunks):
+                collect(results)
+
+    for cache in caches.values():
+        cache.close()
+    logger.info(f'OCR of {len(tasks)} images done in {time.time() - start_time:.1f}s')
+    return texts
+
+
+def merge_ocr_text_into_dataset(json_path, image_base_path, output_csv_path, num_workers=None,
+                                ocr_cache_path=DEFAULT_OCR_CACHE_PATH):
     """
     Process all questions, perform OCR on images, and merge text into context.
     Output the result as a CSV file.
@@ -58,6 +183,8 @@ def merge_ocr_text_into_dataset(json_path, image_base_path, output_csv_path):
         json_path: Path to the JSON file.
         image_base_path: Base path where images are stored.
         output_csv_path: Path to save the updated CSV file.
+        num_workers: Number of OCR processes, defaults to the number of CPUs.
+        ocr_cache_path: Path of the OCR cache shared with the generation runner, None to disable it.
     """
     # Read the JSON data
     data = read_json(json_path)
@@ -65,13 +192,6 @@ def merge_ocr_text_into_dataset(json_path, image_base_path, output_csv_path):
     # Create a list to store all processed questions
     all_questions = []
     
-    # Initialize OCR models for different languages
-    ocr_models = {
-        'english': PaddleOCR(use_angle_cls=True, lang='en'),
-        'chinese': PaddleOCR(use_angle_cls=True, lang='ch'),
-        'french': PaddleOCR(use_angle_cls=True, lang='fr')
-    }
-    
     # Group questions by language and main_question_id
     questions_by_group = {}
     for question_data in data:
@@ -83,34 +203,17 @@ def merge_ocr_text_into_dataset(json_path, image_base_path, output_csv_path):
             questions_by_group[group_key] = []
         
         questions_by_group[group_key].append(question_data)
+
+    # OCR all images in parallel, then merge the texts group by group in dataset order
+    tasks = build_ocr_tasks(questions_by_group, image_base_path)
+    ocr_texts_by_group = {}
+    for (group_key, i, _, _), ocr_text in zip(tasks, run_ocr_tasks(tasks, num_workers, ocr_cache_path=ocr_cache_path)):
+        if ocr_text:
+            ocr_texts_by_group.setdefault(group_key, []).append(f"image_{i} ocr text: {ocr_text}")
     
     # Process each group of questions
     for group_key, question_group in questions_by_group.items():
-        language = question_group[0].get('language', 'english')
-        ocr_model = ocr_models.get(language, ocr_models['english'])
-        
-        # Get all unique images from the first subquestion
-        first_subquestion = None
-        for question in question_group:
-            if question.get('sub_question_id') == '1' or question.get('sub_question_id') == 1:
-                first_subquestion = question
-                break
-        
-        if not first_subquestion:
-            first_subquestion = question_group[0]  # Fallback to first question if no sub_question_id 1
-            
-        # Extract OCR text from images in the first subquestion
-        ocr_texts = []
-        for i in range(1, 8):  # Assuming up to 7 images
-            image_key = f'image_{i}'
-            image_path = first_subquestion.get(image_key)
-            
-            if image_path and image_path != "None":
-                full_image_path = os.path.join(image_base_path, image_path)
-                if os.path.exists(full_image_path):
-                    ocr_text = perform_ocr(full_image_path, ocr_model)
-                    if ocr_text:
-                        ocr_texts.append(f"image_{i} ocr text: {ocr_text}")
+        ocr_texts = ocr_texts_by_group.get(group_key, [])
         
         # If we have OCR text, update only the first subquestion's context
         if ocr_texts:
@@ -157,5 +260,6 @@ if __name__ == "__main__":
     json_path = "../hf_data/release_livepro.json"
     image_base_path = "../hf_data/"
     output_csv_path = "../ddb_storage/release_livepro_txt.csv"
+    num_workers = os.cpu_count()
     
-    merge_ocr_text_into_dataset(json_path, image_base_path, output_csv_path) 
\ No newline at end of file
+    merge_ocr_text_into_dataset(json_path, image_base_path, output_csv_path, num_workers=num_workers) 
\ No newline at end of file
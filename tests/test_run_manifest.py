@@ -0,0 +1,58 @@
+import time
+
+import dictdatabase as DDB
+
+from famma_runner.runners.base_runner import Runner
+from famma_runner.utils.manifest_utils import DONE, PENDING, RunManifest
+from famma_runner.utils.pipeline_utils import Pipeline, Stage
+from famma_runner.utils.writer_utils import ResultWriter
+
+
+class SlowWriterRunner(Runner):
+    """Runner storing its results through a ResultWriter that is still flushing when the pipeline ends."""
+
+    def __init__(self, db_name, manifest_path, keys):
+        self.manifest = RunManifest(manifest_path)
+        self.manifest.register(keys)
+        self.writer = ResultWriter(db_name, batch_size=1, transform=self.slow_transform,
+                                   on_written=self.manifest.done_many)
+
+    @staticmethod
+    def slow_transform(record):
+        time.sleep(0.01)
+        return record
+
+    def persist(self, task):
+        self.writer.put(task['key'], {'value': task['value']})
+        return task
+
+    def run(self, tasks):
+        pipeline = Pipeline('test', [Stage('persist', self.persist)], manifest=self.manifest, mark_done=False)
+        try:
+            with self.writer:
+                self.run_pipeline(pipeline, tasks)
+        finally:
+            self.close_manifest()
+
+
+def test_manifest_outlives_flushing_writer(tmp_path):
+    DDB.config.storage_directory = str(tmp_path)
+    DDB.at('results').create({})
+    keys = [f'q{i}' for i in range(20)]
+
+    runner = SlowWriterRunner('results', str(tmp_path / 'results.manifest.jsonl'), keys)
+    runner.run([{'key': key, 'value': i} for i, key in enumerate(keys)])
+
+    assert sorted(DDB.at('results').read()) == sorted(keys)
+    resumed = RunManifest(str(tmp_path / 'results.manifest.jsonl'), resume=True)
+    assert sorted(resumed.keys(DONE)) == sorted(keys)
+    assert resumed.keys(PENDING) == []
+    resumed.close()
+
+
+def test_closed_manifest_ignores_updates(tmp_path):
+    manifest = RunManifest(str(tmp_path / 'run.manifest.jsonl'))
+    manifest.register(['q1'])
+    manifest.close()
+    manifest.done('q1')
+    assert manifest.state('q1') == PENDING